@@ -0,0 +1,126 @@
+# vim: set fileencoding=utf-8 :
+"""
+Read documents straight out of archives, and write outputs into them.
+
+	texdown2html.py --outdir html.zip corpus.tar.gz more.zip paper.texdown.gz
+
+Inputs to --outdir may be .texdown files, compressed ones (.gz, .bz2, .xz),
+or tar (optionally compressed) and zip archives, whose .texdown members are
+converted. The output may be a directory or an archive: a name ending in
+.zip, .tar, .tar.gz, .tgz, .tar.bz2 or .tar.xz. Outputs keep the paths the
+documents had inside their archive.
+
+Nothing is unpacked to disk. Tar archives are read as a stream, one member at
+a time; zip archives member by member from their index; and outputs are added
+to the output archive as each document is finished. So only the documents
+being converted are held in memory, however big the archive.
+"""
+
+import bz2
+import gzip
+import io
+import lzma
+import os
+import tarfile
+import time
+import zipfile
+
+import texdown
+
+COMPRESSED = {'.gz': gzip.open, '.bz2': bz2.open, '.xz': lzma.open}
+TAR_ENDINGS = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tar.xz')
+TAR_WRITE_MODES = {'.tar': 'w|', '.tar.gz': 'w|gz', '.tgz': 'w|gz', '.tar.bz2': 'w|bz2', '.tar.xz': 'w|xz'}
+
+DOCUMENT_EXTENSION = '.texdown'
+
+class ArchiveError(texdown.ConversionError):
+	pass
+
+def tar_ending(path):
+	for ending in TAR_ENDINGS:
+		if path.endswith(ending):
+			return ending
+	return None
+
+def is_archive(path):
+	return tar_ending(path) is not None or path.endswith('.zip')
+
+def safe_name(name):
+	" A member name as a relative path which stays inside the output. "
+	name = os.path.normpath(name.replace('\\', '/')).lstrip('/')
+	if name == '..' or name.startswith('../'):
+		raise ArchiveError("unsafe path in archive: %s" % (name))
+	return name
+
+def read_documents(path):
+	"""
+	Yield (name, text) for each document in path: an archive, a compressed
+	file or a plain .texdown file. Names of documents from archives are
+	their paths in the archive; other files are named by their basename.
+	"""
+	try:
+		if tar_ending(path):
+			with tarfile.open(path, 'r|*') as archive:
+				for member in archive:
+					if member.isfile() and member.name.endswith(DOCUMENT_EXTENSION):
+						handle = archive.extractfile(member)
+						yield safe_name(member.name), handle.read().decode('utf-8')
+		elif path.endswith('.zip'):
+			with zipfile.ZipFile(path) as archive:
+				for info in archive.infolist():
+					if not info.is_dir() and info.filename.endswith(DOCUMENT_EXTENSION):
+						with archive.open(info) as handle:
+							yield safe_name(info.filename), handle.read().decode('utf-8')
+		else:
+			stem, extension = os.path.splitext(path)
+			if extension in COMPRESSED:
+				with COMPRESSED[extension](path, 'rb') as handle:
+					yield os.path.basename(stem), handle.read().decode('utf-8')
+			else:
+				with open(path, 'rb') as handle:
+					yield os.path.basename(path), handle.read().decode('utf-8')
+	except (IOError, OSError, EOFError, tarfile.TarError, zipfile.BadZipFile, lzma.LZMAError) as e:
+		raise ArchiveError("%s: %s" % (path, e))
+	except UnicodeDecodeError as e:
+		raise ArchiveError("%s: not UTF-8: %s" % (path, e))
+
+class Output(object):
+	" Where converted documents go: a directory, or an archive, by its name. "
+	def __init__(self, path):
+		self.path = path
+		self.written = set()
+		ending = tar_ending(path)
+		if ending:
+			self.kind = 'tar'
+			self.archive = tarfile.open(path, TAR_WRITE_MODES[ending])
+		elif path.endswith('.zip'):
+			self.kind = 'zip'
+			self.archive = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED)
+		else:
+			self.kind = 'directory'
+			if not os.path.isdir(path):
+				os.makedirs(path)
+
+	def write(self, name, text):
+		name = safe_name(name)
+		if self.kind != 'directory' and name in self.written:
+			return # Sidecars shared by several documents; the first will do.
+		self.written.add(name)
+		data = text.encode('utf-8')
+		if self.kind == 'tar':
+			info = tarfile.TarInfo(name)
+			info.size = len(data)
+			info.mtime = time.time()
+			self.archive.addfile(info, io.BytesIO(data))
+		elif self.kind == 'zip':
+			self.archive.writestr(name, data)
+		else:
+			path = os.path.join(self.path, name)
+			if not os.path.isdir(os.path.dirname(path)):
+				os.makedirs(os.path.dirname(path))
+			with open(path, 'wb') as handle:
+				handle.write(data)
+
+	def close(self):
+		if self.kind != 'directory':
+			self.archive.close()
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# vim: set fileencoding=utf-8 :
+"""
+Benchmark the conversion engine on a synthetic document.
+
+	bench.py [-n SECTIONS] [-r REPEATS]
+	bench.py --adversarial [-n SIZE] [-r REPEATS]
+
+Runs the LaTeX backend in-process and reports the best wall-clock time and
+engine statistics, with and without the literal prefilter, the peak memory
+used by one conversion (as chunks, and joined into one string), then the size
+of the HTML search index (see search.py) and the time taken to build it.
+
+With --adversarial, converts inputs built to make the rules backtrack (long
+unterminated runs, huge lists, deeply nested inclusions) at SIZE and four
+times SIZE, and exits 1 if any of them takes more than SLOWDOWN times as
+long at the larger size, i.e. if the time taken doesn't grow linearly.
+"""
+
+import sys
+import time
+import tracemalloc
+from optparse import OptionParser
+
+import search
+import texdown
+import texdown2html
+import texdown2latex
+
+SECTION = """
+== Section %(n)d <<sec.%(n)d>> ==
+Plain paragraph text with nothing special in it, the kind that makes up most
+of a real document. It goes on for a few lines so that the fragments passed
+down the rule list are of a realistic size.
+Here is some /italic text/, some *bold text*, a ''teletype'' word, a
+reference to Section [sec.%(n)d] and a citation[[Knuth84]].
+
+= Subsection %(n)d =
+ * First item
+ * Second item with a "quote"
+ * Third item
+
+	for i in range(%(n)d):	!!floatcode
+		print(i)
+	~~ <<code.%(n)d>> Some code ~~
+
+	Name	Value	Unit	!!floattable
+	alpha	1	ms
+	beta	2	ms
+	~~ <<table.%(n)d>> Timings ~~
+
+ Latency: Time for one request.
+ Throughput: Requests per second.
+
+More text after the listing, again without any markup at all, just words
+and punctuation, commas, full stops.
+"""
+
+# Inputs which are slow to match if a rule backtracks, by size.
+ADVERSARIAL = [
+	('unterminated /', lambda n: 'x ' + '1/a' * n + '\n'),
+	('unterminated "', lambda n: 'a "b' * n + '\n'),
+	('unterminated $', lambda n: 'a $b' * n + '\n'),
+	('unterminated ((', lambda n: '((' * n + '\n))\n'),
+	('quote run', lambda n: '"' * n + '\n'),
+	('spaces before [[', lambda n: 'a' + ' ' * n + 'b [[Knuth84]]\n'),
+	('spaced heading', lambda n: '== ' + ' ' * n + 'x\n'),
+	('bullet list', lambda n: ' * item\n' * n),
+	('nested inclusions', lambda n: " * ''a_b'' \"c_d% e&f\" *g* /h i/ [[k]] [r]\n" * (n // 10)),
+]
+
+SLOWDOWN = 6.0
+
+def make_document(sections):
+	return ''.join(SECTION % {'n': n} for n in range(sections))
+
+def run(document, repeats, prefilter):
+	texdown.Converter.prefilter = prefilter
+	best = None
+	for repeat in range(repeats):
+		converter = texdown.Converter([texdown2latex.Macros])
+		start = time.perf_counter()
+		converter(document)
+		elapsed = time.perf_counter() - start
+		if best is None or elapsed < best:
+			best = elapsed
+	return best, converter.stats
+
+def report(label, elapsed, stats):
+	print("%-14s %8.1f ms   finditer calls %7d   rules skipped %7d   fragment cache %d/%d" \
+			% (label, elapsed * 1000, stats['finditer'], stats['prefilter_skips'],
+			stats['fragment_cache_hits'], stats['fragment_cache_hits'] + stats['fragment_cache_misses']))
+
+def peak_memory(convert):
+	" Peak memory allocated while running convert(), in bytes. "
+	tracemalloc.start()
+	output = convert()
+	current, peak = tracemalloc.get_traced_memory()
+	tracemalloc.stop()
+	del output
+	return peak
+
+def adversarial(size, repeats):
+	" Returns True if every adversarial input takes linear time. "
+	linear = True
+	for name, make in ADVERSARIAL:
+		times = []
+		for document in (make(size), make(size * 4)):
+			best = None
+			for repeat in range(repeats):
+				converter = texdown.Converter([texdown2latex.Macros])
+				start = time.perf_counter()
+				converter(document)
+				elapsed = time.perf_counter() - start
+				if best is None or elapsed < best:
+					best = elapsed
+			times.append(best)
+		slowdown = times[1] / max(times[0], 1e-6)
+		print("%-20s %8.1f ms %8.1f ms   x%.1f%s" % (name, times[0] * 1000, times[1] * 1000,
+				slowdown, '   SUPERLINEAR' if slowdown > SLOWDOWN else ''))
+		if slowdown > SLOWDOWN:
+			linear = False
+	return linear
+
+def main():
+	parser = OptionParser()
+	parser.add_option('-n', dest = 'sections', type = 'int', default = None)
+	parser.add_option('-r', dest = 'repeats', type = 'int', default = 5)
+	parser.add_option('--adversarial', dest = 'adversarial', action = 'store_true', default = False)
+	opts, args = parser.parse_args()
+
+	texdown.update_conversions(texdown.CONVERSIONS, texdown2latex.CONVERSIONS_TXT)
+	if opts.adversarial:
+		if not adversarial(opts.sections or 25000, opts.repeats):
+			sys.exit(1)
+		return
+	if opts.sections is None:
+		opts.sections = 200
+
+	document = make_document(opts.sections)
+	print("Document: %d sections, %d bytes" % (opts.sections, len(document)))
+
+	elapsed, unfiltered = run(document, opts.repeats, False)
+	report('no prefilter', elapsed, unfiltered)
+	elapsed, filtered = run(document, opts.repeats, True)
+	report('prefilter', elapsed, filtered)
+	print("finditer calls avoided: %d" % (unfiltered['finditer'] - filtered['finditer']))
+
+	converter = texdown.Converter([texdown2latex.Macros])
+	print("peak memory: %.2f MB as chunks, %.2f MB joined" \
+			% (peak_memory(lambda: converter.convert_document(document)) / 1e6,
+			peak_memory(lambda: converter(document)) / 1e6))
+
+	# The index is built from the output's chunks as they are joined.
+	texdown.update_conversions(texdown.CONVERSIONS, texdown2html.CONVERSIONS_TXT)
+	chunks = texdown.Converter([texdown2html.Macros]).convert_document(document)
+	best = None
+	for repeat in range(opts.repeats):
+		start = time.perf_counter()
+		index = search.SearchIndex()
+		for chunk in chunks:
+			index.add_output(chunk)
+		index = search.to_json(index.index())
+		elapsed = time.perf_counter() - start
+		if best is None or elapsed < best:
+			best = elapsed
+	print("search index: %d bytes (%.1f%% of the source), built in %.1f ms" \
+			% (len(index.encode('utf-8')), 100.0 * len(index) / len(document), best * 1000))
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,300 @@
+# vim: set fileencoding=utf-8 :
+"""
+A small pure-Python BibTeX reader.
+
+Parsing a big .bib file for every document is slow, so the reader keeps a
+key index next to the bibliography (papers.bib -> papers.bib.idx). The index
+records the byte range of every entry, plus any @string definitions, and is
+reused until the size or modification time of the .bib file changes. Looking
+up a key then means reading and parsing just that one entry.
+
+The index format is plain text:
+	texdown-bibindex	<version>	<bib size>	<bib mtime_ns>
+	<key>	<start>	<end>
+	@<string name>	<string value>
+"""
+
+import os
+import re
+import sys
+
+INDEX_VERSION = 1
+INDEX_MAGIC = 'texdown-bibindex'
+
+# BibTeX predefines the month macros.
+MONTHS = {
+	'jan': 'January', 'feb': 'February', 'mar': 'March', 'apr': 'April',
+	'may': 'May', 'jun': 'June', 'jul': 'July', 'aug': 'August',
+	'sep': 'September', 'oct': 'October', 'nov': 'November', 'dec': 'December',
+}
+
+ENTRY_START = re.compile(br'@[ \t]*([A-Za-z]+)[ \t\r\n]*([{(])')
+LINE_START_AT = re.compile(br'\n[ \t]*@')
+BRACES = re.compile(br'[{}]')
+PARENS_OR_BRACES = re.compile(br'[{}()]')
+FIELD_NAME = re.compile(r'\s*([A-Za-z][A-Za-z0-9_:.+-]*)\s*=\s*')
+BARE_VALUE = re.compile(r'[A-Za-z0-9_:.+-]+')
+LATEX_COMMAND = re.compile(r'\\(?:[A-Za-z]+|.) ?')
+KEPT_COMMANDS = ('LaTeX', 'TeX', 'BibTeX')
+
+class BibError(Exception):
+	pass
+
+def entry_end(data, start, delim):
+	"""
+	Return the offset just past the closing delimiter of the entry whose
+	opening delimiter ends at 'start', or -1 if the entry is unterminated.
+	"""
+	depth = 0
+	if delim == b'{':
+		depth = 1
+		for brace in BRACES.finditer(data, start):
+			if brace.group() == b'{':
+				depth += 1
+			else:
+				depth -= 1
+				if depth == 0:
+					return brace.end()
+	else:
+		for brace in PARENS_OR_BRACES.finditer(data, start):
+			char = brace.group()
+			if char == b'{':
+				depth += 1
+			elif char == b'}':
+				depth -= 1
+			elif char == b')' and depth == 0:
+				return brace.end()
+	return -1
+
+def scan(data, filename = '<bib>'):
+	"""
+	Scan the bytes of a .bib file. Returns (entries, strings), where entries
+	maps each key to the (start, end) byte range of its entry, and strings
+	maps @string names to their values.
+
+	Like BibTeX, an entry which is never closed is reported and skipped, and
+	scanning carries on from the next line starting with '@'.
+	"""
+	entries = {}
+	strings = {}
+
+	pos = 0
+	while True:
+		match = ENTRY_START.search(data, pos)
+		if not match:
+			break
+		end = entry_end(data, match.end(), match.group(2))
+		if end == -1:
+			sys.stderr.write("Warning: %s:%d: unterminated entry skipped\n" \
+					% (filename, data.count(b'\n', 0, match.start()) + 1))
+			resume = LINE_START_AT.search(data, match.end())
+			if not resume:
+				break
+			pos = resume.end() - 1
+			continue
+		pos = end
+
+		entry_type = match.group(1).lower()
+		if entry_type in (b'comment', b'preamble'):
+			continue
+
+		body = data[match.end():end - 1].decode('utf-8', 'replace')
+		if entry_type == b'string':
+			for name, value in parse_fields(body, {}):
+				strings[name] = value
+		else:
+			key = body.split(',', 1)[0].strip()
+			if key:
+				entries[key] = (match.start(), end)
+
+	return entries, strings
+
+def parse_value(body, pos, strings):
+	"""
+	Parse a field value starting at 'pos': one or more braced, quoted or bare
+	parts joined with '#'. Returns (value, new position).
+	"""
+	parts = []
+	while True:
+		while pos < len(body) and body[pos].isspace():
+			pos += 1
+		if pos >= len(body):
+			break
+
+		char = body[pos]
+		if char in '{"':
+			close = '}' if char == '{' else '"'
+			depth = 0
+			end = pos + 1
+			while end < len(body):
+				if body[end] == '{':
+					depth += 1
+				elif body[end] == '}' and depth > 0:
+					depth -= 1
+				elif body[end] == close and depth == 0:
+					break
+				end += 1
+			parts.append(body[pos + 1:end])
+			pos = end + 1
+		else:
+			match = BARE_VALUE.match(body, pos)
+			if not match:
+				break
+			word = match.group()
+			if word.isdigit():
+				parts.append(word)
+			else:
+				parts.append(strings.get(word.lower(), MONTHS.get(word.lower(), word)))
+			pos = match.end()
+
+		while pos < len(body) and body[pos].isspace():
+			pos += 1
+		if pos < len(body) and body[pos] == '#':
+			pos += 1
+		else:
+			break
+
+	return ''.join(parts), pos
+
+def parse_fields(body, strings):
+	" Yield (name, value) for every 'name = value' pair in body. "
+	pos = 0
+	while True:
+		match = FIELD_NAME.match(body, pos)
+		if not match:
+			break
+		value, pos = parse_value(body, match.end(), strings)
+		yield match.group(1).lower(), value
+
+		comma = body.find(',', pos)
+		if comma == -1:
+			break
+		pos = comma + 1
+
+def parse_entry(text, strings):
+	" Parse the text of a single entry into a dict of fields. "
+	match = ENTRY_START.match(text.encode('utf-8'))
+	if not match:
+		raise BibError("Not a BibTeX entry: %r" % (text[:40]))
+	body = text[text.index(match.group(2).decode('ascii')) + 1:-1]
+	key, fields = body.split(',', 1) if ',' in body else (body, '')
+
+	entry = {'type': match.group(1).decode('ascii').lower(), 'key': key.strip()}
+	for name, value in parse_fields(fields, strings):
+		entry[name] = value
+	return entry
+
+def replace_command(match):
+	name = match.group().strip()[1:]
+	if name in KEPT_COMMANDS or (len(name) == 1 and name in '{}&%$#_'):
+		return name
+	return ''
+
+def plain(value):
+	" Reduce a BibTeX field value to plain text. "
+	value = value.replace('\\&', '&').replace('~', ' ').replace('--', '–')
+	value = LATEX_COMMAND.sub(replace_command, value)
+	value = value.replace('{', '').replace('}', '')
+	return ' '.join(value.split())
+
+def split_authors(value):
+	" Split an author field into a list of 'First Last' names. "
+	names = []
+	for name in re.split(r'\s+and\s+', plain(value)):
+		if ',' in name:
+			last, first = name.split(',', 1)
+			name = first.strip() + ' ' + last.strip()
+		names.append(name.strip())
+	return [name for name in names if name]
+
+class BibIndex(object):
+	"""
+	Key index over a .bib file. Entries are parsed on demand from their byte
+	range in the file.
+	"""
+	def __init__(self, path, index_path = None):
+		self.path = path
+		if index_path is None:
+			index_path = path + '.idx'
+		self.index_path = index_path
+		self.parsed = {}
+
+		stat = os.stat(path)
+		self.signature = (stat.st_size, stat.st_mtime_ns)
+		if not self.load_index():
+			self.build_index()
+
+	def load_index(self):
+		try:
+			handle = open(self.index_path, 'r', encoding = 'utf-8')
+		except (IOError, OSError):
+			return False
+
+		with handle:
+			header = handle.readline().rstrip('\n').split('\t')
+			if header != [INDEX_MAGIC, str(INDEX_VERSION)] + [str(item) for item in self.signature]:
+				return False
+
+			self.entries = {}
+			self.strings = {}
+			for line in handle:
+				key, value = line.rstrip('\n').split('\t', 1)
+				if key.startswith('@'):
+					self.strings[key[1:]] = value
+				else:
+					start, end = value.split('\t')
+					self.entries[key] = (int(start), int(end))
+		return True
+
+	def build_index(self):
+		with open(self.path, 'rb') as handle:
+			data = handle.read()
+		self.entries, self.strings = scan(data, self.path)
+
+		lines = ['\t'.join([INDEX_MAGIC, str(INDEX_VERSION)] + [str(item) for item in self.signature])]
+		for name, value in self.strings.items():
+			lines.append('@%s\t%s' % (name, ' '.join(value.split())))
+		for key, (start, end) in self.entries.items():
+			lines.append('%s\t%d\t%d' % (key, start, end))
+
+		# Write atomically; an unwritable directory just means no index reuse.
+		temp_path = '%s.%d.tmp' % (self.index_path, os.getpid())
+		try:
+			with open(temp_path, 'w', encoding = 'utf-8') as handle:
+				handle.write('\n'.join(lines) + '\n')
+			os.replace(temp_path, self.index_path)
+		except (IOError, OSError):
+			pass
+
+	def __contains__(self, key):
+		return key in self.entries
+
+	def __len__(self):
+		return len(self.entries)
+
+	def get(self, key):
+		" Return the parsed entry for 'key', or None if it is not in the index. "
+		if key in self.parsed:
+			return self.parsed[key]
+		if key not in self.entries:
+			return None
+
+		start, end = self.entries[key]
+		with open(self.path, 'rb') as handle:
+			handle.seek(start)
+			text = handle.read(end - start).decode('utf-8', 'replace')
+
+		entry = parse_entry(text, self.strings)
+		self.parsed[key] = entry
+		return entry
+
+def open_index(filename):
+	"""
+	Open the index for a bibliography, given either 'papers' or 'papers.bib'.
+	Returns None if the file does not exist.
+	"""
+	if not filename.endswith('.bib'):
+		filename += '.bib'
+	if not os.path.exists(filename):
+		return None
+	return BibIndex(filename)
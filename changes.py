@@ -0,0 +1,214 @@
+# vim: set fileencoding=utf-8 :
+"""
+Change-tracked output: what changed since an earlier revision of a document.
+
+	texdown2html.py --diff paper-v1.texdown paper.texdown paper.html
+
+Both revisions are split into blocks (headings, list items, paragraphs, runs
+of tab lines for block commands, and !! lines) and the blocks are aligned by
+their text, so a book costs about as much as comparing its blocks' hashes.
+Only blocks which were changed in place are diffed word by word.
+
+Inserted and deleted words are marked in the new revision's source with
+characters from Unicode's private use area, which no rule touches; the
+document is then converted as usual and render() turns the marks into the
+backend's markup (its Macros' diff_markup):
+
+	diff_markup = {'inserted': ('<ins>', '</ins>'), 'deleted': ('<del>', '</del>'),
+			'escape': html.escape}
+
+with, optionally, a 'preamble' to put before \\begin{document} (for the
+LaTeX packages the markup needs). Deleted words aren't left in the source
+for the rules to convert, where a deleted citation would still be numbered
+and listed, or half of some markup pair up with the rest of the line:
+between the marks is only the deleted text's number, and render() puts the
+text back after conversion, as plain text the backend's 'escape' makes safe.
+
+Marks never span lines, and heading and list markup ("==", " *") is left
+outside them so that the rules still see the structure. Blocks of tab lines
+and !! lines are never split up: a new or changed one is followed by
+"!!changed inserted" or "!!changed changed", and a deleted one is replaced
+by "!!changed deleted <command>", which the backends' changed macro shows.
+"""
+
+import difflib
+import re
+
+import texdown
+
+INSERT_START, INSERT_END, DELETE_START, DELETE_END = '\ue000', '\ue001', '\ue002', '\ue003'
+
+# Digits for the numbers of deleted texts, also from the private use area.
+DIGITS = ''.join(chr(0xe010 + digit) for digit in range(10))
+DIGITS_FOR = dict((ord(str(value)), digit) for value, digit in enumerate(DIGITS))
+DIGIT_VALUES = dict((ord(digit), str(value)) for value, digit in enumerate(DIGITS))
+DELETED = re.compile(DELETE_START + '([' + DIGITS + ']+)' + DELETE_END)
+
+HEADING_RULES = ('chapterstar', 'chapter', 'section', 'usenixabstract', 'subsection', 'subsubsection')
+ITEM = re.compile(r'^ +(?:\*|[0-9]+\.)|^ .+?:')
+
+TOKEN = re.compile(r'\s+|\S+')
+
+# Words which are structure rather than text: not marked, and not kept
+# when deleted from a block which is still there.
+MARKUP = re.compile(r'^(?:=+|#+\*?|-+|\^|\*|[0-9]+\.|!!\S*)$')
+
+COMMAND = re.compile(r'!!(\S+)')
+
+ATOMIC = ('tab', 'macro')
+
+class Block(object):
+	def __init__(self, kind, text):
+		self.kind = kind
+		self.text = text
+		self.tail = '' # Blank lines after it
+
+	def key(self):
+		return (self.kind, self.text)
+
+def line_kind(line):
+	if line.startswith('\t'):
+		return 'tab'
+	if line.startswith('!!'):
+		return 'macro'
+	for name in HEADING_RULES:
+		if texdown.CONVERSIONS[name]['match'].match(line):
+			return 'heading'
+	if ITEM.match(line):
+		return 'item'
+	return 'para'
+
+def blocks(text):
+	" (leading blank lines, [Block]) for text. "
+	head = ''
+	result = []
+	for line in text.splitlines(True):
+		if not line.strip():
+			if result:
+				result[-1].tail += line
+			else:
+				head += line
+			continue
+		kind = line_kind(line)
+		if result and kind in ('para', 'tab') and result[-1].kind == kind and not result[-1].tail:
+			result[-1].text += line
+		else:
+			result.append(Block(kind, line))
+	return head, result
+
+def wrap(tokens, start, end, keep_markup = True, keep_newlines = True, stash = None):
+	"""
+	The tokens, with each run of words on a line between start and end.
+	With stash, a list, the runs are added to it, and only their numbers
+	put between the marks.
+	"""
+	out = []
+	run = []
+	trailing = []
+	def flush():
+		while run and not run[-1].strip():
+			trailing.insert(0, run.pop())
+		if run:
+			text = ''.join(run)
+			if stash is not None:
+				stash.append(text)
+				text = str(len(stash) - 1).translate(DIGITS_FOR)
+			out.append(start + text + end)
+		out.extend(trailing)
+		del run[:], trailing[:]
+
+	for token in tokens:
+		if not token.strip():
+			if '\n' in token or not run:
+				flush()
+				out.append(token if keep_newlines else ' ')
+			else:
+				run.append(token)
+		elif MARKUP.match(token):
+			flush()
+			if keep_markup:
+				out.append(token)
+		else:
+			run.append(token)
+	flush()
+	return ''.join(out)
+
+def mark_words(old, new, stash):
+	" new, with the words inserted since old and the words deleted from it (into stash) marked. "
+	old_tokens = TOKEN.findall(old)
+	new_tokens = TOKEN.findall(new)
+	out = []
+	matcher = difflib.SequenceMatcher(None, old_tokens, new_tokens, autojunk = False)
+	for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+		if tag == 'equal':
+			out.extend(new_tokens[j1:j2])
+			continue
+		if i2 > i1:
+			out.append(wrap(old_tokens[i1:i2], DELETE_START, DELETE_END, False, False, stash))
+		if j2 > j1:
+			out.append(wrap(new_tokens[j1:j2], INSERT_START, INSERT_END))
+	return ''.join(out)
+
+def inserted(block):
+	if block.kind in ATOMIC:
+		return block.text + '!!changed inserted\n' + block.tail
+	return wrap(TOKEN.findall(block.text), INSERT_START, INSERT_END) + block.tail
+
+def deleted(block, stash):
+	if block.kind in ATOMIC:
+		command = COMMAND.search(block.text)
+		return '!!changed deleted %s\n' % (command.group(1) if command else '') + block.tail
+	return wrap(TOKEN.findall(block.text), DELETE_START, DELETE_END, stash = stash) + block.tail
+
+def changed(old, new, stash):
+	if new.kind in ATOMIC:
+		return new.text + '!!changed changed\n' + new.tail
+	return mark_words(old.text, new.text, stash) + new.tail
+
+def mark(old_text, new_text):
+	"""
+	(text, deleted): new_text, marked up with the changes since old_text,
+	and the deleted texts, for render().
+	"""
+	stash = []
+	old_head, old_blocks = blocks(old_text)
+	new_head, new_blocks = blocks(new_text)
+	out = [new_head]
+	matcher = difflib.SequenceMatcher(None, [block.key() for block in old_blocks],
+			[block.key() for block in new_blocks], autojunk = False)
+	for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+		if tag == 'equal':
+			for block in new_blocks[j1:j2]:
+				out.append(block.text + block.tail)
+			continue
+		# Replaced blocks are lined up by kind: those paired up were
+		# changed in place, and the rest deleted or inserted.
+		olds = old_blocks[i1:i2]
+		news = new_blocks[j1:j2]
+		kinds = difflib.SequenceMatcher(None, [block.kind for block in olds],
+				[block.kind for block in news], autojunk = False)
+		for kind_tag, k1, k2, l1, l2 in kinds.get_opcodes():
+			if kind_tag == 'equal':
+				for old, new in zip(olds[k1:k2], news[l1:l2]):
+					out.append(changed(old, new, stash))
+				continue
+			for old in olds[k1:k2]:
+				out.append(deleted(old, stash))
+			for new in news[l1:l2]:
+				out.append(inserted(new))
+	return ''.join(out), stash
+
+def render(output, markup, deleted):
+	"""
+	Turn the marks left in the converted output into the backend's
+	diff_markup, putting back the deleted texts mark() returned.
+	"""
+	def deletion(match):
+		text = deleted[int(match.group(1).translate(DIGIT_VALUES))]
+		return markup['deleted'][0] + markup['escape'](text) + markup['deleted'][1]
+	output = DELETED.sub(deletion, output)
+	table = {ord(INSERT_START): markup['inserted'][0], ord(INSERT_END): markup['inserted'][1]}
+	output = output.translate(table)
+	if markup.get('preamble'):
+		output = output.replace('\\begin{document}', markup['preamble'] + '\\begin{document}', 1)
+	return output
@@ -0,0 +1,102 @@
+# vim: set fileencoding=utf-8 :
+"""
+An index of the headings and labels of a whole corpus of documents, for
+references from one document to another.
+
+	texdown2html.py --corpus reports.db --outdir html reports/*.texdown
+
+	The same boilerplate as in [report42:figure.boilerplate] ...
+
+Each document converted with --corpus has its headings (by label, or by
+the ids the HTML backend gives them), its other labels, and the name of
+its output written to the SQLite database, replacing what was there for
+it. A reference [document:label], where document is another document's
+file name without its extension, is then looked up there: the HTML
+backend links to the heading in the other document's output (or to the
+document, for a caption or other label, which have no id to link to), and
+the LaTeX backend to its PDF, both showing the heading or caption text. Output
+names are relative to --outdir (or are the output file's name), so links
+work between documents published side by side.
+
+A document converted before one it refers to won't find its labels: they
+are there from the next conversion on. Since references change with the
+index, the output cache (see outputcache.py) keeps the rows each document's
+references found, and converts it again once they differ.
+"""
+
+import re
+import sqlite3
+
+import outline
+import texdown
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS labels (
+	document TEXT, label TEXT, kind TEXT, title TEXT, anchor TEXT,
+	PRIMARY KEY (document, label)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS outputs (
+	document TEXT, backend TEXT, location TEXT,
+	PRIMARY KEY (document, backend)) WITHOUT ROWID;
+"""
+
+# A label in the output, and the rest of its line (e.g. a caption).
+OUTPUT_LABEL = re.compile(r'\\label\{([^{}]*)\}(.*)$', re.MULTILINE)
+MARKUP = re.compile(r'<[^>]*>|\\[A-Za-z]+\*?|[{}]')
+
+class CorpusError(texdown.ConversionError):
+	pass
+
+def plain_title(title):
+	" A title without citations, which would count as the referring document's. "
+	return ' '.join(texdown.CONVERSIONS['cite']['match'].sub('', title).split())
+
+def targets(source, output):
+	"""
+	(label, kind, title, anchor) for each heading and label in the
+	document. Headings and captions are found in the source; labels which
+	macros make up (e.g. figure.<file>) are taken from the output. Only
+	headings have an anchor: nothing else gets an id in the HTML output.
+	"""
+	found = {}
+	for heading in outline.headings(source):
+		found[heading['id']] = (heading['kind'], plain_title(heading['title']), heading['id'])
+	for match in texdown.CONVERSIONS['caption']['match'].finditer(source):
+		title, label = outline.split_title(match.group(1))
+		if label and label not in found:
+			found[label] = ('caption', plain_title(title), None)
+	for match in OUTPUT_LABEL.finditer(output):
+		label = match.group(1).strip()
+		if label and label not in found:
+			found[label] = ('label', plain_title(MARKUP.sub('', match.group(2))), None)
+	return [(label,) + target for label, target in found.items()]
+
+class Corpus(object):
+	def __init__(self, path):
+		self.path = path
+		try:
+			self.db = sqlite3.connect(path, timeout = 60)
+			self.db.executescript(SCHEMA)
+		except sqlite3.Error as e:
+			raise CorpusError("%s: %s" % (path, e))
+
+	def lookup(self, document, label, backend):
+		"""
+		(title, anchor, location) for the label in document, or None.
+		anchor is None unless it's a heading; location is None if the
+		document wasn't converted by backend, or had no output file.
+		"""
+		row = self.db.execute('SELECT labels.title, labels.anchor, outputs.location FROM labels '
+				'LEFT JOIN outputs ON outputs.document = labels.document AND outputs.backend = ? '
+				'WHERE labels.document = ? AND labels.label = ?', (backend, document, label)).fetchone()
+		return tuple(row) if row is not None else None
+
+	def update(self, document, backend, location, source, output):
+		" Replace what the index holds for document with what's in it now. "
+		rows = [(document,) + target for target in targets(source, output)]
+		with self.db:
+			self.db.execute('DELETE FROM labels WHERE document = ?', (document,))
+			self.db.executemany('INSERT INTO labels VALUES (?, ?, ?, ?, ?)', rows)
+			self.db.execute('INSERT OR REPLACE INTO outputs VALUES (?, ?, ?)', (document, backend, location))
+
+	def close(self):
+		self.db.close()
@@ -0,0 +1,121 @@
+# vim: set fileencoding=utf-8 :
+"""
+The structure of a document as found by the rules, as line-delimited JSON.
+
+	texdown2html.py --export-tree paper.texdown paper.tree
+
+The rules are run over the source by the converter's own walk (see
+Converter.live_rules() and rule_matches()), but without calling the
+macros: text between the matches of a rule goes on to the rules after
+it, and the text of each match to its "incl" rules. Every match becomes a
+node. The tree is written one node per line, in document order, after a
+header which holds the source and names the fields of a node:
+
+	{"format": "texdown-tree", "version": 1, "fields": [...], "source": "== Intro <<sec.intro>> ==\n * One[[Knuth84]]\n..."}
+	[null,"section",0,25,[3,23],0]
+	[0,"label",9,22,[11,20],0]
+	[null,"bullets",26,44,[26,27,28,43],0]
+	[2,"cite",32,43,[34,41],0]
+	[null,"bullets",44,51,[44,45,46,50],1]
+
+That is: the parent node's number (its line, counting nodes from 0), the
+rule, the start and end of the match as character offsets into the source,
+the start and end of each of the rule's groups (-1, -1 if it didn't take
+part), and 1 if the match follows on directly from the one before it
+(another item of the same list, another line of the same tab block), so
+that tools can put lists and tables back together. load() turns the nodes
+back into dicts, with each group's text.
+
+The tree is for tools (outlines, linters, editors); it isn't an input
+format. In a conversion, "incl" rules run on what a macro made of the
+match rather than on the match itself, so the nodes can't be rendered.
+"""
+
+import bisect
+import json
+
+import texdown
+
+TREE_FORMAT = 'texdown-tree'
+TREE_VERSION = 1
+
+class TreeError(texdown.ConversionError):
+	pass
+
+FIELDS = ['parent', 'rule', 'start', 'end', 'groups', 'continues']
+
+def parse(text):
+	" The nodes of a document, as lists of FIELDS. "
+	converter = texdown.Converter([])
+	nodes = []
+
+	def walk(piece, base, match_names, parent):
+		# As Converter.do_convert(), with a node for each match where its
+		# macro's output would go.
+		match_names = converter.live_rules(piece, match_names)
+		if not match_names:
+			return
+
+		name = match_names[0]
+		children = match_names[1:]
+		conv = texdown.CONVERSIONS[name]
+		prev_end = 0
+		for match, open_start, open_end in converter.rule_matches(piece, conv):
+			if match.start() > prev_end:
+				walk(piece[prev_end:match.start()], base + prev_end, children, parent)
+			groups = []
+			for idx in range(1, (match.re.groups) + 1):
+				start, end = match.span(idx)
+				groups.extend((base + start, base + end) if start != -1 else (-1, -1))
+			nodes.append([parent, name, base + match.start(), base + match.end(), groups, 0 if open_start else 1])
+			if 'incl' in conv:
+				walk(match.group(), base + match.start(), conv['incl'], len(nodes) - 1)
+			prev_end = match.end()
+		if prev_end < len(piece):
+			walk(piece[prev_end:], base + prev_end, children, parent)
+
+	walk(text, 0, texdown.CONVERSIONS_ORDER, None)
+	return nodes
+
+def export(text):
+	" The tree of a document, as a list of lines. "
+	lines = [json.dumps({'format': TREE_FORMAT, 'version': TREE_VERSION, 'fields': FIELDS,
+			'source': text}, ensure_ascii = False) + '\n']
+	for node in parse(text):
+		lines.append(json.dumps(node, ensure_ascii = False, separators = (',', ':')) + '\n')
+	return lines
+
+def load(lines):
+	"""
+	Read a tree written by export(). Returns (source, [nodes]), each node a
+	dict of FIELDS plus 'id' (its number) and 'line' (counted from 1), with
+	the text of each group (or None) in 'groups'.
+	"""
+	lines = iter(lines)
+	try:
+		header = json.loads(next(lines))
+	except (StopIteration, ValueError):
+		raise TreeError("not a texdown tree")
+	if not isinstance(header, dict) or header.get('format') != TREE_FORMAT:
+		raise TreeError("not a texdown tree")
+	if header.get('version') != TREE_VERSION:
+		raise TreeError("texdown tree version %s, expected %s" % (header.get('version'), TREE_VERSION))
+	source = header.get('source')
+	if not isinstance(source, str):
+		raise TreeError("texdown tree has no source")
+
+	newlines = [match.start() for match in texdown.NEWLINE.finditer(source)]
+	nodes = []
+	for number, line in enumerate(lines):
+		if not line.strip():
+			continue
+		try:
+			parent, rule, start, end, groups, continues = json.loads(line)
+			nodes.append({'id': len(nodes), 'parent': parent, 'rule': rule,
+					'start': start, 'end': end, 'line': bisect.bisect_left(newlines, start) + 1,
+					'groups': [source[groups[idx]:groups[idx + 1]] if groups[idx] != -1 else None
+						for idx in range(0, len(groups), 2)],
+					'continues': bool(continues)})
+		except (ValueError, TypeError, IndexError):
+			raise TreeError("texdown tree line %d is not a node" % (number + 2))
+	return source, nodes
@@ -0,0 +1,198 @@
+# vim: set fileencoding=utf-8 :
+"""
+Split converted HTML into one page per chapter (or per section).
+
+	texdown2html.py --split chapter manual.texdown outdir
+
+The document is converted once, as usual, and the output is cut at the
+headings: <h1 id=...> for chapters, and also <h2 id=...> for sections.
+Everything before the first of them (the title, authors and so on) goes on
+index.html, followed by a contents list of the pages. Each page gets
+previous / next / up links, and links to ids which ended up on another page
+("#cite.Knuth84", "#sec.intro") are rewritten to point at that page. The
+pages are put together and written by a pool of threads, along with any
+sidecar files (search.json and so on); "#id" strings in JSON sidecars are
+rewritten like links.
+"""
+
+import html
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+LEVELS = {'chapter': '1', 'section': '12'}
+
+# Used when the document has no <body> of its own, e.g. no !!techreport.
+PAGE_HEAD = """<html>
+<head>
+<meta charset="utf-8">
+<title></title>
+</head>
+<body>
+"""
+PAGE_TAIL = """
+</body>
+</html>
+"""
+
+SCRIPTS = '<!-- scripts -->'
+
+NAV = """<nav class="pages">%s</nav>
+"""
+
+ID = re.compile(r'\sid="([^"]*)"')
+HREF = re.compile(r'href="#([^"]*)"')
+JSON_HREF = re.compile(r'"#([^"]*)"')
+TITLE = re.compile(r'<title>(.*?)</title>', re.DOTALL)
+TAG = re.compile(r'<[^>]*>')
+UNSAFE_FILENAME = re.compile(r'[^\w.-]+')
+
+class Page(object):
+	def __init__(self, filename, title, level, body):
+		self.filename = filename
+		self.title = title # HTML
+		self.level = level
+		self.body = body
+		self.prev = self.next = self.up = None
+
+def heading_pattern(level):
+	return re.compile(r'<h([%s]) id="([^"]*)">(.*?)</h\1>' % (LEVELS[level]))
+
+def page_filename(anchor, used):
+	filename = UNSAFE_FILENAME.sub('-', anchor).strip('-.') or 'page'
+	candidate = filename
+	count = 1
+	while candidate + '.html' in used:
+		count += 1
+		candidate = '%s-%d' % (filename, count)
+	used.add(candidate + '.html')
+	return candidate + '.html'
+
+def split_wrapper(output):
+	"""
+	Split output into (head, body, tail), around its <body> if it has one.
+	Scripts at the end of the body belong in the tail, so every page has them.
+	"""
+	start = output.find('<body>')
+	end = output.rfind(SCRIPTS)
+	if end == -1:
+		end = output.rfind('</body>')
+	if start == -1 or end == -1:
+		return PAGE_HEAD, output, PAGE_TAIL
+	start += len('<body>\n')
+	return output[:start], output[start:end], output[end:]
+
+def split_pages(output, level = 'chapter'):
+	"""
+	Cut the output into pages. Returns (head, tail, index page, [pages]);
+	the index page holds everything before the first heading.
+	"""
+	head, body, tail = split_wrapper(output)
+
+	used = set(['index.html'])
+	index = Page('index.html', None, 0, '')
+	pages = []
+	start = 0
+	for match in heading_pattern(level).finditer(body):
+		if pages:
+			pages[-1].body = body[start:match.start()]
+		else:
+			index.body = body[:match.start()]
+		pages.append(Page(page_filename(match.group(2), used), match.group(3),
+				int(match.group(1)), None))
+		start = match.start()
+	if pages:
+		pages[-1].body = body[start:]
+	else:
+		index.body = body
+
+	parents = [index]
+	for idx, page in enumerate(pages):
+		page.prev = pages[idx - 1] if idx else index
+		page.next = pages[idx + 1] if idx + 1 < len(pages) else None
+		while parents[-1].level >= page.level:
+			parents.pop()
+		page.up = parents[-1]
+		parents.append(page)
+	index.next = pages[0] if pages else None
+
+	return head, tail, index, pages
+
+def contents(index, pages):
+	" The nested list of pages for index.html. "
+	children = {}
+	for page in pages:
+		children.setdefault(page.up, []).append(page)
+
+	def page_list(parent):
+		if parent not in children:
+			return ''
+		items = ['<li><a href="%s">%s</a>%s</li>\n' \
+				% (html.escape(page.filename), page.title, page_list(page))
+				for page in children[parent]]
+		return '\n<ul>\n%s</ul>' % (''.join(items))
+
+	return '<nav class="contents">%s\n</nav>\n' % (page_list(index))
+
+def navigation(page):
+	links = []
+	for rel, label, target in (('prev', 'Previous', page.prev), ('up', 'Up', page.up),
+			('next', 'Next', page.next)):
+		if target is not None:
+			title = TAG.sub('', target.title) if target.title else 'Contents'
+			links.append('<a rel="%s" href="%s">%s: %s</a>' \
+					% (rel, html.escape(target.filename), label, title))
+	return NAV % (' | '.join(links))
+
+def rewrite_links(text, page, id_pages, pattern = HREF, link = 'href="%s#%s"'):
+	" Point links to ids on other pages at those pages. "
+	def replace(match):
+		target = id_pages.get(match.group(1))
+		if target is None or target is page:
+			return match.group()
+		return link % (html.escape(target.filename), match.group(1))
+	return pattern.sub(replace, text)
+
+def render_page(page, head, tail, id_pages, extra = ''):
+	if page.title:
+		title = TAG.sub('', page.title)
+		head = TITLE.sub(lambda match: '<title>%s%s</title>' \
+				% (match.group(1) + ' - ' if match.group(1) else '', title), head, 1)
+	body = rewrite_links(page.body + extra, page, id_pages)
+	return head + navigation(page) + body + navigation(page) + tail
+
+def write_pages(output, outdir, level = 'chapter', sidecars = None, jobs = None):
+	" Split output into pages in outdir. Returns the list of filenames. "
+	head, tail, index, pages = split_pages(output, level)
+	sidecars = sidecars or {}
+
+	id_pages = {}
+	for page in [index] + pages:
+		for anchor in ID.findall(page.body):
+			id_pages.setdefault(anchor, page)
+
+	if not os.path.isdir(outdir):
+		os.makedirs(outdir)
+
+	def write(page):
+		extra = contents(index, pages) if page is index else ''
+		text = render_page(page, head, tail, id_pages, extra)
+		with open(os.path.join(outdir, page.filename), 'w', encoding = 'utf-8') as handle:
+			handle.write(text)
+		return page.filename
+
+	def write_sidecar(filename):
+		text = sidecars[filename]
+		if filename.endswith('.json'):
+			# A bare "#" is the top of the document, now index.html.
+			text = rewrite_links(text, None, dict(id_pages, **{'': index}), JSON_HREF, '"%s#%s"')
+		path = os.path.join(outdir, filename)
+		if not os.path.isdir(os.path.dirname(path)):
+			os.makedirs(os.path.dirname(path))
+		with open(path, 'w', encoding = 'utf-8') as handle:
+			handle.write(text)
+
+	with ThreadPoolExecutor(max_workers = jobs) as executor:
+		filenames = list(executor.map(write, [index] + pages))
+		list(executor.map(write_sidecar, sidecars))
+	return filenames
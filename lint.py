@@ -0,0 +1,174 @@
+# vim: set fileencoding=utf-8 :
+"""
+Structural checks for Texdown documents, without converting them.
+
+One pass over the lines finds the problems that would otherwise only turn
+up one at a time as ConversionErrors (or as odd output):
+
+	* !!macro lines and tab blocks naming macros that don't exist
+	* tab blocks whose first line has no \t!!macroname
+	* inline markup left open: [[ ]], << >>, (( )) and '' ''
+	* floats without a caption
+	* author lines in paper headers with missing or unknown fields
+
+An odd number of ", $ or * is only a warning: like any unmatched markup the
+engine leaves them as plain text, and they often are ("costs $5", "2 * 3").
+Warnings don't count towards the exit status of --check.
+"""
+
+import re
+
+# Macros which produce floats, and so should have a caption.
+CAPTIONED_BLOCK_MACROS = ('floatcode', 'exactfloatcode', 'floattable')
+CAPTIONED_LINE_MACROS = ('floatgraphic', 'floatgraphic_wholepage')
+
+# Block macros whose lines are parsed by anypaper().
+PAPER_MACROS = ('sigplanpaper', 'techreport', 'acceptancetestingreport', 'nictatr')
+
+# Inline markup which must open and close on the same line...
+LINE_PAIRS = (("''", "''"), ('((', '))'))
+# ... and markup which may run over several lines of a paragraph.
+PARAGRAPH_PAIRS = (('[[', ']]'), ('<<', '>>'))
+# The same, for characters which are often meant literally: only warn.
+LINE_WARNING_PAIRS = (('"', '"'), ('$', '$'))
+PARAGRAPH_WARNING_PAIRS = (('*', '*'),)
+
+BULLET = re.compile(r' +\*')
+TABS = re.compile(r'\t+')
+
+def unbalanced(text, opener, closer):
+	" Return a description of the problem if opener/closer don't pair up. "
+	if opener == closer:
+		count = text.count(opener)
+		if count % 2:
+			return "unmatched %s" % (opener)
+	else:
+		opened, closed = text.count(opener), text.count(closer)
+		if opened != closed:
+			return "unbalanced %s %s (%d opened, %d closed)" % (opener, closer, opened, closed)
+	return None
+
+class Linter(object):
+	def __init__(self, macros, affiliations = None):
+		self.macros = macros
+		self.affiliations = affiliations or {}
+
+	def check(self, text):
+		"""
+		Return a list of (line number, message), in line order. Warnings are
+		left in self.warnings, in the same form.
+		"""
+		self.problems = []
+		self.warnings = []
+		block = None # (first line number, macro name, [(line number, text)])
+		paragraph = [] # (line number, text)
+
+		for lineno, line in enumerate(text.split('\n'), 1):
+			if line.startswith('\t'):
+				if block is None:
+					block = self.start_block(lineno, line[1:])
+				else:
+					block[2].append((lineno, line[1:]))
+				continue
+
+			if block is not None:
+				self.end_block(*block)
+				block = None
+
+			if not line.strip() or line.startswith('%'):
+				self.end_paragraph(paragraph)
+				paragraph = []
+				continue
+
+			if line.startswith('!!'):
+				self.check_line_macro(lineno, line[2:])
+				continue
+
+			match = BULLET.match(line)
+			if match:
+				line = line[match.end():]
+			self.check_pairs(self.problems, lineno, line, LINE_PAIRS)
+			self.check_pairs(self.warnings, lineno, line, LINE_WARNING_PAIRS)
+			paragraph.append((lineno, line))
+
+		if block is not None:
+			self.end_block(*block)
+		self.end_paragraph(paragraph)
+
+		self.problems.sort(key = lambda problem: problem[0])
+		self.warnings.sort(key = lambda problem: problem[0])
+		return self.problems
+
+	def check_pairs(self, problems, lineno, text, pairs):
+		for opener, closer in pairs:
+			problem = unbalanced(text, opener, closer)
+			if problem:
+				problems.append((lineno, problem))
+
+	def start_block(self, lineno, line):
+		if '\t!!' not in line:
+			self.problems.append((lineno, "tab block has no block command (\\t!!macroname)"))
+			return (lineno, None, [(lineno, line)])
+
+		line, name = line.rsplit('\t!!', 1)
+		if name not in self.macros:
+			self.problems.append((lineno, "unknown block macro '%s'" % (name)))
+		return (lineno, name, [(lineno, line)] if line.strip() else [])
+
+	def end_block(self, lineno, name, lines):
+		if name in CAPTIONED_BLOCK_MACROS and not (lines and lines[-1][1].startswith('~~')):
+			self.problems.append((lineno, "%s has no caption (~~ ... ~~ line)" % (name)))
+		if name in PAPER_MACROS:
+			for author_lineno, line in lines:
+				self.check_author(author_lineno, line)
+
+	def check_author(self, lineno, line):
+		fields = TABS.split(line)
+		if fields[0] != 'author':
+			return
+		if len(fields) < 2 or not fields[1].strip():
+			self.problems.append((lineno, "author line has no name"))
+		elif len(fields) > 4:
+			self.problems.append((lineno, "author line has %d fields (name, email, affiliation)" \
+					% (len(fields) - 1)))
+		elif len(fields) == 4:
+			affiliation = fields[3]
+			if affiliation.startswith('"'):
+				if len(affiliation) < 2 or not affiliation.endswith('"'):
+					self.problems.append((lineno, "unterminated affiliation %s" % (affiliation)))
+			elif affiliation not in self.affiliations:
+				self.problems.append((lineno, "unknown affiliation '%s'" % (affiliation)))
+
+	def check_line_macro(self, lineno, line):
+		if ' ' in line:
+			name, args = line.split(' ', 1)
+		else:
+			name, args = line, ''
+		if name not in self.macros:
+			self.problems.append((lineno, "unknown macro '%s'" % (name)))
+		elif name in CAPTIONED_LINE_MACROS and ',' not in args:
+			self.problems.append((lineno, "%s has no caption (!!%s filename, Caption)" % (name, name)))
+
+	def end_paragraph(self, paragraph):
+		if not paragraph:
+			return
+		text = '\n'.join(line for lineno, line in paragraph)
+		self.check_pairs(self.problems, paragraph[0][0], text, PARAGRAPH_PAIRS)
+		self.check_pairs(self.warnings, paragraph[0][0], text, PARAGRAPH_WARNING_PAIRS)
+
+def check_files(filenames, macros, affiliations = None):
+	"""
+	Check each file and print problems as "filename:line: message". Returns
+	the number of problems found, not counting warnings.
+	"""
+	linter = Linter(macros, affiliations)
+	count = 0
+	for filename in filenames:
+		with open(filename, 'r', encoding = 'utf-8') as handle:
+			text = handle.read()
+		problems = linter.check(text)
+		count += len(problems)
+		warnings = [(lineno, 'warning: ' + message) for lineno, message in linter.warnings]
+		for lineno, message in sorted(problems + warnings, key = lambda problem: problem[0]):
+			print("%s:%d: %s" % (filename, lineno, message))
+	return count
@@ -0,0 +1,148 @@
+# vim: set fileencoding=utf-8 :
+"""
+Code listings taken from files, a range of lines at a time.
+
+	!!listing src/parse.py, 120-240, <<code.parse>> Parsing the header
+
+The range may be N-M, N- (to the end), -M, N (one line) or left out (the
+whole file); lines count from 1, and the caption is optional. The file is
+memory-mapped, and the offsets where its lines start are indexed only as
+far as a range needs, so listing a few lines from the top of a big
+generated dump reads just those. Open files are kept, with their indexes,
+until they change on disk, so a file listed many times in a document is
+opened and scanned for newlines once. The output cache keeps a hash of the
+lines each listing showed, and converts the document again once they differ.
+"""
+
+import array
+import collections
+import hashlib
+import mmap
+import os
+import re
+import threading
+
+import texdown
+
+RANGE = re.compile(r'^\s*([0-9]*)\s*(-?)\s*([0-9]*)\s*$')
+NEWLINE = re.compile(b'\n')
+
+# Bytes scanned for newlines at a time, while indexing a file.
+SCAN_BYTES = 1 << 20
+
+# Files kept open, least recently listed first out.
+OPEN_FILES = 32
+
+class ListingError(texdown.ConversionError):
+	pass
+
+class ListingFile(object):
+	" A file mapped into memory, with the offsets of the lines seen so far. "
+	def __init__(self, path):
+		self.path = path
+		with open(path, 'rb') as handle:
+			stat = os.fstat(handle.fileno())
+			self.stamp = (stat.st_mtime_ns, stat.st_size)
+			# mmap can't map an empty file.
+			self.data = mmap.mmap(handle.fileno(), 0, access = mmap.ACCESS_READ) if stat.st_size else b''
+		self.starts = array.array('Q', [0])
+		self.scanned = 0
+		self.lock = threading.Lock()
+
+	def index(self, count):
+		"""
+		Find the starts of lines until line count + 1 starts, or the end of
+		the file. The file's length is added as the start of the line after
+		the last, so line n is always data[starts[n - 1]:starts[n]].
+		"""
+		size = len(self.data)
+		while len(self.starts) <= count and self.scanned < size:
+			end = min(self.scanned + SCAN_BYTES, size)
+			self.starts.extend(match.end() for match in NEWLINE.finditer(self.data, self.scanned, end))
+			self.scanned = end
+			if end == size and self.starts[-1] != size:
+				self.starts.append(size)
+
+	def lines(self, first, last = None):
+		" The text of lines first to last (or the end), without the final newline. "
+		with self.lock:
+			self.index(last if last is not None else len(self.data) + 1)
+			count = len(self.starts) - 1
+		if last is None:
+			if first == 1 and not count:
+				return ''
+			if first < 1 or first > count:
+				raise ListingError("%s: no lines %d-, it has %d" % (self.path, first, count))
+			last = count
+		if first < 1 or last < first or last > count:
+			raise ListingError("%s: no lines %d-%d, it has %d" % (self.path, first, last, count))
+		text = self.data[self.starts[first - 1]:self.starts[last]]
+		try:
+			text = text.decode('utf-8')
+		except UnicodeDecodeError as e:
+			raise ListingError("%s: not UTF-8: %s" % (self.path, e))
+		return text[:-1] if text.endswith('\n') else text
+
+# Open files by absolute path, see listing_file().
+FILES = collections.OrderedDict()
+FILES_LOCK = threading.Lock()
+
+def listing_file(path):
+	" The ListingFile for path, opened again if the file has changed. "
+	path = os.path.abspath(path)
+	try:
+		stat = os.stat(path)
+		with FILES_LOCK:
+			listing = FILES.get(path)
+			if listing is None or listing.stamp != (stat.st_mtime_ns, stat.st_size):
+				listing = FILES[path] = ListingFile(path)
+				if len(FILES) > OPEN_FILES:
+					FILES.popitem(last = False)
+			FILES.move_to_end(path)
+	except (IOError, OSError) as e:
+		raise ListingError("can't read listing: %s" % (e))
+	return listing
+
+def parse(args):
+	" (path, first line, last line or None, caption or None) from the macro's arguments. "
+	path, _, rest = (args or '').partition(',')
+	first, last = 1, None
+	head, _, tail = rest.partition(',')
+	match = RANGE.match(head)
+	if match and (match.group(1) or match.group(3)):
+		start, dash, end = match.groups()
+		first = int(start) if start else 1
+		last = int(end) if end else (None if dash else first)
+		rest = tail
+	if not path.strip():
+		raise ListingError("listing without a file name")
+	return path.strip(), first, last, rest.strip() or None
+
+def text_digest(text):
+	return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def digest(path, first, last):
+	" A hash of lines first to last (or the end) of the file, or None if they can't be read. "
+	try:
+		return text_digest(listing_file(path).lines(first, last))
+	except ListingError:
+		return None
+
+def read(converter, args):
+	"""
+	(text, caption) for the listing macro's arguments. The lines read are
+	noted as an input of the document (see Converter.note_input()).
+	"""
+	path, first, last, caption = parse(args)
+	text = listing_file(path).lines(first, last)
+	converter.note_input('listing', (path, first, last), text_digest(text))
+	return text, caption
+
+def figure(converter, args):
+	" The listing macro's output, the same for every backend: the lines in a figure. "
+	code, caption = read(converter, args)
+	result = ['\\begin{figure}[htb]', '\\begin{verbatim}', code.replace('\t', '  '), '\\end{verbatim}']
+	if caption:
+		result.append(converter.do_convert('~~ %s ~~' % (caption), ['caption']))
+	result.append('\\end{figure}')
+	return '\n'.join(result)
@@ -0,0 +1,142 @@
+# vim: set fileencoding=utf-8 :
+"""
+An on-disk cache of the output of pure macros (see texdown.pure).
+
+Slow macros, such as ones which run a plotting script, are run again by
+every conversion. Marked pure, their output is kept in the cache directory
+(--macro-cache, default .texdown-cache) and reused while the macro's name,
+arguments (or block lines), version and defining file are the same. Each
+result is one file, named by a hash of those; the least recently used
+results are deleted once the cache is bigger than --macro-cache-size MB.
+The most recently used results are also kept in memory, for pure macros
+called over and over with the same arguments (such as the HTML backend's
+math).
+"""
+
+import collections
+import functools
+import hashlib
+import inspect
+import json
+import os
+import re
+import socket
+
+CACHE_VERSION = 1
+
+ENTRY_NAME = re.compile(r'^[0-9a-f]{64}\.out$')
+
+MEMORY_ENTRIES = 4096
+
+class MacroCache(object):
+	def __init__(self, directory, max_bytes):
+		self.directory = directory
+		self.max_bytes = max_bytes
+		self.total = None # Bytes in the cache, once known
+		self.hits = self.misses = 0
+		self.memory = collections.OrderedDict() # path -> output
+
+	def entries(self):
+		" [(mtime, size, path)] of the results in the cache. "
+		try:
+			names = os.listdir(self.directory)
+		except OSError:
+			return []
+		entries = []
+		for name in names:
+			if ENTRY_NAME.match(name):
+				path = os.path.join(self.directory, name)
+				try:
+					stat = os.stat(path)
+				except OSError:
+					continue # Evicted by someone else
+				entries.append((stat.st_mtime, stat.st_size, path))
+		return entries
+
+	def path(self, name, version, source, args):
+		key = json.dumps([CACHE_VERSION, name, version, source, args])
+		return os.path.join(self.directory, hashlib.sha256(key.encode('utf-8')).hexdigest() + '.out')
+
+	def get(self, path):
+		try:
+			output = self.memory[path]
+		except KeyError:
+			pass
+		else:
+			self.memory.move_to_end(path)
+			return output
+		try:
+			with open(path, 'r', encoding = 'utf-8', newline = '') as handle:
+				output = handle.read()
+		except (IOError, OSError):
+			return None
+		try:
+			os.utime(path, None) # Recently used
+		except OSError:
+			pass
+		self.remember(path, output)
+		return output
+
+	def remember(self, path, output):
+		self.memory[path] = output
+		if len(self.memory) > MEMORY_ENTRIES:
+			self.memory.popitem(last = False)
+
+	def put(self, path, output):
+		if not os.path.isdir(self.directory):
+			os.makedirs(self.directory)
+		if self.total is None:
+			self.total = sum(size for mtime, size, entry in self.entries())
+		# Named for this process on this machine, as the cache may be shared.
+		temp = '%s.%s.%d.tmp' % (path, socket.gethostname(), os.getpid())
+		with open(temp, 'w', encoding = 'utf-8', newline = '') as handle:
+			handle.write(output)
+		os.replace(temp, path)
+		self.remember(path, output)
+		self.total += os.path.getsize(path)
+		if self.total > self.max_bytes:
+			self.evict()
+
+	def evict(self):
+		" Delete the least recently used results until the cache fits. "
+		entries = sorted(self.entries())
+		self.total = sum(size for mtime, size, path in entries)
+		for mtime, size, path in entries:
+			if self.total <= self.max_bytes:
+				break
+			try:
+				os.remove(path)
+			except OSError:
+				pass
+			self.total -= size
+
+	def clear(self):
+		for mtime, size, path in self.entries():
+			os.remove(path)
+		self.total = 0
+		self.memory.clear()
+
+	def wrap(self, name, handler):
+		" A caching version of the line or block macro handler. "
+		version = handler.pure
+		owner = getattr(handler, '__self__', handler)
+		if not inspect.isclass(owner) and not inspect.isfunction(owner):
+			owner = type(owner)
+		try:
+			source = os.path.abspath(inspect.getfile(owner))
+		except TypeError:
+			source = owner.__module__
+
+		def cached(args):
+			path = self.path(name, version, source, args)
+			output = self.get(path)
+			if output is not None:
+				self.hits += 1
+				return output
+			self.misses += 1
+			output = handler(args)
+			if isinstance(output, str):
+				self.put(path, output)
+			return output
+		functools.update_wrapper(cached, handler) # Keeps e.g. concurrent_safe
+		return cached
@@ -0,0 +1,256 @@
+# vim: set fileencoding=utf-8 :
+"""
+TeX math to MathML, for the HTML backend.
+
+	render(r'\frac{a^2}{\sqrt{b}} \leq \alpha_1')
+
+Handles the usual inline math: letters, numbers and operators, ^ and _,
+{groups}, \frac, \sqrt (with [n]), \left ... \right, Greek letters, common
+symbols and relations, named functions (\sin, \log, ...), \mathrm, \mathbf
+and the like, \text and spacing commands. Anything else (environments,
+unknown commands, unbalanced braces) raises Unsupported, and render() then
+returns the TeX as it was, for the reader (or MathJax) to make sense of.
+
+Results are cached by the HTML backend as pure macro output (see
+macrocache.py); VERSION is part of the key, so change it along with the
+output.
+"""
+
+import html
+import re
+
+VERSION = '1'
+
+class Unsupported(Exception):
+	pass
+
+TOKEN = re.compile(r'\\([A-Za-z]+|.)|([0-9]+(?:\.[0-9]+)?)|(\s+)|(.)', re.DOTALL)
+
+GREEK = dict((name, chr(code)) for name, code in (
+	('alpha', 0x3b1), ('beta', 0x3b2), ('gamma', 0x3b3), ('delta', 0x3b4),
+	('epsilon', 0x3f5), ('varepsilon', 0x3b5), ('zeta', 0x3b6), ('eta', 0x3b7),
+	('theta', 0x3b8), ('vartheta', 0x3d1), ('iota', 0x3b9), ('kappa', 0x3ba),
+	('lambda', 0x3bb), ('mu', 0x3bc), ('nu', 0x3bd), ('xi', 0x3be), ('pi', 0x3c0),
+	('varpi', 0x3d6), ('rho', 0x3c1), ('varrho', 0x3f1), ('sigma', 0x3c3),
+	('varsigma', 0x3c2), ('tau', 0x3c4), ('upsilon', 0x3c5), ('phi', 0x3d5),
+	('varphi', 0x3c6), ('chi', 0x3c7), ('psi', 0x3c8), ('omega', 0x3c9),
+	('Gamma', 0x393), ('Delta', 0x394), ('Theta', 0x398), ('Lambda', 0x39b),
+	('Xi', 0x39e), ('Pi', 0x3a0), ('Sigma', 0x3a3), ('Upsilon', 0x3a5),
+	('Phi', 0x3a6), ('Psi', 0x3a8), ('Omega', 0x3a9),
+))
+
+IDENTIFIERS = dict(GREEK, infty='\u221e', partial='\u2202', nabla='\u2207',
+		emptyset='\u2205', ell='\u2113', hbar='\u210f', Re='\u211c', Im='\u2111',
+		aleph='\u2135')
+
+OPERATORS = {
+	'times': '\u00d7', 'cdot': '\u22c5', 'pm': '\u00b1', 'mp': '\u2213', 'div': '\u00f7',
+	'leq': '\u2264', 'le': '\u2264', 'geq': '\u2265', 'ge': '\u2265', 'neq': '\u2260',
+	'ne': '\u2260', 'approx': '\u2248', 'equiv': '\u2261', 'sim': '\u223c', 'simeq': '\u2243',
+	'propto': '\u221d', 'll': '\u226a', 'gg': '\u226b', 'in': '\u2208', 'notin': '\u2209',
+	'ni': '\u220b', 'subset': '\u2282', 'subseteq': '\u2286', 'supset': '\u2283',
+	'supseteq': '\u2287', 'cup': '\u222a', 'cap': '\u2229', 'setminus': '\u2216',
+	'wedge': '\u2227', 'land': '\u2227', 'vee': '\u2228', 'lor': '\u2228', 'neg': '\u00ac',
+	'lnot': '\u00ac', 'forall': '\u2200', 'exists': '\u2203', 'to': '\u2192',
+	'rightarrow': '\u2192', 'leftarrow': '\u2190', 'gets': '\u2190',
+	'leftrightarrow': '\u2194', 'Rightarrow': '\u21d2', 'Leftarrow': '\u21d0',
+	'Leftrightarrow': '\u21d4', 'iff': '\u21d4', 'implies': '\u21d2', 'mapsto': '\u21a6',
+	'ldots': '\u2026', 'cdots': '\u22ef', 'dots': '\u2026', 'vdots': '\u22ee',
+	'sum': '\u2211', 'prod': '\u220f', 'coprod': '\u2210', 'int': '\u222b', 'oint': '\u222e',
+	'bigcup': '\u22c3', 'bigcap': '\u22c2', 'circ': '\u2218', 'ast': '\u2217', 'star': '\u22c6',
+	'bullet': '\u2219', 'oplus': '\u2295', 'otimes': '\u2297', 'mid': '\u2223',
+	'parallel': '\u2225', 'perp': '\u22a5', 'vdash': '\u22a2', 'models': '\u22a8',
+	'langle': '\u27e8', 'rangle': '\u27e9', 'lfloor': '\u230a', 'rfloor': '\u230b',
+	'lceil': '\u2308', 'rceil': '\u2309', '{': '{', '}': '}', '|': '\u2016', '%': '%',
+	'#': '#', '&': '&', '$': '$', '_': '_',
+}
+
+FUNCTIONS = set(('log', 'ln', 'lg', 'exp', 'sin', 'cos', 'tan', 'sec', 'csc', 'cot',
+		'arcsin', 'arccos', 'arctan', 'sinh', 'cosh', 'tanh', 'lim', 'max', 'min', 'sup',
+		'inf', 'det', 'gcd', 'deg', 'dim', 'ker', 'hom', 'Pr', 'arg', 'mod', 'limsup', 'liminf'))
+
+# \mathxx{...}: mathvariant
+FONTS = {'mathrm': 'normal', 'mathbf': 'bold', 'mathit': 'italic', 'mathsf': 'sans-serif',
+		'mathtt': 'monospace', 'mathbb': 'double-struck', 'mathcal': 'script',
+		'mathfrak': 'fraktur', 'operatorname': 'normal'}
+
+TEXT = ('text', 'textrm', 'mbox', 'textit', 'textbf')
+
+SPACES = {',': '0.167em', ':': '0.222em', ';': '0.278em', ' ': '0.25em', 'quad': '1em',
+		'qquad': '2em', '!': None}
+
+OPERATOR_CHARS = '+-=<>()[]|/,.;:!?*\''
+
+def element(tag, content, **attributes):
+	attrs = ''.join(' %s="%s"' % (name, html.escape(value)) for name, value in sorted(attributes.items()))
+	return '<%s%s>%s</%s>' % (tag, attrs, content, tag)
+
+class Parser(object):
+	def __init__(self, tex):
+		self.tex = tex
+		self.tokens = []
+		for match in TOKEN.finditer(tex):
+			if match.group(3) is None:
+				self.tokens.append(match)
+		self.pos = 0
+
+	def peek(self):
+		if self.pos < len(self.tokens):
+			return self.tokens[self.pos]
+		return None
+
+	def take(self):
+		token = self.peek()
+		if token is None:
+			raise Unsupported("unexpected end")
+		self.pos += 1
+		return token
+
+	def raw_group(self):
+		" The text of a {group}, unparsed (for \\text). "
+		token = self.take()
+		if token.group(4) != '{':
+			raise Unsupported("expected {")
+		depth = 1
+		start = token.end()
+		for idx in range(token.end(), len(self.tex)):
+			char = self.tex[idx]
+			if char == '{':
+				depth += 1
+			elif char == '}':
+				depth -= 1
+				if depth == 0:
+					while self.peek() is not None and self.peek().start() <= idx:
+						self.pos += 1
+					return self.tex[start:idx]
+		raise Unsupported("unbalanced {")
+
+	def row(self, stop = None):
+		" Terms up to stop (a character, or the end). "
+		items = []
+		while True:
+			token = self.peek()
+			if token is None:
+				if stop is not None:
+					raise Unsupported("missing %s" % (stop))
+				break
+			if stop is not None and token.group(4) == stop:
+				self.pos += 1
+				break
+			if token.group(1) == 'right':
+				if stop != 'right':
+					raise Unsupported("\\right without \\left")
+				break
+			items.append(self.term())
+		if len(items) == 1:
+			return items[0]
+		return element('mrow', ''.join(items))
+
+	def term(self):
+		base = self.atom()
+		sub = sup = None
+		while True:
+			token = self.peek()
+			if token is None or token.group(4) not in ('^', '_'):
+				break
+			self.pos += 1
+			if token.group(4) == '^':
+				if sup is not None:
+					raise Unsupported("double superscript")
+				sup = self.argument()
+			else:
+				if sub is not None:
+					raise Unsupported("double subscript")
+				sub = self.argument()
+		if sub is not None and sup is not None:
+			return element('msubsup', base + sub + sup)
+		if sub is not None:
+			return element('msub', base + sub)
+		if sup is not None:
+			return element('msup', base + sup)
+		return base
+
+	def argument(self):
+		" The argument of ^, _, \\frac and so on: a {group} or a single symbol. "
+		token = self.peek()
+		if token is not None and token.group(2) is not None and len(token.group(2)) > 1:
+			# x^23 is x^2 followed by 3.
+			self.pos += 1
+			rest = TOKEN.match(self.tex, token.start() + 1)
+			self.tokens.insert(self.pos, rest)
+			return element('mn', token.group(2)[0])
+		if token is not None and token.group(4) in ('^', '_', '}'):
+			raise Unsupported("missing argument")
+		return self.atom()
+
+	def atom(self):
+		token = self.take()
+		command, number, space, char = token.groups()
+		if number is not None:
+			return element('mn', number)
+		if char is not None:
+			if char == '{':
+				return self.row('}')
+			if char.isalpha():
+				return element('mi', html.escape(char))
+			if char in OPERATOR_CHARS:
+				return element('mo', html.escape('\u2212' if char == '-' else '\u2032' if char == "'" else char))
+			raise Unsupported("character %r" % (char))
+		return self.command(command)
+
+	def command(self, name):
+		if name in IDENTIFIERS:
+			return element('mi', IDENTIFIERS[name])
+		if name in OPERATORS:
+			return element('mo', html.escape(OPERATORS[name]))
+		if name in FUNCTIONS:
+			return element('mi', name)
+		if name in SPACES:
+			if SPACES[name] is None:
+				return ''
+			return element('mspace', '', width = SPACES[name])
+		if name == 'frac':
+			return element('mfrac', self.argument() + self.argument())
+		if name == 'sqrt':
+			token = self.peek()
+			if token is not None and token.group(4) == '[':
+				self.pos += 1
+				index = self.row(']')
+				return element('mroot', self.argument() + index)
+			return element('msqrt', self.argument())
+		if name == 'left':
+			opening = self.delimiter()
+			inner = self.row('right')
+			self.take() # \right
+			closing = self.delimiter()
+			return element('mrow', opening + inner + closing)
+		if name in FONTS:
+			return element('mi', html.escape(self.raw_group()), mathvariant = FONTS[name])
+		if name in TEXT:
+			return element('mtext', html.escape(self.raw_group()))
+		raise Unsupported("\\%s" % (name))
+
+	def delimiter(self):
+		token = self.take()
+		if token.group(4) == '.':
+			return ''
+		if token.group(4) is not None and token.group(4) in '()[]|/':
+			return element('mo', token.group(4))
+		if token.group(1) in OPERATORS:
+			return element('mo', html.escape(OPERATORS[token.group(1)]))
+		raise Unsupported("delimiter")
+
+def to_mathml(tex, display = False):
+	" MathML for tex, or raises Unsupported. "
+	content = Parser(tex).row()
+	if display:
+		return element('math', content, display = 'block')
+	return element('math', content)
+
+def render(tex, display = False):
+	" MathML for tex, or the TeX itself (escaped, in a span) if it can't be done. "
+	try:
+		return to_mathml(tex, display)
+	except Unsupported:
+		delimiter = '$$' if display else '$'
+		return '<span class="tex">%s%s%s</span>' % (delimiter, html.escape(tex), delimiter)
@@ -0,0 +1,126 @@
+# vim: set fileencoding=utf-8 :
+"""
+Document outline (chapters and sections) from a fast heading-only scan.
+
+Only the heading rules from texdown.CONVERSIONS are run, combined into one
+regular expression, so getting the outline of a document costs a fraction
+of converting it. Each heading is returned as a dict:
+
+	{"kind": "section", "level": 2, "title": "Introduction",
+	 "label": "sec.intro", "id": "sec.intro", "line": 12, "offset": 345,
+	 "children": [...]}
+
+"offset" is the byte offset of the heading in the UTF-8 encoded document and
+"line" is counted from 1. "id" is the heading's <<label>> if it has one, and
+otherwise made from its title ("sec-big-chapter", then "sec-big-chapter-2" for
+a second heading with the same title). The HTML backend gives each heading it
+converts the same id, using HeadingIds, so links from the outline work.
+
+The scan doesn't run the rules which come before the headings in a full
+conversion. Those only take lines starting with a tab, "!!" or a space, so
+they can't hide a heading, except that math mode can: a heading line holding
+$...$, or one following $...$ on the same line, comes out differently in a
+full conversion. Since ids come from titles rather than from positions, such
+a heading can only affect the ids of later headings with the same title.
+"""
+
+import json
+import re
+
+import texdown
+
+HEADING_LEVELS = (
+	('chapterstar', 1),
+	('chapter', 1),
+	('section', 2),
+	('subsection', 3),
+	('subsubsection', 4),
+)
+
+# Every heading line starts with one of these.
+HEADING_STARTS = '#=-'
+
+def heading_matcher():
+	"""
+	One pattern matching any heading, in rule order, so that e.g. '== A =='
+	is a section and not a subsection, as in a full conversion. The
+	lookahead lets most lines fail on their first character.
+	"""
+	parts = []
+	for kind, level in HEADING_LEVELS:
+		parts.append('(?P<%s>%s)' % (kind, texdown.CONVERSIONS[kind]['match'].pattern))
+	return re.compile('^(?=[%s])(?:%s)' % (re.escape(HEADING_STARTS), '|'.join(parts)), re.MULTILINE)
+
+ID_UNSAFE = re.compile(r'[^\w.]+')
+
+class HeadingIds(object):
+	" Hands out heading ids, numbering repeated titles. Use one per document. "
+	def __init__(self):
+		self.seen = {}
+
+	def next(self, title, label):
+		if label:
+			return label
+		base = 'sec-' + (ID_UNSAFE.sub('-', title.lower()).strip('-') or 'untitled')
+		count = self.seen.get(base, 0) + 1
+		self.seen[base] = count
+		if count == 1:
+			return base
+		return '%s-%d' % (base, count)
+
+def split_title(text):
+	" Split heading text into (title, label). label is None if there isn't one. "
+	label = None
+	match = texdown.CONVERSIONS['label']['match'].search(text)
+	if match:
+		label = match.group(1).strip()
+		text = text[:match.start()] + text[match.end():]
+	return ' '.join(text.split()), label
+
+def headings(text, positions = False):
+	"""
+	A flat list of headings, in document order. With positions, each also
+	has the "start" and "end" of its heading line as string indexes.
+	"""
+	matcher = heading_matcher()
+	ids = HeadingIds()
+	result = []
+	line = 1
+	offset = 0
+	position = 0
+	ascii = text.isascii()
+
+	for match in matcher.finditer(text):
+		kind = match.lastgroup
+		title, label = split_title(match.group(matcher.groupindex[kind] + 1))
+
+		skipped = text[position:match.start()]
+		line += skipped.count('\n')
+		offset += len(skipped) if ascii else len(skipped.encode('utf-8'))
+		position = match.start()
+
+		result.append({'kind': kind, 'level': dict(HEADING_LEVELS)[kind],
+				'title': title, 'label': label,
+				'id': ids.next(title, label),
+				'line': line, 'offset': offset})
+		if positions:
+			result[-1]['start'], result[-1]['end'] = match.span()
+	return result
+
+def tree(flat):
+	" Nest a flat list of headings: each gets a list of its 'children'. "
+	root = {'level': 0, 'children': []}
+	stack = [root]
+	for heading in flat:
+		heading = dict(heading, children = [])
+		while stack[-1]['level'] >= heading['level']:
+			stack.pop()
+		stack[-1]['children'].append(heading)
+		stack.append(heading)
+	return root['children']
+
+def outline(text):
+	return tree(headings(text))
+
+def to_json(text):
+	return json.dumps(outline(text), indent = 1, ensure_ascii = False) + '\n'
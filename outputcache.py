@@ -0,0 +1,152 @@
+# vim: set fileencoding=utf-8 :
+"""
+A cache of whole conversions, which can be shared between machines.
+
+	texdown2latex.py --output-cache /nfs/texdown-output --outdir out *.texdown
+
+The output of each conversion (and the files written next to it, such as a
+search index) is kept in the --output-cache directory, named by a hash of
+everything it depends on: the document's text, the rules, the source of
+texdown and its backends and of the local macro modules, the options which
+change the output and the bibliography.
+A document seen before is written out without setting up a converter at all.
+
+Entries are written to a temporary file and renamed into place, so readers
+never see half an entry, even on NFS with other machines writing. The least
+recently used entries are deleted once the cache is bigger than
+--output-cache-size MB (see macrocache.py, which this shares its workings
+with).
+
+What macros read from files as they convert isn't known beforehand, so it
+can't be part of the key. Instead macros note what they read (see
+Converter.note_input()), and the entry keeps it: the lines each listing
+showed (see listings.py), and the rows of the --corpus index each reference
+to another document found (see corpus.py). An entry is only used while
+those are the same, so a change to the index only affects the documents
+which refer to what changed.
+Other files, such as graphics or a plotting script's data, aren't noted:
+point CI jobs whose documents use those at a cache of their own, or clear
+it.
+"""
+
+import glob
+import hashlib
+import inspect
+import json
+import os
+
+import macrocache
+import texdown
+
+CACHE_VERSION = 2
+
+# Options which don't change the output of a conversion.
+IGNORED_OPTIONS = frozenset([
+	'localmacros', # The modules' sources are hashed instead
+	'fragment_cache', 'macro_cache', 'macro_cache_size', 'clear_macro_cache', 'macro_threads',
+	'output_cache', 'output_cache_size', 'stats', 'bytes', 'jobs', 'timeout', 'memory_limit',
+	'outdir', 'check', 'preview',
+	'corpus', # Only whether there is one: the lookups are kept with each entry
+])
+
+def file_digest(path):
+	" A hash of the file's contents, or of its absence. "
+	try:
+		with open(path, 'rb') as handle:
+			return hashlib.sha256(handle.read()).hexdigest()
+	except (IOError, OSError):
+		return 'missing'
+
+def describe(value):
+	" A rule's value (a pattern, finder, list of names...) as JSON. "
+	if hasattr(value, 'pattern'):
+		return [value.pattern, value.flags]
+	if callable(value):
+		return '%s.%s' % (value.__module__, value.__qualname__)
+	return value
+
+def setup_digest(macro_clses, opts):
+	"""
+	A hash of everything but the document which a conversion's output
+	depends on. Files are named by their basenames, so that machines with
+	the tool installed in different places share entries.
+	"""
+	directory = os.path.dirname(os.path.abspath(texdown.__file__))
+	sources = set(glob.glob(os.path.join(directory, '*.py')))
+	if texdown.localmacros is not None:
+		macro_clses = list(macro_clses) + [texdown.localmacros.Macros]
+	for cls in macro_clses:
+		sources.add(os.path.abspath(inspect.getfile(cls)))
+
+	rules = [[name, sorted((key, describe(value)) for key, value in texdown.CONVERSIONS[name].items())]
+			for name in texdown.CONVERSIONS_ORDER]
+	options = dict((key, value) for key, value in vars(opts).items() if key not in IGNORED_OPTIONS)
+	bibliography = opts.bibliography if opts.bibliography.endswith('.bib') else opts.bibliography + '.bib'
+	key = json.dumps([CACHE_VERSION, rules, options, file_digest(bibliography), bool(opts.corpus),
+			sorted((os.path.basename(path), file_digest(path)) for path in sources)], sort_keys = True)
+	return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+class OutputCache(macrocache.MacroCache):
+	def __init__(self, directory, max_bytes, macro_clses, opts):
+		"""
+		A cache for conversions by Converter(macro_clses, opts), with the
+		rules as they are now.
+		"""
+		macrocache.MacroCache.__init__(self, directory, max_bytes)
+		self.setup = setup_digest(macro_clses, opts)
+		self.opts = opts
+		self.corpus = None
+
+	def remember(self, path, output):
+		pass # Documents are big, and each is looked up once.
+
+	def document_path(self, text):
+		" The entry for the document text (str, or UTF-8 bytes). "
+		if isinstance(text, str):
+			text = text.encode('utf-8')
+		hasher = hashlib.sha256(self.setup.encode('ascii'))
+		hasher.update(text)
+		return os.path.join(self.directory, hasher.hexdigest() + '.out')
+
+	def get_conversion(self, path):
+		" (output, sidecars) from the entry at path, or None. "
+		entry = self.get(path)
+		try:
+			output, sidecars, inputs = json.loads(entry)
+		except (TypeError, ValueError):
+			self.misses += 1
+			return None
+		for kind, key, value in inputs:
+			try:
+				unchanged = self.current_input(kind, tuple(key)) == value
+			except KeyError:
+				unchanged = False
+			if not unchanged:
+				self.misses += 1
+				return None
+		self.hits += 1
+		return output, sidecars
+
+	def current_input(self, kind, key):
+		" The value Converter.note_input() would note for the input now. KeyError for unknown kinds. "
+		if kind == 'listing':
+			import listings
+			return listings.digest(*key)
+		if kind == 'corpus' and self.opts.corpus:
+			if self.corpus is None:
+				import corpus
+				self.corpus = corpus.Corpus(self.opts.corpus)
+			target = self.corpus.lookup(*key)
+			return list(target) if target is not None else None
+		raise KeyError(kind)
+
+	def put_conversion(self, path, output, sidecars, inputs):
+		" inputs: what macros read from outside the document, see Converter.note_input(). "
+		inputs = [[kind, list(key), value] for (kind, key), value in inputs.items()]
+		self.put(path, json.dumps([output, sidecars, inputs]))
+
+	def report(self):
+		" How often documents were found, as a line for stderr. "
+		looked_up = self.hits + self.misses
+		return "output cache: %d hits, %d misses (%d%% hit rate)\n" \
+				% (self.hits, self.misses, 100 * self.hits // looked_up if looked_up else 0)
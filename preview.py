@@ -0,0 +1,256 @@
+# vim: set fileencoding=utf-8 :
+"""
+Live preview server for editors.
+
+Started with --preview, the converter keeps one warm Converter and talks
+line-delimited JSON over stdin/stdout. The editor sends the whole buffer
+once, then only the line ranges it changes:
+
+	{"op": "open", "lines": ["== Intro ==", "Some text", ...]}
+	{"op": "change", "start": 10, "end": 12, "lines": ["new line 10"]}
+	{"op": "output"}
+	{"op": "quit"}
+
+"change" replaces lines [start, end) (counted from zero) with "lines".
+
+The document is handled as blocks: a run of non-blank lines plus the blank
+lines after it. Tab blocks end at a blank line, but a list carries on over a
+single blank line, so two list-like lines (starting with a space) separated
+by one blank line stay in the same block. Blocks are converted separately,
+and after a change only the blocks around the changed lines are split and
+converted again. (Inline markup left open across a blank line, like a
+stray '[', therefore isn't matched up with the next paragraph's ']'.)
+
+Citations are numbered in document order, so whenever a change adds or
+removes blocks holding citations, every block with a citation is converted
+again, in order, and the reply covers any of them whose output changed.
+Heading ids are numbered within each block, so unlabelled headings with the
+same title in different blocks share an id, and the paper header's end
+matter is only rebuilt when the whole buffer is opened again.
+
+Every reply describes how to update the editor's list of block outputs:
+
+	{"first": 3, "remove": 1, "insert": ["<p>...</p>"], "end": "</body>...",
+		"blocks": 120, "errors": [], "ms": 1.2}
+
+i.e. replace "remove" outputs starting at index "first" with "insert". The
+full output is those block outputs joined, followed by "end". Requests may
+carry an "id", which is copied into the reply.
+"""
+
+import json
+import sys
+import time
+
+# Outputs of blocks that were edited away, kept in case the edit is undone.
+RECENT_OUTPUTS = 256
+
+# Blocks holding this (see the cite rule) depend on the citations before them.
+CITATION = '[['
+
+def is_blank(line):
+	# Lines holding just a tab still belong to a tab block.
+	return not line.strip(' \r')
+
+def check_lines(lines):
+	if not isinstance(lines, list) or not all(isinstance(line, str) for line in lines):
+		raise ValueError("'lines' must be a list of strings")
+	return lines
+
+class Block(object):
+	def __init__(self, lines, text):
+		self.lines = lines
+		self.text = text
+		self.output = None
+		self.error = None
+
+	def has_citations(self):
+		return CITATION in self.text
+
+class PreviewDocument(object):
+	def __init__(self, converter):
+		self.converter = converter
+		self.lines = []
+		self.blocks = []
+		self.recent = {}
+
+	def starts_block(self, idx):
+		lines = self.lines
+		if is_blank(lines[idx]) or not is_blank(lines[idx - 1]):
+			return False
+		if idx < 2 or is_blank(lines[idx - 2]):
+			return True
+		return not (lines[idx].startswith(' ') and lines[idx - 2].startswith(' '))
+
+	def split(self, start, end):
+		" Split lines[start:end] into blocks. "
+		blocks = []
+		block_start = start
+		for idx in range(start + 1, end):
+			if self.starts_block(idx):
+				blocks.append(self.make_block(block_start, idx))
+				block_start = idx
+		if block_start < end:
+			blocks.append(self.make_block(block_start, end))
+		return blocks
+
+	def make_block(self, start, end):
+		return Block(end - start, '\n'.join(self.lines[start:end]) + '\n')
+
+	def render(self, block):
+		previous = self.recent.pop(block.text, None)
+		if previous is not None:
+			return previous
+
+		converter = self.converter
+		converter.enum_depth = 0
+		for obj in converter.macro_objects:
+			if hasattr(obj, 'reset_headings'):
+				obj.reset_headings()
+		block.error = None
+		try:
+			block.output = converter.convert(block.text)
+		except Exception as e:
+			# Half-typed markup fails all the time; keep serving.
+			block.output = ''
+			block.error = str(e)
+			converter.block_cmd = None
+			converter.block_accum = []
+		return block
+
+	def replace(self, first, last, new_blocks):
+		" Replace blocks [first, last) and describe the change. "
+		removed = self.blocks[first:last]
+		for block in removed:
+			if not block.has_citations():
+				self.recent[block.text] = block
+		while len(self.recent) > RECENT_OUTPUTS:
+			del self.recent[next(iter(self.recent))]
+
+		new_blocks = [self.render(block) for block in new_blocks]
+		self.blocks[first:last] = new_blocks
+
+		# The changed range, in terms of the new list of blocks.
+		start, end = first, first + len(new_blocks)
+		if any(block.has_citations() for block in removed + new_blocks):
+			changed = self.renumber_citations()
+			if changed:
+				start, end = min(start, changed[0]), max(end, changed[-1] + 1)
+
+		errors = []
+		for idx in range(start, end):
+			if self.blocks[idx].error:
+				errors.append({'block': idx, 'line': self.block_start(idx) + 1,
+						'message': self.blocks[idx].error})
+
+		return {'first': start, 'remove': end - start - len(new_blocks) + len(removed),
+				'insert': [block.output for block in self.blocks[start:end]],
+				'end': self.converter.macros['end_document'](None),
+				'blocks': len(self.blocks),
+				'errors': errors}
+
+	def renumber_citations(self):
+		"""
+		Forget the citations and convert every block holding one again, in
+		document order. Returns the indexes of blocks whose output changed.
+		"""
+		for obj in self.converter.macro_objects:
+			if hasattr(obj, 'reset_citations'):
+				obj.reset_citations()
+		changed = []
+		for idx, block in enumerate(self.blocks):
+			if block.has_citations():
+				output = block.output
+				self.render(block)
+				if block.output != output:
+					changed.append(idx)
+		return changed
+
+	def block_start(self, block_idx):
+		return sum(block.lines for block in self.blocks[:block_idx])
+
+	def open(self, lines):
+		self.lines = list(check_lines(lines))
+		self.converter.reset()
+		self.recent = {}
+		return self.replace(0, len(self.blocks), self.split(0, len(self.lines)))
+
+	def change(self, start, end, lines):
+		"""
+		Replace lines [start, end). The blocks to redo are those holding the
+		changed lines, widened because whether a line starts a block depends
+		on the two lines before it: inserting or deleting a blank line can
+		merge or split the neighbouring blocks.
+		"""
+		check_lines(lines)
+		if not (isinstance(start, int) and isinstance(end, int) and 0 <= start <= end <= len(self.lines)):
+			raise ValueError("Bad line range %r-%r" % (start, end))
+
+		first = last = None
+		pos = 0
+		for idx, block in enumerate(self.blocks):
+			block_end = pos + block.lines
+			if first is None and block_end > start - 1:
+				first, first_line = idx, pos
+			if block_end > end + 1 or idx == len(self.blocks) - 1:
+				last, last_line = idx + 1, block_end
+				break
+			pos = block_end
+
+		if first is None:
+			first, first_line = len(self.blocks), len(self.lines)
+			last, last_line = first, first_line
+
+		self.lines[start:end] = lines
+		last_line += len(lines) - (end - start)
+		return self.replace(first, last, self.split(first_line, last_line))
+
+	def output(self):
+		return ''.join(block.output for block in self.blocks) \
+				+ self.converter.macros['end_document'](None)
+
+def handle_request(document, request):
+	op = request.get('op')
+	if op == 'open':
+		return document.open(request['lines'])
+	elif op == 'change':
+		return document.change(request['start'], request['end'], request['lines'])
+	elif op == 'output':
+		return {'output': document.output()}
+	else:
+		raise ValueError("Unknown op %r" % (op))
+
+def serve(converter, infile = None, outfile = None):
+	if infile is None:
+		infile = sys.stdin
+	if outfile is None:
+		outfile = sys.stdout
+
+	# Macros and the engine print diagnostics; keep them off the channel.
+	sys.stdout = sys.stderr
+
+	document = PreviewDocument(converter)
+	while True:
+		line = infile.readline()
+		if not line:
+			break
+		if not line.strip():
+			continue
+
+		start = time.perf_counter()
+		try:
+			request = json.loads(line)
+			if not isinstance(request, dict):
+				raise ValueError("Requests must be JSON objects")
+			if request.get('op') == 'quit':
+				break
+			reply = handle_request(document, request)
+		except (ValueError, KeyError, TypeError) as e:
+			request = {}
+			reply = {'error': str(e)}
+
+		if 'id' in request:
+			reply['id'] = request['id']
+		reply['ms'] = round((time.perf_counter() - start) * 1000, 2)
+		outfile.write(json.dumps(reply) + '\n')
+		outfile.flush()
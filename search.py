@@ -0,0 +1,153 @@
+# vim: set fileencoding=utf-8 :
+"""
+Client-side search for HTML output.
+
+With --search-index the HTML backend writes search.json and search.js next
+to its output. The index maps each word to the sections (see outline.py)
+whose text contains it. It is built from the output as the conversion
+produces it (see texdown.Chunks), a heading with an id starting each
+section, so nothing is read twice:
+
+	{"version": 1,
+	 "sections": [["#sec.intro", "Introduction"], ...],
+	 "words": {"abstraction": "1", "texdown": "0,1,3", "words": "0,1*40", ...}}
+
+Each word's sections are stored as the differences between section numbers,
+in base 36, with "d*n" for the same difference n times over, so that common
+words cost a few bytes rather than a list of every section. search.js puts a
+search box at the top of the page and only fetches search.json when the box
+is first used.
+"""
+
+import html
+import json
+import re
+
+INDEX_VERSION = 1
+
+WORD = re.compile(r'\w{2,40}')
+# Tags and LaTeX commands left in the output aren't words, nor are
+# environment names, placements or labels.
+MARKUP = re.compile(r'<[^>]*>|\\(?:begin|end|label|ref)\{[^{}]*\}(?:\[[^\]\n]*\])?|\\[A-Za-z]+')
+HEADING = re.compile(r'<h[1-6] id="([^"]*)">(.*?)</h[1-6]>')
+
+def base36(number):
+	digits = ''
+	while True:
+		number, digit = divmod(number, 36)
+		digits = '0123456789abcdefghijklmnopqrstuvwxyz'[digit] + digits
+		if not number:
+			return digits
+
+def encode_postings(numbers):
+	" Encode ascending section numbers, as in the module docstring. "
+	runs = [] # [difference, count]
+	previous = 0
+	for number in numbers:
+		difference = number - previous
+		previous = number
+		if runs and runs[-1][0] == difference:
+			runs[-1][1] += 1
+		else:
+			runs.append([difference, 1])
+	return ','.join(base36(difference) + ('*%s' % (base36(count)) if count > 1 else '')
+			for difference, count in runs)
+
+def plain_text(output):
+	return html.unescape(MARKUP.sub(' ', output))
+
+class SearchIndex(object):
+	" Words by section, collected from pieces of output in document order. "
+	def __init__(self):
+		self.sections = [['#', '']]
+		self.words = [set()]
+
+	def add_output(self, output):
+		if isinstance(output, bytes):
+			output = output.decode('utf-8')
+		pos = 0
+		for match in HEADING.finditer(output):
+			self.add_words(output[pos:match.start()])
+			title = ' '.join(plain_text(match.group(2)).split())
+			self.sections.append(['#' + html.unescape(match.group(1)), title])
+			self.words.append(set())
+			self.add_words(title)
+			pos = match.end()
+		self.add_words(output[pos:])
+
+	def add_words(self, output):
+		self.words[-1].update(WORD.findall(plain_text(output).lower()))
+
+	def index(self):
+		" The index, as a dict, leaving out sections without words. "
+		sections = []
+		words = {}
+		for section, found in zip(self.sections, self.words):
+			if not found:
+				continue
+			number = len(sections)
+			sections.append(section)
+			for word in found:
+				words.setdefault(word, []).append(number)
+
+		return {'version': INDEX_VERSION, 'sections': sections,
+				'words': dict((word, encode_postings(numbers)) for word, numbers in words.items())}
+
+def to_json(index):
+	return json.dumps(index, ensure_ascii = False, separators = (',', ':'), sort_keys = True)
+
+SEARCH_JS = r"""// Texdown search: fetches search.json the first time the box is used.
+(function () {
+	var index = null, loading = null;
+	var box = document.createElement('div');
+	box.className = 'texdown-search';
+	box.innerHTML = '<input type="search" placeholder="Search"><ol></ol>';
+	document.body.insertBefore(box, document.body.firstChild);
+	var input = box.querySelector('input'), results = box.querySelector('ol');
+
+	function load() {
+		if (!loading) {
+			loading = fetch('search.json').then(function (response) {
+				return response.json();
+			}).then(function (data) { index = data; });
+		}
+		return loading;
+	}
+
+	function decode(postings) {
+		var numbers = [], number = 0;
+		postings.split(',').forEach(function (run) {
+			var parts = run.split('*'), difference = parseInt(parts[0], 36);
+			var count = parts.length > 1 ? parseInt(parts[1], 36) : 1;
+			for (var i = 0; i < count; i++) {
+				number += difference;
+				numbers.push(number);
+			}
+		});
+		return numbers;
+	}
+
+	function search() {
+		var words = input.value.toLowerCase().match(/[\wÀ-￿]{2,}/g) || [];
+		var found = null;
+		words.forEach(function (word) {
+			var sections = index.words[word] ? decode(index.words[word]) : [];
+			found = found === null ? sections : found.filter(function (n) {
+				return sections.indexOf(n) !== -1;
+			});
+		});
+		results.innerHTML = '';
+		(found || []).slice(0, 50).forEach(function (n) {
+			var section = index.sections[n];
+			var item = document.createElement('li'), link = document.createElement('a');
+			link.href = section[0];
+			link.textContent = section[1] || document.title || 'Top';
+			item.appendChild(link);
+			results.appendChild(item);
+		});
+	}
+
+	input.addEventListener('focus', load);
+	input.addEventListener('input', function () { load().then(search); });
+})();
+"""
@@ -0,0 +1,882 @@
+#!/usr/bin/env python3
+# vim: set fileencoding=utf-8 :
+"""
+Quick checks of the pieces that are easy to get subtly wrong.
+
+	selftest.py
+
+Each check_ function raises AssertionError on failure. Prints one line per
+check and exits non-zero if any fail.
+"""
+
+import html
+import json
+import os
+import shutil
+import sys
+import tempfile
+import traceback
+
+import bibtex
+import texdown
+import texdown2html
+
+BIB = b"""
+@string{acm = "ACM Press"}
+
+@article{broken, title={Never closed}
+@book{Knuth84, author = {Donald E. Knuth and A. <b> & Co}, title = {The {\\TeX}book},
+	publisher = acm, year = 1984}
+@misc{Lamport94, title = "LaTeX", year = {1994}}
+"""
+
+def write_bib(tmp):
+	" Write BIB to papers.bib in tmp, and return its path. "
+	path = os.path.join(tmp, 'papers.bib')
+	with open(path, 'wb') as handle:
+		handle.write(BIB)
+	return path
+
+KEYS_RULE = r"""keys:
+	match	\{\{(.+?)\}\}
+	func	keys
+"""
+
+def html_converter(bib_path):
+	texdown.update_conversions(texdown.CONVERSIONS, texdown2html.CONVERSIONS_TXT)
+	opts, args = texdown.parse_args(['-b', bib_path])
+	return texdown.Converter([texdown2html.Macros], opts)
+
+class KeysMacros(object):
+	def __init__(self, converter):
+		pass
+
+	def macro_keys(self, match):
+		return '<kbd>%s</kbd>' % (match.group(1))
+
+def check_add_conversions(tmp):
+	" Rules added by add_conversions() run where they're placed; bad ones are refused. "
+	import copy
+	saved = copy.deepcopy(texdown.CONVERSIONS), list(texdown.CONVERSIONS_ORDER)
+	try:
+		texdown.update_conversions(texdown.CONVERSIONS, texdown2html.CONVERSIONS_TXT)
+		texdown.add_conversions(KEYS_RULE + '\tafter\tbold\n\tinside\tbullets\n')
+		texdown.add_conversions(KEYS_RULE + '\tbefore\tbold\n\tinside\tbullets numbers\n')
+		order = texdown.CONVERSIONS_ORDER
+		assert order.index('keys') + 1 == order.index('bold'), order
+		assert texdown.CONVERSIONS['bullets']['incl'].count('keys') == 1, texdown.CONVERSIONS['bullets']
+		assert texdown.CONVERSIONS['numbers']['incl'][-1] != 'keys', texdown.CONVERSIONS['numbers']
+		opts, args = texdown.parse_args(['-b', os.path.join(tmp, 'missing')])
+		output = texdown.Converter([texdown2html.Macros, KeysMacros], opts)('Press {{*}} *now*.\n\n * {{q}} quits\n\n')
+		assert 'Press <kbd>*</kbd> <b>now</b>.' in output and '<kbd>q</kbd> quits' in output, output
+		for rules in ('keys\n\tmatch\tx\n', 'x:\n\tmatch\tx\n', KEYS_RULE + '\tbefore\tnothing\n'):
+			try:
+				texdown.add_conversions(rules)
+			except texdown.ConversionError:
+				pass
+			else:
+				raise AssertionError(rules)
+	finally:
+		texdown.CONVERSIONS.clear()
+		texdown.CONVERSIONS.update(saved[0])
+		texdown.CONVERSIONS_ORDER[:] = saved[1]
+		texdown.CONVERSIONS_GENERATION += 1
+
+def check_bib_unterminated_entry(tmp):
+	" An unterminated entry is skipped; the entries after it are kept. "
+	entries, strings = bibtex.scan(BIB)
+	assert sorted(entries) == ['Knuth84', 'Lamport94'], entries
+	assert strings == {'acm': 'ACM Press'}, strings
+
+	path = write_bib(tmp)
+	index = bibtex.open_index(path)
+	assert index.get('Knuth84')['publisher'] == 'ACM Press'
+	# ... and again from the saved index.
+	index = bibtex.open_index(path)
+	assert 'Lamport94' in index and len(index) == 2
+
+def check_bib_authors_escaped(tmp):
+	path = write_bib(tmp)
+	output = html_converter(path)('See[[Knuth84]].\n')
+	assert '<b>' not in output and 'A. &lt;b&gt; &amp; Co' in output, output
+
+def check_citations_per_document(tmp):
+	" A Converter used for two documents numbers each one's citations afresh. "
+	path = write_bib(tmp)
+	converter = html_converter(path)
+	converter('First[[Lamport94]].\n')
+	output = converter('Second[[Knuth84]].\n')
+	assert 'Lamport94' not in output, output
+	assert '<a href="#cite.Knuth84">1</a>' in output, output
+
+def check_failed_block_forgotten(tmp):
+	" A document which fails inside a block leaves nothing behind for the next one. "
+	converter = html_converter(os.path.join(tmp, 'missing'))
+	try:
+		converter('\tfoo\t!!nosuchmacro\n\tbar\n')
+	except KeyError:
+		pass
+	output = converter('\tfirst\t!!floatcode\n\tsecond\n')
+	assert '\\begin{verbatim}\nfirst\nsecond\n\\end{verbatim}' in output, output
+
+def check_cached_fragment_citations(tmp):
+	" Citations in fragments (here a description list) count in every document. "
+	path = write_bib(tmp)
+	converter = html_converter(path)
+	for repeat in range(2):
+		output = converter(' Books: See[[Knuth84]].\n')
+		assert '<li id="cite.Knuth84">' in output, output
+
+PREVIEW_LINES = [
+	'== First ==', 'Some text[[Knuth84]].', '', ' * one', ' * two', '', ' * three', '',
+	'	A	B	!!floattable', '	1	2', '', '= Second =', 'More[[Lamport94]] text.', '',
+	' 1. first', '', ' 2. second', '', 'Plain /italic/ text.', '',
+]
+
+EDITS = ['', '', 'Cited[[Lamport94]].', 'See[[Knuth84]] again.', 'Plain words.',
+		' * item', ' 3. three', '- Third <<sub.third>> -', '	x	y	!!floattable', '	1	2']
+
+def apply_reply(outputs, reply):
+	assert 'error' not in reply, reply # (as opposed to 'errors' in blocks)
+	outputs[reply['first']:reply['first'] + reply['remove']] = reply['insert']
+	assert len(outputs) == reply['blocks'], (len(outputs), reply)
+	return ''.join(outputs) + reply['end']
+
+def check_preview_matches_full_conversion(tmp):
+	" After random edits, the spliced block outputs equal a full conversion. "
+	import preview
+	import random
+
+	path = write_bib(tmp)
+	document = preview.PreviewDocument(html_converter(path))
+	lines = list(PREVIEW_LINES)
+	outputs = []
+	apply_reply(outputs, document.open(lines))
+
+	rand = random.Random(1)
+	for edit in range(300):
+		start = rand.randrange(len(lines) + 1)
+		end = min(len(lines), start + rand.randrange(3))
+		new = [rand.choice(EDITS) for count in range(rand.randrange(3))]
+		lines[start:end] = new
+		output = apply_reply(outputs, document.change(start, end, new))
+		try:
+			expected = html_converter(path)(''.join(line + '\n' for line in lines))
+		except texdown.ConversionError:
+			continue # e.g. a tab block without its !!macro line
+		assert output == expected, (edit, lines, output, expected)
+
+def check_preview_bad_requests(tmp):
+	" Malformed requests get an error reply and the server keeps going. "
+	import io
+	import json
+	import preview
+
+	requests = ['[1]', '{"op": "open", "lines": ["a"]}',
+			'{"op": "change", "start": 0, "end": 0, "lines": [1]}',
+			'{"op": "change", "start": 0, "end": 5, "lines": []}',
+			'{"op": "output", "id": 7}']
+	outfile = io.StringIO()
+	stdout = sys.stdout
+	try:
+		preview.serve(html_converter('missing'), io.StringIO('\n'.join(requests) + '\n'), outfile)
+	finally:
+		sys.stdout = stdout
+
+	replies = [json.loads(line) for line in outfile.getvalue().splitlines()]
+	assert len(replies) == 5, replies
+	assert 'error' in replies[0] and 'error' not in replies[1]
+	assert 'error' in replies[2] and 'error' in replies[3]
+	assert replies[4]['id'] == 7 and replies[4]['output'].strip() == 'a', replies[4]
+
+LINT_DOCUMENT = """	title	T	!!techreport
+	author	Someone	a@b.c	"Uni
+	author
+	author	X	x@y.z	NOSUCH
+
+Open [[cite and <<label here.
+Costs $5, 2 * 3 and 5'2" tall.
+A ((url and ''tt.
+
+!!nosuch args
+!!floatgraphic file.pdf
+
+	code	!!floatcode
+
+	no command here
+"""
+
+def check_lint(tmp):
+	import lint
+
+	linter = lint.Linter(html_converter('missing').macros, texdown2html.AFFILIATIONS)
+	problems = linter.check(LINT_DOCUMENT)
+	assert problems == [
+		(2, 'unterminated affiliation "Uni'),
+		(3, 'author line has no name'),
+		(4, "unknown affiliation 'NOSUCH'"),
+		(6, 'unbalanced [[ ]] (1 opened, 0 closed)'),
+		(6, 'unbalanced << >> (1 opened, 0 closed)'),
+		(8, "unmatched ''"),
+		(8, 'unbalanced (( )) (1 opened, 0 closed)'),
+		(10, "unknown macro 'nosuch'"),
+		(11, 'floatgraphic has no caption (!!floatgraphic filename, Caption)'),
+		(13, 'floatcode has no caption (~~ ... ~~ line)'),
+		(15, 'tab block has no block command (\\t!!macroname)'),
+	], problems
+	# Literal $, * and " are only warnings.
+	assert linter.warnings == [(6, 'unmatched *'), (7, 'unmatched "'), (7, 'unmatched $')], \
+			linter.warnings
+
+def check_search_index(tmp):
+	" The index is collected from the output: words by section, not markup. "
+	import search
+
+	assert search.encode_postings([0, 1, 3, 5, 7, 100]) == '0,1,2*3,2l'
+	texdown.update_conversions(texdown.CONVERSIONS, texdown2html.CONVERSIONS_TXT)
+	opts, args = texdown.parse_args(['-b', os.path.join(tmp, 'missing'), '--search-index'])
+	converter = texdown.Converter([texdown2html.Macros], opts)
+	for repeat in range(2):
+		converter('Front words.\n\n== Alpha ==\nshared *Words*\n\n= Beta <<sub.b>> =\nshared\n'
+				'\tx = 1\t!!floatcode\n')
+		index = json.loads(converter.sidecars['search.json'])
+		assert index['sections'] == [['#', ''], ['#sec-alpha', 'Alpha'], ['#sub.b', 'Beta']], index
+		assert index['words']['words'] == '0,1' and index['words']['shared'] == '1*2', index
+		assert 'floatcode' not in index['words'] and 'sub' not in index['words'], index
+
+	# Preview has nowhere to put it.
+	opts.preview = True
+	converter = texdown.Converter([texdown2html.Macros], opts)
+	converter('== Alpha ==\n')
+	assert 'search.json' not in converter.sidecars
+
+def check_split_pages(tmp):
+	" Pages link to each other, and links follow ids to their page. "
+	import htmlsplit
+
+	path = write_bib(tmp)
+	output = html_converter(path)('Front.\n\n## One ##\nSee[[Knuth84]].\n\n'
+			'== Two <<sec.two>> ==\nBack to [sec.two].\n\n## Three ##\nCited[[Lamport94]].\n')
+	outdir = os.path.join(tmp, 'out')
+	names = htmlsplit.write_pages(output, outdir, 'section')
+	assert names == ['index.html', 'sec-one.html', 'sec.two.html', 'sec-three.html'], names
+
+	def page(name):
+		with open(os.path.join(outdir, name), encoding = 'utf-8') as handle:
+			return handle.read()
+	assert 'href="sec-three.html#cite.Knuth84"' in page('sec-one.html')
+	two = page('sec.two.html')
+	assert '<a rel="up" href="sec-one.html">' in two and '<a rel="next" href="sec-three.html">' in two
+	assert '<li><a href="sec.two.html">Two</a></li>' in page('index.html')
+
+def check_tree_export(tmp):
+	" Nodes of an exported tree point at the source; bad trees are rejected. "
+	import doctree
+
+	text = 'Intro.\n\n== Intro <<sec.intro>> ==\n * One[[Knuth84]]\n * Two\n\n\tA\tB\t!!floattable\n\t1\t2\n'
+	source, nodes = doctree.load(doctree.export(text))
+	assert source == text
+	found = [(node['rule'], node['parent'], node['groups'], node['continues']) for node in nodes]
+	assert found == [
+		('section', None, ['Intro <<sec.intro>> '], False),
+		('label', 0, ['sec.intro'], False),
+		('bullets', None, [' ', ' One[[Knuth84]]'], False),
+		('cite', 2, ['Knuth84'], False),
+		('bullets', None, [' ', ' Two'], True),
+		('block_cmd', None, ['A\tB\t!!floattable'], False),
+		('block_cmd', None, ['1\t2'], True),
+	], found
+	assert [node['line'] for node in nodes] == [3, 3, 4, 4, 5, 7, 8]
+	assert all(text[node['start']:node['end']] for node in nodes)
+
+	for bad in (['{}'], ['{"format": "texdown-tree", "version": 99, "source": ""}'],
+			['{"format": "texdown-tree", "version": 1, "source": ""}', '[1, 2]']):
+		try:
+			doctree.load(bad)
+		except doctree.TreeError:
+			pass
+		else:
+			assert False, bad
+
+def check_required_literals(tmp):
+	required = texdown.required_literals
+	assert required(texdown.re.compile(r'<<([^<]*)>>')) == ['<<', '>>']
+	assert required(texdown.re.compile(r'(?i)fixme')) == []
+	assert required(texdown.re.compile(r'x(?i:fixme)y')) == ['x', 'y']
+
+# The rules as they were before being made linear-time, with characters to
+# make test strings from.
+OLD_RULES = [
+	('italics', r'([^A-Za-z]|^)/([^ ].+?[^ ])/([^A-Za-z]|$)', '/ a1\n'),
+	('url', r'\(\((.*?)\)\)', '() a\n'),
+	('cite', r' *\[\[([^\[]*)\]\]', ' [] a\n'),
+	('chapter', r'^## *(.*) *##', '# a\n'),
+	('section', r'^== *(.*) *==', '= a\n'),
+	('subsubsection', r'^- *(.*) *-', '- a\n'),
+]
+
+def check_linear_rules_match_old_rules(tmp):
+	" Rewritten patterns and finders find the same matches as the old patterns. "
+	import random
+
+	def found(matches):
+		return [(match.span(), match.groups()) for match in matches]
+
+	rand = random.Random(1)
+	for name, old, characters in OLD_RULES:
+		old = texdown.re.compile(old, texdown.re.MULTILINE)
+		conv = texdown.CONVERSIONS[name]
+		for count in range(20000):
+			text = ''.join(rand.choice(characters) for idx in range(rand.randrange(20)))
+			if 'finder' in conv:
+				new = found(conv['finder'](conv['match'], text))
+			else:
+				new = found(conv['match'].finditer(text))
+			assert new == found(old.finditer(text)), (name, text)
+
+def check_witnesses_never_skip_matches(tmp):
+	" Text without a witness character isn't matched by any rule, as str or UTF-8. "
+	import random
+	import texdown2latex
+
+	rand = random.Random(1)
+	for module in (texdown2html, texdown2latex):
+		texdown.update_conversions(texdown.CONVERSIONS, module.CONVERSIONS_TXT)
+		plain, plain_bytes = texdown.witnesses(str), texdown.witnesses(bytes)
+		assert plain is not None and plain_bytes is not None
+		rules = [(name, conv) for name, conv in texdown.CONVERSIONS.items() if 'match' in conv]
+		byte_rules = texdown.byte_conversions()
+		# Everything the rules look for, but the witnesses themselves.
+		characters = set(''.join(''.join(conv['needs']) for name, conv in rules) + 'aZ0 .,é\n\t')
+		characters = sorted(char for char in characters if plain.search(char) is None)
+		assert len(characters) > 10, characters
+		for count in range(5000):
+			text = ''.join(rand.choice(characters) for idx in range(rand.randrange(30)))
+			assert plain_bytes.search(text.encode('utf-8')) is None, text
+			for name, conv in rules:
+				assert conv['match'].search(text) is None, (module.__name__, name, text)
+				assert byte_rules[name]['match'].search(text.encode('utf-8')) is None, (module.__name__, name, text)
+		for name, conv in rules:
+			assert plain.search(''.join(conv['needs'])), (module.__name__, name)
+
+class PlotMacros(object):
+	calls = 0
+
+	def __init__(self, converter):
+		pass
+
+	@texdown.pure('1')
+	def macro_plot(self, args):
+		PlotMacros.calls += 1
+		return '<img src="%s.png">' % (args) + ' ' * 400 + '\n'
+
+class NewPlotMacros(PlotMacros):
+	@texdown.pure('2')
+	def macro_plot(self, args):
+		return PlotMacros.macro_plot(self, args)
+
+def check_pure_macro_cache(tmp):
+	" Pure macro output is reused, by version, evicted beyond the size limit and cleared. "
+	import macrocache
+
+	directory = os.path.join(tmp, 'cache')
+	def convert(text, macros = PlotMacros):
+		texdown.update_conversions(texdown.CONVERSIONS, texdown2html.CONVERSIONS_TXT)
+		opts, args = texdown.parse_args(['-b', 'missing', '--macro-cache', directory,
+				'--macro-cache-size', '1'])
+		return texdown.Converter([texdown2html.Macros, macros], opts)(text)
+
+	first = convert('!!plot a\n!!plot b\n!!plot a\n')
+	assert PlotMacros.calls == 2, PlotMacros.calls
+	assert convert('!!plot a\n!!plot b\n!!plot a\n') == first and PlotMacros.calls == 2
+	convert('!!plot a\n', NewPlotMacros)
+	assert PlotMacros.calls == 3, PlotMacros.calls
+
+	cache = macrocache.MacroCache(directory, 1000)
+	assert len(cache.entries()) == 3
+	cache.put(cache.path('plot', '', '', 'c'), 'x' * 500)
+	assert len(cache.entries()) == 2 and sum(entry[1] for entry in cache.entries()) <= 1000
+	cache.clear()
+	assert cache.entries() == []
+
+def check_math(tmp):
+	" $...$ becomes MathML, from the cache the second time; what can't be converted stays TeX. "
+	import mathml
+
+	assert mathml.render(r'x_1^{2}') == '<math><msubsup><mi>x</mi><mn>1</mn><mn>2</mn></msubsup></math>'
+	assert mathml.render(r'\frac{a}{b}') == '<math><mfrac><mi>a</mi><mi>b</mi></mfrac></math>'
+	assert mathml.render(r'a < b') == '<math><mrow><mi>a</mi><mo>&lt;</mo><mi>b</mi></mrow></math>'
+	for tex in (r'\begin{matrix} a \end{matrix}', r'{a', r'x^', r'a & b', r'\left( a'):
+		assert mathml.render(tex) == '<span class="tex">$%s$</span>' % (html.escape(tex)), tex
+
+	directory = os.path.join(tmp, 'cache')
+	def convert(text):
+		texdown.update_conversions(texdown.CONVERSIONS, texdown2html.CONVERSIONS_TXT)
+		opts, args = texdown.parse_args(['-b', 'missing', '--macro-cache', directory])
+		converter = texdown.Converter([texdown2html.Macros], opts)
+		return converter(text), converter.macro_cache
+
+	text = 'Both $x^2$ and $x^2$, not $\\foo$.\n'
+	output, cache = convert(text)
+	assert output == 'Both %s and %s, not %s.\n' % (mathml.render('x^2'), mathml.render('x^2'),
+			'<span class="tex">$\\foo$</span>'), output
+	assert (cache.hits, cache.misses) == (1, 2), (cache.hits, cache.misses)
+	output, cache = convert(text)
+	assert (cache.hits, cache.misses) == (3, 0), (cache.hits, cache.misses)
+
+DIFF_OLD = """== Introduction ==
+
+Says something plain.
+
+ * First
+ * Second
+ * Third
+
+	A	B	!!floattable
+	1	2
+
+Old paragraph.
+"""
+
+DIFF_NEW = """== Introduction and Aims ==
+
+Says something new.
+
+ * First
+ * Third
+
+	A	B	!!floattable
+	1	3
+"""
+
+def check_diff(tmp):
+	" --diff marks words changed in headings, paragraphs and items, and whole changed blocks. "
+	import changes
+
+	marked, deleted = changes.mark(DIFF_OLD, DIFF_NEW)
+	assert changes.mark(DIFF_NEW, DIFF_NEW) == (DIFF_NEW, [])
+	texdown.update_conversions(texdown.CONVERSIONS, texdown2html.CONVERSIONS_TXT)
+	converter = html_converter(os.path.join(tmp, 'missing.bib'))
+	output = changes.render(converter(marked), texdown2html.Macros.diff_markup, deleted)
+	for expected in ('Introduction <ins>and Aims</ins></h2>', 'something <del>plain.</del><ins>new.</ins>',
+			'<del>Second</del>', '<ins>Changed above</ins>', '<del>Old paragraph.</del>'):
+		assert expected in output, (expected, output)
+	assert changes.INSERT_START not in output and changes.DELETE_END not in output
+
+	# Deleted words are shown as they were, not converted: a deleted
+	# citation isn't numbered or listed, and deleted markup stays inert.
+	converter = html_converter(write_bib(tmp))
+	marked, deleted = changes.mark('See it[[Knuth84]] now, *or <b>\n', 'See it[[Lamport94]] now, or\n')
+	output = changes.render(converter(marked), texdown2html.Macros.diff_markup, deleted)
+	assert '<del>it[[Knuth84]]</del><ins>it&nbsp;[<a href="#cite.Lamport94">1</a>]</ins>' in output, output
+	assert 'cite.Knuth84' not in output and '<del>*or &lt;b&gt;</del>' in output, output
+
+FAKE_TOOLCHAIN = r"""
+import os, re, sys
+tool, target = sys.argv[1], sys.argv[2]
+name = os.path.splitext(target)[0]
+with open('runs.log', 'a') as handle:
+	handle.write('%s %s\n' % (tool, name))
+def read(path):
+	return open(path).read() if os.path.exists(path) else ''
+if tool == 'latex':
+	tex, bbl = read(name + '.tex'), read(name + '.bbl')
+	keys = re.findall(r'\\cite[pt]?\{(.*?)\}', tex)
+	aux = ''.join('\\citation{%s}\n' % (key) for key in keys) + ('\\bibdata{papers}\n' if keys else '')
+	aux += ''.join('\\bibcite{%s}{1}\n' % (key) for key in re.findall(r'\\bibitem\{(.*?)\}', bbl))
+	open(name + '.aux', 'w').write(aux)
+	open(name + '.pdf', 'w').write(tex + bbl)
+else:
+	aux = read(name + '.aux')
+	open(name + '.bbl', 'w').write(''.join('\\bibitem{%s}\n' % (key)
+		for key in re.findall(r'\\citation\{(.*?)\}', aux) if key in read('papers.bib')))
+"""
+
+def check_build_reruns(tmp):
+	" texdown2pdf.py runs LaTeX and BibTeX only when their inputs changed. "
+	import texdown2latex
+	import texdown2pdf
+
+	fake = os.path.join(tmp, 'fake.py')
+	with open(fake, 'w') as handle:
+		handle.write(FAKE_TOOLCHAIN)
+	for name, text in (('papers.bib', BIB.decode('utf-8')), ('a.texdown', 'See[[Knuth84]].\n'),
+			('b.texdown', 'No citations.\n')):
+		with open(os.path.join(tmp, name), 'w') as handle:
+			handle.write(text)
+	texdown.update_conversions(texdown.CONVERSIONS, texdown2latex.CONVERSIONS_TXT)
+	opts, args = texdown.parse_args(['-j', '2', '--latex', '%s %s latex' % (sys.executable, fake),
+			'--bibtex', '%s %s bibtex' % (sys.executable, fake)], [texdown2pdf.build_options])
+
+	def build(*names):
+		log = os.path.join(tmp, 'runs.log')
+		if os.path.exists(log):
+			os.remove(log)
+		stdout = sys.stdout
+		sys.stdout = open(os.devnull, 'w')
+		try:
+			failures = texdown2pdf.build_files([os.path.join(tmp, name) for name in names],
+					[texdown2latex.Macros], opts)
+		finally:
+			sys.stdout.close()
+			sys.stdout = stdout
+		assert failures == 0
+		if not os.path.exists(log):
+			return []
+		with open(log) as handle:
+			return sorted(handle.read().split('\n')[:-1])
+
+	# The first run writes the .aux file, so even b needs a second.
+	assert build('a.texdown', 'b.texdown') == ['bibtex a', 'latex a', 'latex a', 'latex a', 'latex b', 'latex b']
+	assert build('a.texdown', 'b.texdown') == []
+	with open(os.path.join(tmp, 'a.texdown'), 'a') as handle:
+		handle.write('More text.\n')
+	assert build('a.texdown') == ['latex a']
+	with open(os.path.join(tmp, 'papers.bib'), 'a') as handle:
+		handle.write('@book{Other, title = {Other}}\n')
+	# The .bbl file comes out the same, so LaTeX needn't run.
+	assert build('a.texdown', 'b.texdown') == ['bibtex a']
+
+THREADS_DOCUMENT = """Intro[[Knuth84]].
+
+	x = 1	!!floatcode
+	~~ <<code.a>> Code, see[[Lamport94]] ~~
+
+!!floatgraphic plot.pdf, A plot
+
+	x = 1	!!floatcode
+	~~ <<code.b>> Same code again[[Knuth84]] ~~
+
+	A	B	!!floattable
+	1	2
+
+!!floatgraphic plot.pdf, A plot
+"""
+
+UTF8_DOCUMENT = """== Café <<sec.café>> ==
+
+Ünïcode /é/ and /naïve/ italics, é/x/ and 😀 /a b/, *gras* ''tty'' "quoté".
+See Section [sec.café] and ((http://example.com/é)) and [[Knuth84]].
+
+ * Élan
+ * ж ж 1/2
+ 1. Über
+ Term: définition — fin
+
+~~ Légende ~~
+"""
+
+def check_utf8_bytes_same_output(tmp):
+	" Converting the UTF-8 bytes gives the same output as converting the text. "
+	import random
+	import texdown2latex
+
+	pieces = ['/', '/é/', 'é', '😀', 'ж', ' ', '\n', '*', 'a', 'Z', '((x))', '\t', '!!', '==', ' * ',
+			'#', '_', '`', '$', '\\', '^', '-', '{', '[', ']', ':', '1.', '"', "'", '<', '&', '~', '%']
+	rand = random.Random(1)
+	texts = [UTF8_DOCUMENT] + [''.join(rand.choice(pieces) for idx in range(rand.randrange(40)))
+			for count in range(1000)]
+	for module in (texdown2html, texdown2latex):
+		texdown.update_conversions(texdown.CONVERSIONS, module.CONVERSIONS_TXT)
+		assert texdown.byte_conversions() is not None, module.__name__
+		opts, args = texdown.parse_args(['-b', os.path.join(tmp, 'missing')])
+		for text in texts:
+			outputs = []
+			for convert in ('convert_document', 'convert_document_bytes'):
+				converter = texdown.Converter([module.Macros], opts)
+				try:
+					chunks = getattr(converter, convert)(text.encode('utf-8') if convert.endswith('bytes') else text)
+					outputs.append(b''.join(chunk if isinstance(chunk, bytes) else chunk.encode('utf-8') for chunk in chunks))
+				except Exception as e:
+					outputs.append(repr(e))
+			assert outputs[0] == outputs[1], (module.__name__, text, outputs)
+
+	# Offsets in any order, from one shared CharOffsets.
+	import re
+	import utf8rules
+	text = 'aé 😀b\nж zé'
+	data = text.encode('utf-8')
+	offsets = utf8rules.CharOffsets(data)
+	matches = list(re.finditer('[^ ]+', text))
+	byte_matches = list(re.finditer(rb'[^ ]+', data))
+	for idx in (2, 0, 1, 2, 0):
+		match = utf8rules.Utf8Match(byte_matches[idx], offsets)
+		assert match.span() == matches[idx].span() and match.group() == matches[idx].group(), idx
+
+	try:
+		texdown.Converter([texdown2html.Macros], opts).convert_document_bytes(b'caf\xe9\n')
+	except UnicodeDecodeError:
+		pass
+	else:
+		assert False, 'invalid UTF-8 converted'
+
+def check_draft_placeholders(tmp):
+	" --draft shows big tables and long blocks as placeholders, keeping their labels. "
+	rows = ''.join('\t%d\t%d\n' % (idx, idx * idx) for idx in range(100))
+	text = ('== Results <<sec.results>> ==\n\n\tN\tSquare\t!!floattable\n' + rows + '\t~~ <<table.squares>> Squares ~~\n\n'
+			+ '\tshort\t!!floatcode\n\tcode\n\n\tlong\t!!floatcode\n' + rows + '\t~~ <<code.long>> Long ~~\n')
+	texdown.update_conversions(texdown.CONVERSIONS, texdown2html.CONVERSIONS_TXT)
+	opts, args = texdown.parse_args(['-b', os.path.join(tmp, 'missing'), '--draft'])
+	output = texdown.Converter([texdown2html.Macros], opts)(text)
+	assert '<div class="placeholder">table: 101&times;2</div>\n\\caption{\\label{table.squares} Squares}' in output, output
+	assert '<div class="placeholder">floatcode: 101 lines</div>\n\\caption{\\label{code.long} Long}' in output, output
+	assert 'short\ncode' in output and '99\t9801' not in output, output
+	assert '<h2' in output and 'sec.results' in output, output
+
+	# An empty table, or an empty placeholder.
+	import texdown2latex
+	for module, size in ((texdown2html, '0&times;0'), (texdown2latex, '0$\\times$0')):
+		texdown.update_conversions(texdown.CONVERSIONS, module.CONVERSIONS_TXT)
+		output = texdown.Converter([module.Macros], opts)('\t\t!!floattable\n\n\t\t!!placeholder\n')
+		assert 'table: ' + size in output, output
+
+def check_paged_tables(tmp):
+	" Tables longer than --table-page-rows show their first page, the rest going in JSON sidecars. "
+	import json
+	rows = ''.join('\t%d\t%d\n' % (idx, idx * idx) for idx in range(2500))
+	text = '\tN\tSquare\t!!floattable\n' + rows + '\t~~ <<table.squares>> Squares ~~\n'
+	texdown.update_conversions(texdown.CONVERSIONS, texdown2html.CONVERSIONS_TXT)
+	opts, args = texdown.parse_args(['-b', os.path.join(tmp, 'missing')])
+	converter = texdown.Converter([texdown2html.Macros], opts)
+	output = converter(text)
+	assert 'class="texdown-paged" data-rows="2500" data-page="100" data-chunk="1000"' in output, output
+	assert '<tr><td>99</td><td>9801</td></tr>' in output and '<td>100</td><td>10000</td>' not in output, output
+	assert 'table.squares' in output, output
+	chunks = sorted(name for name in converter.sidecars if name.endswith('.json'))
+	assert len(chunks) == 3 and 'table.js' in converter.sidecars, chunks
+	loaded = sum((json.loads(converter.sidecars[name]) for name in chunks), [])
+	assert loaded[0] == ['100', '10000'] and loaded[-1] == ['2499', '6245001'] and len(loaded) == 2400, loaded[:2]
+
+	opts, args = texdown.parse_args(['-b', os.path.join(tmp, 'missing'), '--table-page-rows', '0'])
+	converter = texdown.Converter([texdown2html.Macros], opts)
+	output = converter(text)
+	assert 'texdown-paged' not in output and '6245001' in output and not converter.sidecars, output[:200]
+
+	# Preview has nowhere to put the rows.
+	opts, args = texdown.parse_args(['-b', os.path.join(tmp, 'missing'), '--preview'])
+	converter = texdown.Converter([texdown2html.Macros], opts)
+	output = converter(text)
+	assert 'texdown-paged' not in output and '6245001' in output and not converter.sidecars, output[:200]
+
+def check_listings(tmp):
+	" !!listing shows a range of a file's lines, reusing the open file until it changes. "
+	import listings
+	path = os.path.join(tmp, 'code.py')
+	with open(path, 'w') as handle:
+		handle.write(''.join('line %d\tx = a_b\n' % (idx) for idx in range(1, 301)))
+	text = '!!listing %s, 120-122, <<code.middle>> The middle\n\n!!listing %s, 300-\n' % (path, path)
+	texdown.update_conversions(texdown.CONVERSIONS, texdown2html.CONVERSIONS_TXT)
+	opts, args = texdown.parse_args(['-b', os.path.join(tmp, 'missing')])
+	output = texdown.Converter([texdown2html.Macros], opts)(text)
+	assert '\\begin{verbatim}\nline 120  x = a_b\nline 121  x = a_b\nline 122  x = a_b\n\\end{verbatim}\n' \
+			'\\caption{\\label{code.middle} The middle}' in output, output
+	assert '\\begin{verbatim}\nline 300  x = a_b\n\\end{verbatim}' in output, output
+
+	listing = listings.listing_file(path)
+	assert listings.listing_file(path) is listing
+	assert listings.parse('%s, 7' % (path)) == (path, 7, 7, None)
+	assert listings.parse('%s, Caption, with a comma' % (path)) == (path, 1, None, 'Caption, with a comma')
+	converter = texdown.Converter([texdown2html.Macros], opts)
+	for args in ('%s, 300-301', '%s, 0-2', '%s, 301-', os.path.join(tmp, 'missing.py')):
+		try:
+			listings.read(converter, args.replace('%s', path))
+		except listings.ListingError:
+			pass
+		else:
+			raise AssertionError(args)
+	with open(path, 'a') as handle:
+		handle.write('line 301\n')
+	assert listings.listing_file(path) is not listing
+	assert listings.read(converter, '%s, 301-' % (path)) == ('line 301', None)
+
+def check_corpus_references(tmp):
+	" [document:label] references are resolved from the --corpus index, kept up to date per document. "
+	import corpus
+	path = os.path.join(tmp, 'corpus.db')
+	texdown.update_conversions(texdown.CONVERSIONS, texdown2html.CONVERSIONS_TXT)
+	opts, args = texdown.parse_args(['-b', os.path.join(tmp, 'missing'), '--corpus', path])
+	converter = texdown.Converter([texdown2html.Macros], opts)
+	report = ('== Boilerplate <<sec.boiler>> ==\n\n\tcode\t!!floatcode\n\t~~ <<figure.code>> The code[[Knuth84]] ~~\n\n'
+			+ '!!floatgraphic plots/speed-up, Speed *up*\n\n= Untitled =\n')
+	index = corpus.Corpus(path)
+	report_output = converter(report)
+	index.update('report42', 'html', 'report42.html', report, report_output)
+
+	# Headings are linked to; captions and other labels have no id, so their document is.
+	output = converter('[report42:figure.code], [report42: sec.boiler], [report42:figure.speed.up], '
+			'[report42:sec-untitled], [report42:missing] and [local]\n')
+	assert '<a href="report42.html">The code</a>, <a href="report42.html#sec.boiler">Boilerplate</a>, ' \
+			'<a href="report42.html">Speed <b>up</b></a>, ' \
+			'<a href="report42.html#sec-untitled">Untitled</a>, \\ref{report42:missing} and \\ref{local}' in output, output
+	for anchor in texdown.re.findall(r'href="report42\.html#([^"]*)"', output):
+		assert 'id="%s"' % (anchor) in report_output, anchor
+
+	# The output cache keeps the rows a document's references found, and
+	# only those changing makes it convert the document again.
+	import outputcache
+	cache = outputcache.OutputCache(os.path.join(tmp, 'cache'), 1 << 20, [texdown2html.Macros], opts)
+	text = 'See [report42:sec.boiler] and [report42:missing].\n'
+	cache.put_conversion(cache.document_path(text), converter(text), converter.sidecars, converter.inputs)
+	index.update('report7', 'html', 'report7.html', '== Unrelated ==\n', '')
+	assert cache.get_conversion(cache.document_path(text)) is not None
+	index.update('report42', 'html', 'report42.html', '== Other ==\n', '')
+	assert cache.get_conversion(cache.document_path(text)) is None
+
+	assert index.lookup('report42', 'figure.code', 'html') is None
+	assert index.lookup('report42', 'sec-other', 'html') == ('Other', 'sec-other', 'report42.html')
+	assert index.lookup('report42', 'sec-other', 'latex') == ('Other', 'sec-other', None)
+	index.close()
+
+def check_macro_threads_same_output(tmp):
+	" Macros run in threads give the same output, in the same order. "
+	path = write_bib(tmp)
+	texdown.update_conversions(texdown.CONVERSIONS, texdown2html.CONVERSIONS_TXT)
+	outputs = []
+	for threads in ('0', '3'):
+		opts, args = texdown.parse_args(['-b', path, '--macro-threads', threads])
+		converter = texdown.Converter([texdown2html.Macros], opts)
+		outputs.append(converter(THREADS_DOCUMENT))
+		assert converter.started_macros == {}
+	assert outputs[0] == outputs[1], outputs
+
+class RunawayMacros(object):
+	def __init__(self, converter):
+		pass
+
+	def macro_spin(self, args):
+		while True:
+			pass
+
+	def macro_eat(self, args):
+		return 'x' * (2 ** 33)
+
+def check_worker_limits(tmp):
+	" Runaway documents fail with structured errors; the pool carries on. "
+	import workers
+
+	opts, args = texdown.parse_args(['-b', 'missing'])
+	pool = workers.WorkerPool(texdown2html.CONVERSIONS_TXT, [texdown2html.Macros, RunawayMacros],
+			opts, jobs = 1, timeout = 1, memory_limit = 200)
+	try:
+		results = pool.map(['!!spin\n', 'Fine.\n', '!!eat\n', '== Also fine ==\n'])
+	finally:
+		pool.close()
+	assert isinstance(results[0], workers.ConversionTimeout), results[0]
+	assert isinstance(results[2], workers.ConversionOutOfMemory), results[2]
+	assert results[1][0].strip() == 'Fine.', results[1]
+	assert '<h2 id="sec-also-fine">' in results[3][0], results[3]
+
+def check_archives(tmp):
+	" --outdir reads documents out of tar, zip and .gz files and writes into an archive. "
+	import gzip
+	import io
+	import tarfile
+	import zipfile
+
+	corpus = os.path.join(tmp, 'corpus.tar.gz')
+	with tarfile.open(corpus, 'w:gz') as archive:
+		for name, text in (('docs/a.texdown', '== A ==\n'), ('docs/notes.txt', 'Not a document'),
+				('docs/more/b.texdown', 'Some *bold*.\n')):
+			info = tarfile.TarInfo(name)
+			info.size = len(text)
+			archive.addfile(info, io.BytesIO(text.encode('utf-8')))
+	with gzip.open(os.path.join(tmp, 'c.texdown.gz'), 'wt', encoding = 'utf-8') as handle:
+		handle.write('Gzipped.\n')
+	with open(os.path.join(tmp, 'broken.zip'), 'w') as handle:
+		handle.write('Not a zip file')
+
+	outdir = os.path.join(tmp, 'out.zip')
+	opts, args = texdown.parse_args(['-b', 'missing', '-j', '1', '--outdir', outdir])
+	stdout = sys.stdout
+	sys.stdout = io.StringIO()
+	try:
+		failures = texdown.convert_files('html', texdown2html.CONVERSIONS_TXT, [texdown2html.Macros], opts,
+				[corpus, os.path.join(tmp, 'c.texdown.gz'), os.path.join(tmp, 'broken.zip')])
+		errors = sys.stdout.getvalue()
+	finally:
+		sys.stdout = stdout
+	assert failures == 1 and 'broken.zip' in errors, (failures, errors)
+	with zipfile.ZipFile(outdir) as archive:
+		assert sorted(archive.namelist()) == ['c.html', 'docs/a.html', 'docs/more/b.html'], archive.namelist()
+		assert archive.read('docs/more/b.html').decode('utf-8').strip() == 'Some <b>bold</b>.'
+
+def check_output_cache(tmp):
+	" Documents found in the output cache are written without starting any workers. "
+	import io
+	import outputcache
+	import workers
+
+	paths = []
+	for name, text in (('a.texdown', '== A ==\n\nSome *bold*.\n'), ('b.texdown', 'Plain.\n')):
+		paths.append(os.path.join(tmp, name))
+		with open(paths[-1], 'w', encoding = 'utf-8') as handle:
+			handle.write(text)
+	cache_dir = os.path.join(tmp, 'cache')
+	def convert(outdir, *more):
+		texdown.update_conversions(texdown.CONVERSIONS, texdown2html.CONVERSIONS_TXT)
+		opts, args = texdown.parse_args(['-b', 'missing', '-j', '1', '--search-index',
+				'--output-cache', cache_dir, '--outdir', os.path.join(tmp, outdir)] + list(more))
+		stderr = sys.stderr
+		sys.stderr = io.StringIO()
+		try:
+			assert texdown.convert_files('html', texdown2html.CONVERSIONS_TXT, [texdown2html.Macros], opts, paths) == 0
+			return sys.stderr.getvalue()
+		finally:
+			sys.stderr = stderr
+
+	assert 'output cache: 0 hits, 2 misses' in convert('cold')
+	pool = workers.WorkerPool
+	def no_workers(*args):
+		raise AssertionError('workers started')
+	workers.WorkerPool = no_workers
+	try:
+		assert 'output cache: 2 hits, 0 misses (100% hit rate)' in convert('warm')
+	finally:
+		workers.WorkerPool = pool
+	for name in ('a.html', 'b.html', 'search.json', 'search.js'):
+		with open(os.path.join(tmp, 'cold', name), 'rb') as cold, open(os.path.join(tmp, 'warm', name), 'rb') as warm:
+			assert cold.read() == warm.read(), name
+	assert 'output cache: 0 hits, 2 misses' in convert('other', '--draft')
+
+	# A change to the bibliography is a change to every document.
+	opts, args = texdown.parse_args(['-b', os.path.join(tmp, 'papers')])
+	setup = outputcache.setup_digest([texdown2html.Macros], opts)
+	with open(os.path.join(tmp, 'papers.bib'), 'w') as handle:
+		handle.write('@misc{X, title = {X}}\n')
+	assert outputcache.setup_digest([texdown2html.Macros], opts) != setup
+
+	# An entry is only used while the lines it listed are the same.
+	listed = os.path.join(tmp, 'code.py')
+	with open(listed, 'w') as handle:
+		handle.write('one\ntwo\nthree\n')
+	text = '!!listing %s, 2\n' % (listed)
+	cache = outputcache.OutputCache(cache_dir, 1 << 20, [texdown2html.Macros], opts)
+	converter = texdown.Converter([texdown2html.Macros], opts)
+	cache.put_conversion(cache.document_path(text), converter(text), converter.sidecars, converter.inputs)
+	assert cache.get_conversion(cache.document_path(text))[0] == converter.output
+	with open(listed, 'w') as handle:
+		handle.write('one, longer\ntwo\nthree\n')
+	assert cache.get_conversion(cache.document_path(text)) is not None
+	with open(listed, 'w') as handle:
+		handle.write('one\nTWO\nthree\n')
+	assert cache.get_conversion(cache.document_path(text)) is None
+
+def main():
+	checks = [(name, func) for name, func in sorted(globals().items()) if name.startswith('check_')]
+	failures = 0
+	for name, func in checks:
+		tmp = tempfile.mkdtemp()
+		try:
+			func(tmp)
+		except Exception:
+			failures += 1
+			print("FAIL %s" % (name))
+			traceback.print_exc()
+		else:
+			print("ok   %s" % (name))
+		finally:
+			shutil.rmtree(tmp)
+	sys.exit(1 if failures else 0)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,167 @@
+# vim: set fileencoding=utf-8 :
+"""
+Paged HTML tables, for tables too long to put in a page whole.
+
+A table with more rows than --table-page-rows (default 100) is written as
+an HTML table holding its header and first page of rows. The rest go in
+sidecar files of CHUNK_ROWS rows each, as JSON lists of rows of cells:
+
+	<table class="texdown-paged" data-rows="50000" data-page="100"
+			data-chunk="1000" data-src="table-3f2a9c41d0e7">
+	...
+	table-3f2a9c41d0e7.0.json: [["<b>101</b>","7.5"],["102","7.9"],...]
+
+The files are named by a hash of the table, so tables in several documents
+written to one directory don't overwrite each other. table.js adds buttons
+to go from page to page, fetching each file the first time one of its rows
+is shown (and the next one once the buttons are in view), and sorts the
+rows fetched so far when a column heading is clicked.
+Preview, which serves no sidecars, shows every table whole.
+"""
+
+import hashlib
+import html
+import json
+
+CHUNK_ROWS = 1000
+
+def to_json(rows):
+	return json.dumps(rows, ensure_ascii = False, separators = (',', ':'))
+
+def render(header, rows, page_rows):
+	"""
+	(HTML, sidecars) for the table with the header and rows, lists of cells
+	already converted to HTML.
+	"""
+	chunks = [to_json(rows[start:start + CHUNK_ROWS]) for start in range(page_rows, len(rows), CHUNK_ROWS)]
+	hasher = hashlib.sha256(to_json([header, rows[:page_rows]]).encode('utf-8'))
+	for chunk in chunks:
+		hasher.update(chunk.encode('utf-8'))
+	name = 'table-' + hasher.hexdigest()[:12]
+	sidecars = {'table.js': TABLE_JS}
+	for number, chunk in enumerate(chunks):
+		sidecars['%s.%d.json' % (name, number)] = chunk
+
+	result = ['<table class="texdown-paged" data-rows="%d" data-page="%d" data-chunk="%d" data-src="%s">\n' \
+			% (len(rows), page_rows, CHUNK_ROWS, html.escape(name))]
+	result.append('<thead><tr>%s</tr></thead>\n' % (''.join('<th>%s</th>' % (cell) for cell in header)))
+	result.append('<tbody>\n')
+	for row in rows[:page_rows]:
+		result.append('<tr>%s</tr>\n' % (''.join('<td>%s</td>' % (cell) for cell in row)))
+	result.append('</tbody>\n</table>\n')
+	return ''.join(result), sidecars
+
+TABLE_JS = r"""// Texdown paged tables: fetches rows past the first page as they're needed.
+(function () {
+	function Table(table) {
+		var data = table.dataset, self = this;
+		this.table = table;
+		this.body = table.tBodies[0];
+		this.total = parseInt(data.rows, 10);
+		this.size = parseInt(data.page, 10);
+		this.chunk = parseInt(data.chunk, 10);
+		this.src = data.src;
+		this.rows = Array.prototype.map.call(this.body.rows, function (row) {
+			return Array.prototype.map.call(row.cells, function (cell) { return cell.innerHTML; });
+		});
+		this.fetched = {};
+		this.page = 0;
+		this.sorted = null; // Rows fetched so far, in order of a column
+
+		var nav = document.createElement('nav');
+		nav.className = 'texdown-pager';
+		nav.innerHTML = '<button type="button">&lsaquo;</button> <span></span> <button type="button">&rsaquo;</button>';
+		table.parentNode.insertBefore(nav, table.nextSibling);
+		this.label = nav.querySelector('span');
+		var buttons = nav.querySelectorAll('button');
+		buttons[0].addEventListener('click', function () { self.show(self.page - 1); });
+		buttons[1].addEventListener('click', function () { self.show(self.page + 1); });
+		if (window.IntersectionObserver) {
+			new IntersectionObserver(function (entries) {
+				if (entries[0].isIntersecting)
+					self.fetch((self.page + 1) * self.size);
+			}).observe(nav);
+		}
+		Array.prototype.forEach.call(table.tHead.rows[0].cells, function (cell, column) {
+			cell.style.cursor = 'pointer';
+			cell.addEventListener('click', function () { self.sort(column); });
+		});
+		this.label.textContent = this.describe();
+	}
+
+	Table.prototype.fetch = function (row) {
+		// The chunk holding row, fetched once.
+		var number = Math.floor((row - this.size) / this.chunk), self = this;
+		if (row < this.size || row >= this.total)
+			return Promise.resolve();
+		if (!this.fetched[number]) {
+			this.fetched[number] = fetch(this.src + '.' + number + '.json').then(function (response) {
+				return response.json();
+			}).then(function (rows) {
+				var start = self.size + number * self.chunk;
+				for (var i = 0; i < rows.length; i++)
+					self.rows[start + i] = rows[i];
+				if (self.sorted)
+					self.sort(self.sorted.column, true);
+			});
+		}
+		return this.fetched[number];
+	};
+
+	Table.prototype.show = function (page) {
+		var self = this, start = page * this.size, pages = Math.ceil(this.total / this.size);
+		if (page < 0 || page >= pages)
+			return;
+		var end = Math.min(start + this.size, this.total);
+		Promise.all([this.fetch(start), this.fetch(end - 1)]).then(function () {
+			self.page = page;
+			self.render(start, end);
+		});
+	};
+
+	Table.prototype.render = function (start, end) {
+		var rows = this.sorted ? this.sorted.rows : this.rows, out = [];
+		for (var i = start; i < end && i < rows.length; i++) {
+			if (rows[i])
+				out.push('<tr><td>' + rows[i].join('</td><td>') + '</td></tr>');
+		}
+		this.body.innerHTML = out.join('');
+		this.label.textContent = this.describe();
+	};
+
+	Table.prototype.describe = function () {
+		var start = this.page * this.size;
+		var text = (start + 1) + '–' + Math.min(start + this.size, this.total) + ' of ' + this.total;
+		if (this.sorted && this.sorted.rows.length < this.total)
+			text += ' (sorted: the ' + this.sorted.rows.length + ' rows fetched so far)';
+		return text;
+	};
+
+	function key(cell) {
+		var text = cell.replace(/<[^>]*>/g, '').trim(), number = parseFloat(text);
+		return isNaN(number) || !/^[-+]?[\d.,]+(e[-+]?\d+)?%?$/i.test(text) ? text : number;
+	}
+
+	Table.prototype.sort = function (column, keep) {
+		// A second click on a column reverses the order.
+		var descending = false;
+		if (this.sorted && this.sorted.column === column)
+			descending = keep ? this.sorted.descending : !this.sorted.descending;
+		var keyed = this.rows.filter(Boolean).map(function (row) { return [key(row[column]), row]; });
+		keyed.sort(function (a, b) {
+			var order = typeof a[0] === typeof b[0] ? (a[0] < b[0] ? -1 : a[0] > b[0] ? 1 : 0)
+					: (typeof a[0] === 'number' ? -1 : 1);
+			return descending ? -order : order;
+		});
+		this.sorted = {column: column, descending: descending, rows: keyed.map(function (pair) { return pair[1]; })};
+		if (!keep)
+			this.page = 0;
+		var start = this.page * this.size;
+		this.render(start, start + this.size);
+	};
+
+	Array.prototype.forEach.call(document.querySelectorAll('table.texdown-paged'), function (table) {
+		new Table(table);
+	});
+})();
+"""
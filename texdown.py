@@ -3,8 +3,17 @@
 
 import os
 import re
+import bisect
 import sys
 import codecs
+import collections
+
+try:
+	import re._parser as sre_parse
+	import re._constants as sre_constants
+except ImportError: # Python < 3.11
+	import sre_parse
+	import sre_constants
 
 """
 Convert Texdown syntax to iother formats.
@@ -61,19 +70,19 @@ chapterstar:
 	match	^##\*(.*)##
 	incl	label
 chapter:
-	match	^## *(.*) *##
+	match	^## *(?! )(.*)##
 	incl	label
 section:
-	match	^== *(.*) *==
+	match	^== *(?! )(.*)==
 	incl	label escape_underscores escape_percents teletype
 usenixabstract:
-	match	^\^ *(.*) *\^
+	match	^\^ *(?! )(.*)\^
 	incl	label escape_underscores escape_percents teletype
 subsection:
-	match	^= *(.*) *=
+	match	^= *(?! )(.*)=
 	incl	label escape_underscores escape_percents teletype
 subsubsection:
-	match	^- *(.*) *-
+	match	^- *(?! )(.*)-
 	incl	label escape_underscores escape_percents teletype
 label:
 	match	<<([^<]*)>>
@@ -82,8 +91,9 @@ caption:
 	incl	label cite
 url:
 	match	\(\((.*?)\)\)
+	finder	url
 cite:
-	match	 *\[\[([^\[]*)\]\]
+	match	(?<! ) *\[\[([^\[]*)\]\]
 cite_fixme:
 	match	\[\[FIXME\]\]
 teletype:
@@ -93,6 +103,7 @@ ref:
 	match	\[([^\[]*)\]
 italics:
 	match	([^A-Za-z]|^)/([^ ].+?[^ ])/([^A-Za-z]|$)
+	finder	italics
 bold:
 	match	\*([^\*]+)\*
 subscript:
@@ -107,6 +118,145 @@ escape_percents:
 escape_ampersands:
 	match	&
 """
+
+# Every rule also has a list of literal strings ("needs") which must all be
+# present in a piece of text for the rule to match it. They are worked out
+# from the regular expression, or can be given explicitly as a space-separated
+# list, e.g. "needs	[[ ]]". An empty "needs" line disables the check.
+def literal_runs(subpattern):
+	" Literal strings which any match of the parsed subpattern must contain. "
+	runs = []
+	run = ''
+	for op, av in subpattern:
+		if op is sre_constants.LITERAL:
+			run += chr(av)
+			continue
+		if run:
+			runs.append(run)
+			run = ''
+		if op is sre_constants.SUBPATTERN:
+			# (?i:...) matches other cases than its literals.
+			if len(av) < 4 or not av[1] & re.IGNORECASE:
+				runs.extend(literal_runs(av[-1]))
+		elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT) and av[0] >= 1:
+			runs.extend(literal_runs(av[2]))
+	if run:
+		runs.append(run)
+	return runs
+
+def required_literals(pattern):
+	if pattern.flags & re.IGNORECASE:
+		return []
+
+	needs = []
+	for run in literal_runs(sre_parse.parse(pattern.pattern, pattern.flags)):
+		if run not in needs:
+			needs.append(run)
+	return needs
+
+# Every rule's matches must be found in time proportional to the length of
+# the text, whatever the text, since documents come from users. Where the
+# regular expression engine would keep searching to the end of a line from
+# each place a rule might start, the rule names a "finder": a function which
+# returns the same matches as match.finditer(text), only faster, e.g.
+# "finder	italics". A rule given a new "match" loses its finder.
+def line_finder(start):
+	"""
+	A finder for rules which can only start where the regular expression
+	start matches, and which, if they can't match at one such place on a
+	line, can't match further along that line either. (E.g. a URL with no
+	closing "))".) The rest of the line is skipped after the first failure.
+	"""
+	starts = {str: re.compile(start), bytes: re.compile(start.encode('ascii'))}
+	def finditer(pattern, text):
+		start = starts[type(text)]
+		newline = b'\n' if isinstance(text, bytes) else '\n'
+		pos = 0
+		while True:
+			candidate = start.search(text, pos)
+			if candidate is None:
+				return
+			match = pattern.match(text, candidate.start())
+			if match:
+				yield match
+				pos = match.end()
+			else:
+				pos = text.find(newline, candidate.start()) + 1
+				if not pos:
+					return
+	return finditer
+
+SLASH = re.compile('/')
+NEWLINE = re.compile('\n')
+ASCII_LETTERS = frozenset('ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz')
+# What find_italics() looks for, in text and in UTF-8 bytes (see utf8rules.py).
+ITALICS_CONSTANTS = {
+	str: (SLASH, NEWLINE, '/', '\n', ' ', ASCII_LETTERS),
+	bytes: (re.compile(b'/'), re.compile(b'\n'), b'/', b'\n', b' ',
+			frozenset(letter.encode('ascii') for letter in ASCII_LETTERS)),
+}
+
+def find_italics(pattern, text):
+	"""
+	Finder for italics: ([^A-Za-z]|^)/([^ ].+?[^ ])/([^A-Za-z]|$).
+	Rather than searching for a closing "/" from every opening one, the
+	places where italics could close are listed once, and each opening "/"
+	is looked up in that list. The pattern is only run where it will match.
+	Over UTF-8 bytes, offsets count bytes, so the distances checked here are
+	at least those in characters: a few more places may be tried, no fewer.
+	"""
+	slash_re, newline_re, slash_char, newline, space, letters = ITALICS_CONSTANTS[type(text)]
+	utf8 = isinstance(text, bytes)
+	length = len(text)
+	slashes = [match.start() for match in slash_re.finditer(text)]
+	newlines = [match.start() for match in newline_re.finditer(text)]
+	# A closing "/" is at least four characters after the opening one, after
+	# something other than a space, and before a non-letter or the end.
+	closes = [idx for idx in slashes if idx >= 4 and text[idx - 1:idx] != space \
+			and text[idx + 1:idx + 2] not in letters]
+
+	def closed(opening):
+		" Is there a close for the italics opened by the '/' at opening? "
+		if text[opening + 1:opening + 2] in (text[:0], space):
+			return False
+		# The text in between, apart from its first and last characters,
+		# is all on one line.
+		idx = bisect.bisect_left(newlines, opening + 2)
+		last = newlines[idx] + 1 if idx < len(newlines) else length
+		idx = bisect.bisect_left(closes, opening + 4)
+		return idx < len(closes) and closes[idx] <= last
+
+	def may_match(start, after):
+		" after is where the character at start ends. "
+		if text[after:after + 1] == slash_char and text[start:after] not in letters \
+				and closed(after):
+			return True
+		return text[start:start + 1] == slash_char and (start == 0 or text[start - 1:start] == newline) \
+				and closed(start)
+
+	pos = 0
+	tried = -1
+	for slash in slashes:
+		# Matches start on the character before an opening "/", or on it
+		# at a line start.
+		before = slash - 1
+		while utf8 and before > 0 and text[before] & 0xC0 == 0x80:
+			before -= 1
+		for start, after in ((before, slash), (slash, slash + 1)):
+			if start < pos or start <= tried:
+				continue
+			tried = start
+			if may_match(start, after):
+				match = pattern.match(text, start)
+				if match:
+					yield match
+					pos = match.end()
+
+FINDERS = {
+	'italics': find_italics,
+	'url': line_finder(r'\(\('),
+}
+
 def extract_conversions(conversions_txt):
 	conversions = {}
 	conversions_order = []
@@ -120,35 +270,271 @@ def extract_conversions(conversions_txt):
 			key, value = line[1:].split('\t', 1)
 			if key == 'match':
 				value = re.compile(value, re.MULTILINE)
-			elif key == 'incl':
+			elif key in ('incl', 'inside'):
 				value = value.split(' ')
+			elif key == 'finder':
+				value = FINDERS[value]
+			elif key == 'needs':
+				value = [codecs.decode(literal, 'unicode_escape') for literal in value.split(' ') if literal]
 			conversions[hlname][key] = value
 		else:
+			if not line.endswith(':'):
+				raise ConversionError("rule name without a colon: %s" % (line))
 			hlname = line[:-1]
 			conversions[hlname] = {}
 			conversions_order.append(hlname)
+
+	for conv in conversions.values():
+		if 'match' in conv and 'needs' not in conv:
+			conv['needs'] = required_literals(conv['match'])
 	
 	return conversions, conversions_order
 
 CONVERSIONS, CONVERSIONS_ORDER = extract_conversions(CONVERSIONS_TXT)
 
+# Bumped whenever the rules change, so cached conversions aren't reused.
+CONVERSIONS_GENERATION = 0
+
+# The rules as bytes patterns, (generation, rules), see byte_conversions().
+BYTE_CONVERSIONS = (None, None)
+
+def byte_conversions():
+	"""
+	CONVERSIONS with bytes patterns, for converting UTF-8 without decoding
+	it, or None if some rule can't run over bytes.
+	"""
+	global BYTE_CONVERSIONS
+	generation, conversions = BYTE_CONVERSIONS
+	if generation != CONVERSIONS_GENERATION:
+		import utf8rules
+		conversions = utf8rules.byte_conversions(CONVERSIONS)
+		BYTE_CONVERSIONS = (CONVERSIONS_GENERATION, conversions)
+	return conversions
+
+# A pattern for any of the rules' "witness" characters, (generation,
+# {str: pattern, bytes: pattern}), see witnesses().
+WITNESSES = (None, None)
+
+def witnesses(text_type = str):
+	"""
+	A compiled character class holding one character from one of each
+	rule's needs. No rule can match text in which it finds nothing (as in
+	most table cells, and the words between markup), which is quicker to
+	see than that no rule's needs are all there. None if a rule has no
+	needs. Common characters (letters, spaces...) are avoided.
+	"""
+	global WITNESSES
+	generation, patterns = WITNESSES
+	if generation != CONVERSIONS_GENERATION:
+		chosen = []
+		rules = [conv for conv in CONVERSIONS.values() if 'match' in conv]
+		for conv in sorted(rules, key = lambda conv: len(set(''.join(conv['needs'])))):
+			characters = ''.join(conv['needs'])
+			if not characters:
+				chosen = None
+				break
+			for preferred in (chosen, [char for char in characters if not (char.isalnum() or char in ' .,')]):
+				witness = next((char for char in characters if char in preferred), None)
+				if witness is not None:
+					break
+			else:
+				witness = characters[0]
+			if witness not in chosen:
+				chosen.append(witness)
+		patterns = {}
+		if chosen is not None:
+			patterns[str] = re.compile('[%s]' % (''.join(re.escape(char) for char in chosen)))
+			if all(ord(char) < 128 for char in chosen):
+				patterns[bytes] = re.compile(patterns[str].pattern.encode('ascii'))
+		WITNESSES = (CONVERSIONS_GENERATION, patterns)
+	return patterns.get(text_type)
+
 def update_conversions(conversions, more_conversions_txt):
-	" Update conversions dict with values from matching keys in more_conversions_txt. "
+	"""
+	Update conversions dict with values from matching keys in
+	more_conversions_txt. New rules are added with add_conversions().
+	"""
+	global CONVERSIONS_GENERATION
+	CONVERSIONS_GENERATION += 1
 
 	extra, more_conversions_order = extract_conversions(more_conversions_txt)
 
 	for extra_name, extra_dict in extra.items():
 		if extra_name in conversions:
+			if 'match' in extra_dict and 'finder' not in extra_dict:
+				conversions[extra_name].pop('finder', None)
 			conversions[extra_name].update(extra_dict)
+		else:
+			sys.stderr.write("Warning: no rule '%s' to update; new rules need add_conversions()\n" % (extra_name))
+
+# Where add_conversions() puts a rule.
+PLACEMENT_KEYS = ('before', 'after', 'inside')
+
+def add_conversions(more_conversions_txt):
+	"""
+	Add the rules in more_conversions_txt, e.g. from a local macros module:
+
+		texdown.add_conversions(r'''
+		keys:
+			match	\\{\\{(.+?)\\}\\}
+			func	keys
+			before	bold
+			inside	bullets numbers
+		''')
+
+	"before" or "after" a rule runs the new one over the document just
+	before or after it; "inside" rules adds it to their "incl" lists, next
+	to the before or after rule if they include it, or else last. A rule
+	with none of these runs over the document after all the others. Adding
+	a rule again replaces it.
+
+	Text without a character an added rule needs skips it along with the
+	rest (see witnesses()), and text without one of its needs skips it
+	alone. Otherwise each added rule is a regex pass of its own, as each
+	built-in one is: rules are not combined into one scan, which would
+	change which of two overlapping matches wins. Twelve added rules, three
+	of them used, make bench.py's document about 10% slower.
+	"""
+	global CONVERSIONS_GENERATION
+	CONVERSIONS_GENERATION += 1
+
+	added, added_order = extract_conversions(more_conversions_txt)
+	for name in added_order:
+		conv = added[name]
+		placement = dict((key, conv.pop(key)) for key in PLACEMENT_KEYS if key in conv)
+		if 'match' not in conv or not ('repl' in conv or 'func' in conv):
+			raise ConversionError("rule '%s' needs a match, and a repl or func" % (name))
+		if 'before' in placement and 'after' in placement:
+			raise ConversionError("rule '%s' can't go both before and after other rules" % (name))
+		anchor = placement.get('before', placement.get('after'))
+		for other in [anchor] + placement.get('inside', []) + conv.get('incl', []):
+			if other is not None and (other == name or other not in CONVERSIONS):
+				raise ConversionError("rule '%s' refers to unknown rule '%s'" % (name, other))
+
+		# Take out the rule being replaced.
+		if name in CONVERSIONS_ORDER:
+			CONVERSIONS_ORDER.remove(name)
+		for other in CONVERSIONS.values():
+			if name in other.get('incl', ()):
+				other['incl'] = [incl for incl in other['incl'] if incl != name]
+		CONVERSIONS[name] = conv
+
+		def place(names):
+			" Put name into the list names, by the anchor if it's there. "
+			if anchor in names:
+				names.insert(names.index(anchor) + ('after' in placement), name)
+			else:
+				names.append(name)
+
+		if anchor is not None or 'inside' not in placement:
+			place(CONVERSIONS_ORDER)
+		for other in placement.get('inside', []):
+			place(CONVERSIONS[other].setdefault('incl', []))
+
+class Chunks(list):
+	"""
+	Converted text, as a list of strings. Rules produce lots of short
+	strings; every so often the ones added since the last time are joined
+	into one, which keeps the per-string overhead down. A listener, if
+	set, sees each joined piece: all of the output, in order, once.
+	"""
+	coalesce_after = 256
+	mark = 0
+	empty = ''
+	listener = None
+
+	def coalesce(self):
+		joined = self.empty.join(self[self.mark:])
+		if self.listener is not None:
+			self.listener(joined)
+		self[self.mark:] = [joined]
+		self.mark = len(self)
+
+class ByteChunks(Chunks):
+	" Converted UTF-8, as a list of bytes. "
+	empty = b''
+
+def several_characters(data, start, end):
+	" Does data[start:end], in UTF-8, hold more than one character? "
+	return end - start > 4 or sum(1 for byte in data[start:end] if byte & 0xC0 != 0x80) > 1
 
 class ConversionError(Exception):
 	pass
 
+TABS = re.compile(r'\t+') # Between a table's cells
+
+def split_caption(block_lines):
+	" (lines, caption): a block's lines without its final ~~ caption ~~ line, and that line or None. "
+	if block_lines and block_lines[-1].startswith('~~'):
+		return block_lines[:-1], block_lines[-1]
+	return block_lines, None
+
+def table_size(lines):
+	" (rows, columns) of a table's tab-separated lines. "
+	return len(lines), max([len(TABS.split(line)) for line in lines] or [0])
+
+def side_effects(func):
+	"""
+	Decorator for macros whose result depends on, or changes, state beyond
+	their arguments (e.g. the \\enumerate depth). Fragment conversions which
+	call such a macro are never cached.
+	"""
+	func.side_effects = True
+	return func
+
+def concurrent_safe(func):
+	"""
+	Decorator for line or block macros which may be run in another thread,
+	while the document is being converted: their output depends only on
+	their arguments (or block lines), and they don't touch the converter or
+	anything else shared. With --macro-threads they are started as soon as
+	the document is read, and their results used in document order.
+	"""
+	func.concurrent_safe = True
+	return func
+
+def pure(version = ''):
+	"""
+	Decorator for slow line or block macros whose output depends only on
+	their arguments (or block lines), e.g. ones which run a plotting script:
+	their output is kept in the macro cache (see macrocache.py) and reused.
+	Give a new version whenever the macro's output changes:
+
+		@texdown.pure('2')
+		def macro_plot(self, args):
+
+	Plain @texdown.pure is version ''.
+	"""
+	if callable(version):
+		version.pure = ''
+		return version
+	def mark(func):
+		func.pure = version
+		return func
+	return mark
+
 class Converter(object):
-	def __init__(self, macro_classes):
-		self.block_cmd = None
-		self.block_accum = []
+	# Skip rules whose required literals are absent. Only worth turning
+	# off to measure what it saves.
+	prefilter = True
+
+	def __init__(self, macro_classes, opts = None):
+		if opts is None:
+			opts, args = parse_args([])
+		self.opts = opts
+		self.stats = {'finditer': 0, 'prefilter_skips': 0,
+				'fragment_cache_hits': 0, 'fragment_cache_misses': 0}
+		self.fragment_cache = collections.OrderedDict()
+		self.side_effects = False
 		self.macros = {}
+		self.drafts = {} # name -> draft_<name>() placeholder, for --draft
+		self.macro_objects = []
+		self.macro_cache = None
+		self.macro_threads = None
+		self.corpus = None # See corpus_target()
+		self.source = ''
+		self.source_bytes = None
+		self.reset()
 
 		self.register_macros(self)
 		if localmacros is not None:
@@ -158,36 +544,261 @@ class Converter(object):
 			self.register_macros(cls(self))
 
 	def __call__(self, texdown):
-		self.reset()
-		self.output = self.convert(texdown, magic = True)
+		self.output = ''.join(self.convert_document(texdown))
 		return self.output
 
+	def convert_document(self, texdown):
+		"""
+		Convert a whole document, returning the output as a list of chunks
+		(to join, or to pass to a file's writelines()).
+		"""
+		self.reset()
+		self.source = texdown # The whole document, e.g. for its outline
+		return self.convert_source(texdown)
+
+	def convert_document_bytes(self, data):
+		"""
+		Convert a whole document given as UTF-8, returning the output as a
+		list of UTF-8 chunks: the same as convert_document()'s, encoded. The
+		rules run over the bytes themselves (see utf8rules.py) unless one of
+		them can't. Raises UnicodeDecodeError if data isn't UTF-8.
+		"""
+		import utf8rules
+		utf8rules.valid_utf8(data)
+		if byte_conversions() is None:
+			return [chunk.encode('utf-8') for chunk in self.convert_document(data.decode('utf-8'))]
+		self.reset()
+		self.source = None # Decoded if a macro wants it
+		self.source_bytes = data
+		return self.convert_source(data)
+
+	@property
+	def source(self):
+		" The whole document being converted, e.g. for its outline. "
+		if self.decoded_source is None:
+			self.decoded_source = self.source_bytes.decode('utf-8')
+		return self.decoded_source
+
+	@source.setter
+	def source(self, texdown):
+		self.decoded_source = texdown
+		self.source_bytes = None
+
+	def convert_source(self, texdown):
+		if self.opts.macro_threads:
+			self.start_macros(self.source)
+		try:
+			return self.convert_chunks(texdown, magic = True)
+		finally:
+			for futures in self.started_macros.values():
+				for future in futures:
+					future.cancel()
+			self.started_macros = {}
+
 	def reset(self):
+		" Start a new document. Macro objects with a reset() method are reset too. "
 		self.enum_depth = 0 # Keep track, so we can set the counter in \enumerate
+		self.fragment_cache.clear()
+		self.sidecars = {} # Files to write next to the output: name -> text
+		self.started_macros = {} # (name, args) -> [Future], see start_macros()
+		self.output_listener = None # Sees the document's output, see Chunks
+		self.inputs = {} # (kind, key) -> value, see note_input()
+		# A document which failed inside a block leaves its lines behind.
+		self.block_cmd = None
+		self.block_accum = []
+		for obj in self.macro_objects:
+			if hasattr(obj, 'reset'):
+				obj.reset()
 	
 	def register_macros(self, obj):
+		if obj is not self:
+			self.macro_objects.append(obj)
 		for key in dir(obj):
 			if key.startswith('macro_'):
-				self.macros[key[6:]] = getattr(obj, key)
+				handler = getattr(obj, key)
+				if hasattr(handler, 'pure') and self.opts.macro_cache_size:
+					handler = self.get_macro_cache().wrap(key[6:], handler)
+				self.macros[key[6:]] = handler
+			elif key.startswith('draft_'):
+				self.drafts[key[6:]] = getattr(obj, key)
+
+	def get_macro_cache(self):
+		if self.macro_cache is None:
+			import macrocache
+			self.macro_cache = macrocache.MacroCache(self.opts.macro_cache,
+					self.opts.macro_cache_size * 1024 * 1024)
+		return self.macro_cache
+
+	def note_input(self, kind, key, value):
+		"""
+		Note something a macro read from outside the document, e.g. lines of
+		a listed file: kind and key (a tuple) say what, and value is what it
+		was (as JSON), or a hash of it. The output cache only reuses the
+		output while each is still the same (see outputcache.py).
+		"""
+		self.inputs[(kind, key)] = value
+
+	def corpus_target(self, reference, backend):
+		"""
+		(title, anchor, location) for a [document:label] reference, from the
+		--corpus index (see corpus.py). None if it isn't one, or there's no
+		index; a warning if it isn't found.
+		"""
+		if not self.opts.corpus or ':' not in reference:
+			return None
+		if self.corpus is None:
+			import corpus
+			self.corpus = corpus.Corpus(self.opts.corpus)
+		document, label = [part.strip() for part in reference.split(':', 1)]
+		target = self.corpus.lookup(document, label, backend)
+		self.note_input('corpus', (document, label, backend), list(target) if target is not None else None)
+		if target is None:
+			sys.stderr.write("Warning: [%s] is not in the corpus index %s\n" % (reference, self.opts.corpus))
+		return target
+
+	def start_macros(self, texdown):
+		"""
+		Start every concurrent_safe line or block macro call in the document
+		in a thread. call_macro() then picks up the results in document order,
+		so everything done with them afterwards (e.g. captions' citations) is
+		still done in order. Calls found here that the conversion doesn't make
+		(and vice versa) cost time but change nothing.
+		"""
+		if self.macro_threads is None:
+			from concurrent.futures import ThreadPoolExecutor
+			self.macro_threads = ThreadPoolExecutor(max_workers = self.opts.macro_threads)
+
+		def start(name, args):
+			if self.draft_renderer(name, args) is not None:
+				return
+			handler = self.macros.get(name)
+			if getattr(handler, 'concurrent_safe', False) and not getattr(handler, 'side_effects', False):
+				key = (name, tuple(args) if isinstance(args, list) else args)
+				future = self.macro_threads.submit(handler, list(args) if isinstance(args, list) else args)
+				self.started_macros.setdefault(key, []).append(future)
+
+		# Blocks, as macro_block_cmd() puts them together.
+		lines = []
+		name = None
+		prev_end = None
+		matches = list(CONVERSIONS['block_cmd']['match'].finditer(texdown))
+		for idx, match in enumerate(matches):
+			line = match.group(1)
+			if prev_end is None or match.start() - 1 > prev_end:
+				if '\t!!' not in line:
+					break # An error, once the conversion gets here.
+				line, name = line.rsplit('\t!!', 1)
+				lines = []
+			if line.strip():
+				lines.append(line)
+			if idx + 1 == len(matches) or match.end() + 1 < matches[idx + 1].start():
+				start(name, lines)
+			prev_end = match.end()
+
+		for match in CONVERSIONS['startline_cmd']['match'].finditer(texdown):
+			start(match.group(1), match.group(2))
+
+	def draft_renderer(self, name, args):
+		"""
+		With --draft, what to call instead of the line or block macro name:
+		its draft_<name>() if it has one, or for blocks of more than
+		--draft-lines lines, the backend's placeholder macro (keeping the
+		caption, and so the label). None to call the macro itself. Macros
+		with side effects are always called.
+		"""
+		if not self.opts.draft:
+			return None
+		if name in self.drafts:
+			return self.drafts[name]
+		handler = self.macros.get(name)
+		if isinstance(args, list) and len(args) > self.opts.draft_lines and 'placeholder' in self.macros \
+				and name != 'placeholder' and not getattr(handler, 'side_effects', False):
+			def placeholder(lines):
+				lines, caption = split_caption(lines)
+				return self.macros['placeholder'](['%s: %d lines' % (name, len(lines))] + ([caption] if caption else []))
+			return placeholder
+		return None
+
+	def call_macro(self, name, handler, args):
+		" Call a line or block macro, or take its result if start_macros() started it. "
+		renderer = self.draft_renderer(name, args)
+		if renderer is not None:
+			return renderer(args)
+		futures = self.started_macros.get((name, tuple(args) if isinstance(args, list) else args))
+		if futures:
+			return futures.pop(0).result()
+		return handler(args)
+
+	def note_handler(self, handler):
+		" Called before every macro call, to notice macros with side effects. "
+		if getattr(handler, 'side_effects', False):
+			self.side_effects = True
 
 	def convert(self, texdown, magic = False, fragment = False):
 		"""
-		Conversion:
-			Text is list of (chunk, names of conversions for this chunk),
-			conceptually. Do a depth-first conversion and join up a
-			complete text block in reality.
+		Fragment conversions (short strings converted by macros, such as
+		table cells) repeat a lot, so they are kept in a small LRU cache
+		unless converting them called a macro with side effects.
 		"""
+		if not fragment or not self.opts.fragment_cache:
+			return self.convert_uncached(texdown, magic, fragment)
+
+		key = (texdown, magic, CONVERSIONS_GENERATION)
+		try:
+			result = self.fragment_cache[key]
+		except KeyError:
+			pass
+		else:
+			self.fragment_cache.move_to_end(key)
+			self.stats['fragment_cache_hits'] += 1
+			return result
+
+		self.stats['fragment_cache_misses'] += 1
+		outer_side_effects = self.side_effects
+		self.side_effects = False
+		try:
+			result = self.convert_uncached(texdown, magic, fragment)
+			if not self.side_effects:
+				self.fragment_cache[key] = result
+				if len(self.fragment_cache) > self.opts.fragment_cache:
+					self.fragment_cache.popitem(last = False)
+		finally:
+			self.side_effects = self.side_effects or outer_side_effects
+		return result
+
+	def convert_uncached(self, texdown, magic = False, fragment = False):
 		if fragment:
 			# Hack to ensure that ^ and $ don't match anything important.
 			texdown = ' ' + texdown + ' '
 
-		texdown = self.do_convert(texdown, CONVERSIONS_ORDER)
+		texdown = ''.join(self.convert_chunks(texdown, magic))
+
+		if fragment:
+			texdown = texdown[1:-1]
+
+		return texdown
+
+	def convert_chunks(self, texdown, magic = False):
+		"""
+		Conversion:
+			Text is list of (chunk, names of conversions for this chunk),
+			conceptually. Do a depth-first conversion, appending the
+			output to one list of chunks, which is only joined up at the
+			very end (if at all).
+		"""
+		out = ByteChunks() if isinstance(texdown, bytes) else Chunks()
+		if magic:
+			out.listener = self.output_listener
+		self.do_convert(texdown, CONVERSIONS_ORDER, out)
 		#for match, replacement in CONVERSIONS:
 		#	texdown = self.convert_one(texdown, match, replacement)
 
 		if magic:
+			if out.listener is not None:
+				out.coalesce()
 			# Hack: add document ending here.
-			texdown += self.macros['end_document'](None)
+			end = self.macros['end_document'](None)
+			out.append(end.encode('utf-8') if isinstance(texdown, bytes) else end)
 
 			# Hack: magical abstract conversion.
 			if 0:
@@ -200,72 +811,142 @@ class Converter(object):
 						+ '\\end{abstract}\n' \
 						+ texdown[abstract_end:]
 
-		if fragment:
-			texdown = texdown[1:-1]
-
-		return texdown
+		return out
 	
-	def do_convert(self, text, match_names):
+	def may_match(self, text, conv):
+		" Cheap check: False if the rule cannot possibly match text. "
+		if not self.prefilter:
+			return True
+		for literal in conv.get('needs', ()):
+			if literal not in text:
+				return False
+		return True
+
+	def may_match_bytes(self, text, conv):
+		" may_match() for UTF-8 text. "
+		if not self.prefilter:
+			return True
+		# "in" is slow on bytes: it tries the literal as a byte value first.
+		for literal in conv.get('needs', ()):
+			if text.find(literal) < 0:
+				return False
+		return True
+
+	def live_rules(self, text, match_names):
+		"""
+		The rules in match_names which may match text, in order. Rules which
+		can't match are skipped outright. Nor can they match the pieces of
+		text between matches, so those need only be handed the rules which
+		might.
+		"""
+		if not self.prefilter:
+			return match_names
+		if isinstance(text, str):
+			conversions, may_match = CONVERSIONS, self.may_match
+		else:
+			conversions, may_match = byte_conversions(), self.may_match_bytes
+		plain = witnesses(type(text))
+		if plain is not None and plain.search(text) is None:
+			live = []
+		else:
+			live = [name for name in match_names if may_match(text, conversions[name])]
+		self.stats['prefilter_skips'] += len(match_names) - len(live)
+		return live
+
+	def do_convert(self, text, match_names, out = None):
 		"""
-		Walk down the list of names in match_names.
+		Walk down the list of names in match_names, appending the output to
+		out (Chunks). Without out, return the output as a string. Text may
+		be UTF-8 bytes, converted by the rules as bytes patterns.
 		"""
-		result = []
+		if out is None:
+			out = ByteChunks() if isinstance(text, bytes) else Chunks()
+			self.do_convert(text, match_names, out)
+			return out.empty.join(out)
+
+		conversions = CONVERSIONS if isinstance(text, str) else byte_conversions()
+		match_names = self.live_rules(text, match_names)
+		if not match_names:
+			out.append(text)
+			return
 
 		match_name = match_names[0]
 		children = match_names[1:]
-		conv = CONVERSIONS[match_name]
+		conv = conversions[match_name]
 
 		for pre_match, match in self.convert_one(text, match_name, conv):
 			if children:
-				pre_match = self.do_convert(pre_match, children)
+				self.do_convert(pre_match, children, out)
+			elif pre_match:
+				out.append(pre_match)
 			if 'incl' in conv:
-				match = self.do_convert(match, conv['incl'])
-			result.append(pre_match)
-			result.append(match)
-
-		return ''.join(result)
+				self.do_convert(match, conv['incl'], out)
+			elif match:
+				out.append(match)
+			if len(out) - out.mark > out.coalesce_after:
+				out.coalesce()
 			
 
-	def convert_one(self, texdown, match_name, conv):
-		match = conv['match']
+	def rule_matches(self, texdown, conv):
+		"""
+		(match, open_start, open_end) for each match of conv's rule in
+		texdown, open_start and open_end being whether there's more than a
+		character between it and the match before and after it (always so
+		for the first and last).
+		"""
+		utf8 = isinstance(texdown, bytes)
 
-		matches = list(match.finditer(texdown))
-		if not matches:
-			yield texdown, ''
+		self.stats['finditer'] += 1
+		# Matches are taken one ahead of the one being handled (to see
+		# whether the next one follows on), rather than all at once.
+		if 'finder' in conv:
+			matches = conv['finder'](conv['match'], texdown)
+		else:
+			matches = conv['match'].finditer(texdown)
+		match = next(matches, None)
 
-		for idx in range(len(matches)):
-			match = matches[idx]
+		prev_end = None
+		while match is not None:
+			next_match = next(matches, None)
 
 			# Does this match start right after the previous one ends?
-			if idx > 0:
-				prev_end = matches[idx - 1].end()
-				open_start = (match.start() - 1 > prev_end)
-				#print("mid idx open start", open_start)
-				# Store everything between the last result and this one.
-				#result.append(texdown[prev_end:match.start()])
-				before_match = texdown[prev_end:match.start()]
+			if prev_end is not None:
+				open_start = match.start() - 1 > prev_end \
+						and (not utf8 or several_characters(texdown, prev_end, match.start()))
 			else:
 				# At beginning of file: start the block.
 				open_start = True
-				#print("beginning open start", open_start)
-				#print("text", texdown)
-				# Also store everything up to the first match in result.
-				#result.append(texdown[:match.start()])
-				before_match = texdown[:match.start()]
 
 			# Work out if there is a newline after this match and before
 			# the next one.
-			if idx < (len(matches) - 1):
-				next_start = matches[idx + 1].start()
-				open_end = (match.end() +1 < next_start)
+			if next_match is not None:
+				open_end = match.end() + 1 < next_match.start() \
+						and (not utf8 or several_characters(texdown, match.end(), next_match.start()))
 			else:
 				# At end of file: end the block.
 				open_end = True
 
-			#print(match, newline_before, newline_after)
+			yield match, open_start, open_end
+
+			prev_end = match.end()
+			match = next_match
+
+	def convert_one(self, texdown, match_name, conv):
+		utf8 = isinstance(texdown, bytes)
+		if utf8:
+			import utf8rules
+			offsets = utf8rules.CharOffsets(texdown)
+
+		prev_end = 0
+		for match, open_start, open_end in self.rule_matches(texdown, conv):
+			# Everything between the last result and this one.
+			before_match = texdown[prev_end:match.start()]
 
 			if 'func' in conv:
 				handler = self.macros[conv['func']]
+				self.note_handler(handler)
+				# Macros see groups as text, however the rule ran.
+				groups = utf8rules.Utf8Match(match, offsets) if utf8 else match
 				try:
 					co = handler.__code__ # python 3
 				except AttributeError:
@@ -273,12 +954,12 @@ class Converter(object):
 				try:
 					if co.co_argcount == 2:
 						#result.append(handler(match))
-						result = handler(match)
+						result = handler(groups)
 					else:
 						#result.append(handler(match, open_start, open_end))
-						result = handler(match, open_start, open_end)
+						result = handler(groups, open_start, open_end)
 				except:
-					nl_count = texdown[:match.start()].count('\n')
+					nl_count = texdown[:match.start()].count(b'\n' if utf8 else '\n')
 					print("*** Error while converting line %d:" % (nl_count + 1))
 					raise
 			elif 'repl' in conv:
@@ -289,15 +970,18 @@ class Converter(object):
 			# If there is a post-processing handler, call it here.
 			postprocess_handler = self.macros.get('postproc_%s' % (match_name))
 			if postprocess_handler:
-				result = postprocess_handler(result)
+				result = postprocess_handler(result.decode('utf-8') if utf8 else result)
+			if utf8 and isinstance(result, str):
+				result = result.encode('utf-8')
 
 			yield before_match, result
 
-		if matches:
-			# Store everything after the last match
-			#result.append(texdown[matches[-1].end():])
-			yield texdown[matches[-1].end():], ''
+			prev_end = match.end()
+
+		# Store everything after the last match
+		yield texdown[prev_end:], texdown[:0]
 	
+	@side_effects
 	def macro_block_cmd(self, match, open_start, open_end):
 		# A block command ends with \t!!(.*) on its first line. This 
 		# determines the real block handler.
@@ -311,7 +995,8 @@ class Converter(object):
 			self.block_accum.append(line)
 		if open_end:
 			handler = self.macros[self.block_cmd]
-			result = handler(self.block_accum)
+			self.note_handler(handler)
+			result = self.call_macro(self.block_cmd, handler, self.block_accum)
 			self.block_accum = []
 			self.block_cmd = None
 			return result
@@ -326,12 +1011,69 @@ class Converter(object):
 			handler = self.macros[command]
 		except KeyError:
 			raise ConversionError("Macro '%s' not found." % (command))
-		return handler(args)
+		self.note_handler(handler)
+		return self.call_macro(command, handler, args)
 
-def parse_args():
+def parse_args(argv = None, option_groups = ()):
+	"""
+	The options every backend shares. A tool with its own passes in
+	functions which take the parser and return an OptionGroup of them.
+	"""
 	parser = OptionParser()
 	parser.add_option('-m', dest = 'localmacros', default = [], action = 'append')
-	return parser.parse_args() # returns (opts, args)
+	parser.add_option('-b', '--bibliography', dest = 'bibliography', default = 'papers',
+			help = 'BibTeX database used for citations (default: papers)')
+	parser.add_option('--fragment-cache', dest = 'fragment_cache', type = 'int', default = 1024,
+			help = 'number of converted fragments to cache, 0 to disable (default: 1024)')
+	parser.add_option('--macro-cache', dest = 'macro_cache', default = '.texdown-cache',
+			help = 'directory for the output of pure macros (default: .texdown-cache)')
+	parser.add_option('--macro-cache-size', dest = 'macro_cache_size', type = 'int', default = 100,
+			help = 'MB of pure macro output to keep, 0 to disable (default: 100)')
+	parser.add_option('--clear-macro-cache', dest = 'clear_macro_cache', default = False, action = 'store_true',
+			help = 'empty the pure macro cache first')
+	parser.add_option('--output-cache', dest = 'output_cache', metavar = 'DIR',
+			help = 'reuse whole conversions kept in this directory, which may be shared (see outputcache.py)')
+	parser.add_option('--output-cache-size', dest = 'output_cache_size', type = 'int', default = 1000,
+			help = 'MB of conversions to keep in the output cache (default: 1000)')
+	parser.add_option('--corpus', dest = 'corpus', metavar = 'FILE',
+			help = 'index documents\' labels in this SQLite file, for [document:label] references (see corpus.py)')
+	parser.add_option('--macro-threads', dest = 'macro_threads', type = 'int', default = 0,
+			help = 'run macros marked concurrent_safe in this many threads (default: 0, off)')
+	parser.add_option('--check', dest = 'check', default = False, action = 'store_true',
+			help = 'check the structure of each input file instead of converting')
+	parser.add_option('--toc', dest = 'toc', default = False, action = 'store_true',
+			help = 'write the outline (chapters and sections) as JSON instead of converting')
+	parser.add_option('--export-tree', dest = 'export_tree', default = False, action = 'store_true',
+			help = 'write the structure of the document as JSON lines instead of converting')
+	parser.add_option('--draft', dest = 'draft', default = False, action = 'store_true',
+			help = 'show placeholders for tables, graphics and long blocks, for quick rebuilds while writing')
+	parser.add_option('--draft-lines', dest = 'draft_lines', type = 'int', default = 50,
+			help = 'with --draft, block macros with more lines than this become placeholders (default: 50)')
+	parser.add_option('--diff', dest = 'diff', metavar = 'OLD',
+			help = 'mark what changed since the revision in the file OLD')
+	parser.add_option('--split', dest = 'split', type = 'choice', choices = ['chapter', 'section'],
+			help = 'write one page per chapter or section into the directory named as output')
+	parser.add_option('--search-index', dest = 'search_index', default = False, action = 'store_true',
+			help = 'HTML: write a search index and script next to the output')
+	parser.add_option('--table-page-rows', dest = 'table_page_rows', type = 'int', default = 100,
+			help = 'HTML: show longer tables a page of this many rows at a time, 0 to show them whole (default: 100; --preview shows them whole)')
+	parser.add_option('--preview', dest = 'preview', default = False, action = 'store_true',
+			help = 'run the editor live-preview server on stdin/stdout')
+	parser.add_option('--bytes', dest = 'bytes', default = False, action = 'store_true',
+			help = 'run the rules over the UTF-8 input without decoding it (see utf8rules.py)')
+	parser.add_option('--stats', dest = 'stats', default = False, action = 'store_true',
+			help = 'print engine statistics to stderr')
+	parser.add_option('--outdir', dest = 'outdir',
+			help = 'convert every input file (or archive, see archives.py) into this directory or archive, in worker processes')
+	parser.add_option('-j', '--jobs', dest = 'jobs', type = 'int',
+			help = 'number of worker processes for --outdir, or of documents texdown2pdf.py builds at once (default: one per CPU)')
+	parser.add_option('--timeout', dest = 'timeout', type = 'float',
+			help = 'give up on a document after this many seconds')
+	parser.add_option('--memory-limit', dest = 'memory_limit', type = 'int',
+			help = 'give up on a document which needs more than this many MB')
+	for option_group in option_groups:
+		parser.add_option_group(option_group(parser))
+	return parser.parse_args(argv) # returns (opts, args)
 
 def import_local_macros(filenames):
 	# Read "filenames", return list of Macros classes.
@@ -352,32 +1094,241 @@ def import_local_macros(filenames):
 
 	return clses
 
-def run_specialised_converter(name, specialised_conversions_txt, specialised_macros):
+def print_stats(converter):
+	stats = converter.stats
+	sys.stderr.write("finditer calls: %d (%d rules skipped by the literal prefilter)\n" \
+			% (stats['finditer'], stats['prefilter_skips']))
+	sys.stderr.write("fragment cache: %d hits, %d misses\n" \
+			% (stats['fragment_cache_hits'], stats['fragment_cache_misses']))
+	if converter.macro_cache is not None:
+		sys.stderr.write("macro cache: %d hits, %d misses\n" \
+				% (converter.macro_cache.hits, converter.macro_cache.misses))
+
+def write_sidecars(directory, sidecars):
+	" Write the extra files (search indexes and so on) a conversion produced. "
+	for filename, text in sidecars.items():
+		path = os.path.join(directory, filename)
+		if os.path.dirname(path) and not os.path.isdir(os.path.dirname(path)):
+			os.makedirs(os.path.dirname(path))
+		handle = codecs.open(path, 'w', encoding = 'utf-8')
+		handle.write(text)
+		handle.close()
+
+OUTPUT_EXTENSIONS = {'latex': '.tex', 'html': '.html'}
+
+def convert_files(name, specialised_conversions_txt, macro_clses, opts, filenames):
+	"""
+	Convert filenames into opts.outdir with a pool of workers. Either may be
+	an archive (see archives.py). Returns the number that failed.
+	"""
+	import archives
+	import itertools
+	import workers
+
+	cache = None
+	if opts.output_cache:
+		import outputcache
+		cache = outputcache.OutputCache(opts.output_cache, opts.output_cache_size * 1024 * 1024, macro_clses, opts)
+
+	index = None
+	if opts.corpus:
+		import corpus
+		index = corpus.Corpus(opts.corpus)
+
+	def write(document_name, source, text, sidecars):
+		location = os.path.splitext(document_name)[0] + OUTPUT_EXTENSIONS[name]
+		output.write(location, text)
+		for sidecar_name, sidecar_text in sorted(sidecars.items()):
+			output.write(os.path.join(os.path.dirname(document_name), sidecar_name), sidecar_text)
+		if index is not None:
+			index.update(os.path.splitext(os.path.basename(document_name))[0], name, location, source, text)
+
+	failures = 0
+	def documents():
+		" The documents to convert: those not in the output cache. "
+		nonlocal failures
+		for filename in filenames:
+			try:
+				for document_name, text in archives.read_documents(filename):
+					label = '%s:%s' % (filename, document_name) if archives.is_archive(filename) else filename
+					path = cached = None
+					if cache is not None:
+						path = cache.document_path(text)
+						cached = cache.get_conversion(path)
+					if cached is not None:
+						write(document_name, text, *cached)
+					else:
+						# The source is only kept for the corpus index.
+						yield (label, document_name, path, text if index is not None else None), text
+			except archives.ArchiveError as e:
+				print("Error: %s" % (e))
+				failures += 1
+
+	output = archives.Output(opts.outdir)
+	pool = None
+	try:
+		# The workers are only started once there's something for them.
+		pending = documents()
+		first = next(pending, None)
+		if first is not None:
+			pool = workers.WorkerPool(specialised_conversions_txt, macro_clses, opts,
+					opts.jobs, opts.timeout, opts.memory_limit)
+			for (label, document_name, path, source), result in pool.imap_unordered(itertools.chain([first], pending)):
+				if isinstance(result, ConversionError):
+					print("Error: %s: %s" % (label, result))
+					failures += 1
+					continue
+				converted, sidecars, inputs = result
+				write(document_name, source, converted, sidecars)
+				if cache is not None:
+					cache.put_conversion(path, converted, sidecars, inputs)
+	finally:
+		if pool is not None:
+			pool.close()
+		output.close()
+		if index is not None:
+			index.close()
+	if cache is not None:
+		sys.stderr.write(cache.report())
+	return failures
+
+def run_specialised_converter(name, specialised_conversions_txt, specialised_macros, split_output = None):
+	"""
+	The command-line converter. split_output(output, outdir, level, sidecars),
+	if the backend has one, writes the output as separate pages for --split.
+	"""
+	sidecars = {}
 	update_conversions(CONVERSIONS, specialised_conversions_txt)
 
 	opts, args = parse_args()
 
 	local_macro_clses = [specialised_macros] + import_local_macros(opts.localmacros)
 
+	if opts.clear_macro_cache:
+		import macrocache
+		macrocache.MacroCache(opts.macro_cache, 0).clear()
+		if not args:
+			return
+
+	if opts.preview:
+		import preview
+		preview.serve(Converter(local_macro_clses, opts))
+		return
+
+	if opts.check:
+		import lint
+		affiliations = getattr(sys.modules[specialised_macros.__module__], 'AFFILIATIONS', {})
+		macros = Converter(local_macro_clses, opts).macros
+		if lint.check_files(args, macros, affiliations):
+			sys.exit(1)
+		return
+
+	if opts.outdir:
+		if convert_files(name, specialised_conversions_txt, local_macro_clses, opts, args):
+			sys.exit(1)
+		return
+
 	texdownfile = args[0]
-	
-	handle = codecs.open(texdownfile, 'r', encoding = 'utf-8')
-	data = handle.read()
-	handle.close()
 
-	c = Converter(local_macro_clses)
+	# Plain conversions can be done on the UTF-8 as it is.
+	utf8 = opts.bytes and not (opts.diff or opts.export_tree or opts.toc \
+			or opts.timeout or opts.memory_limit or opts.split)
+	if utf8:
+		with open(texdownfile, 'rb') as handle:
+			data = handle.read()
+	else:
+		handle = codecs.open(texdownfile, 'r', encoding = 'utf-8')
+		data = handle.read()
+		handle.close()
 
-	try:
-		output = c(data)
-	except ConversionError as e:
-		print("Error: %s" % (e,))
-		sys.exit(1)
+	if opts.diff:
+		import changes
+		with open(opts.diff, 'r', encoding = 'utf-8') as handle:
+			data, deleted = changes.mark(handle.read(), data)
 
+	# A conversion found in the output cache needs no converter.
+	cache = cached = None
+	if opts.output_cache and not (opts.export_tree or opts.toc):
+		import outputcache
+		cache = outputcache.OutputCache(opts.output_cache, opts.output_cache_size * 1024 * 1024,
+				local_macro_clses, opts)
+		cache_path = cache.document_path(data)
+		cached = cache.get_conversion(cache_path)
+
+	if opts.export_tree:
+		import doctree
+		chunks = doctree.export(data)
+	elif opts.toc:
+		import outline
+		chunks = [outline.to_json(data)]
+	elif cached is not None:
+		output, sidecars = cached
+		chunks = [output.encode('utf-8') if utf8 else output]
+	elif opts.timeout or opts.memory_limit:
+		# Convert in a worker process, which can be stopped.
+		import workers
+		pool = workers.WorkerPool(specialised_conversions_txt, local_macro_clses, opts,
+				1, opts.timeout, opts.memory_limit)
+		try:
+			output, sidecars, inputs = pool.convert(data)
+		except ConversionError as e:
+			print("Error: %s" % (e,))
+			sys.exit(1)
+		finally:
+			pool.close()
+		chunks = [output]
+	else:
+		c = Converter(local_macro_clses, opts)
+
+		try:
+			chunks = c.convert_document_bytes(data) if utf8 else c.convert_document(data)
+		except (ConversionError, UnicodeDecodeError) as e:
+			print("Error: %s" % (e,))
+			sys.exit(1)
+
+		if opts.stats:
+			print_stats(c)
+		sidecars = c.sidecars
+		inputs = c.inputs
+
+	if cache is not None:
+		if cached is None:
+			output = b''.join(chunks).decode('utf-8') if utf8 else ''.join(chunks)
+			cache.put_conversion(cache_path, output, sidecars, inputs)
+			chunks = [output.encode('utf-8') if utf8 else output]
+		sys.stderr.write(cache.report())
+
+	if opts.diff:
+		chunks = [changes.render(''.join(chunks), specialised_macros.diff_markup, deleted)]
+
+	if opts.split:
+		if split_output is None:
+			print("Error: --split is not supported for %s output" % (name))
+			sys.exit(1)
+		split_output(''.join(chunks), args[1] if len(args) == 2 else '.', opts.split, sidecars)
+		return
+
+	# The output is written chunk by chunk, without joining it up first.
+	write_sidecars(os.path.dirname(args[1]) if len(args) == 2 else '.', sidecars)
 	if len(args) == 2:
 		outputfile = args[1]
-		handle = codecs.open(outputfile, 'w', encoding = 'utf-8')
-		handle.write(output)
+		if utf8:
+			handle = open(outputfile, 'wb')
+		else:
+			handle = open(outputfile, 'w', encoding = 'utf-8', newline = '')
+		handle.writelines(chunks)
 		handle.close()
+	elif utf8:
+		sys.stdout.flush()
+		sys.stdout.buffer.writelines(chunks)
 	else:
-		sys.stdout.write(output)
+		sys.stdout.writelines(chunks)
 
+	if opts.corpus and not (opts.export_tree or opts.toc or opts.diff):
+		import corpus
+		index = corpus.Corpus(opts.corpus)
+		source = data.decode('utf-8') if utf8 else data
+		output = b''.join(chunks).decode('utf-8') if utf8 else ''.join(chunks)
+		index.update(os.path.splitext(os.path.basename(texdownfile))[0], name,
+				os.path.basename(args[1]) if len(args) == 2 else None, source, output)
+		index.close()
@@ -46,3 +46,75 @@ hi link texdownsection TexdownHeading
 hi link texdownsubsection TexdownMildHeading
 hi link texdownsubsubsection TexdownMilderHeading
 
+
+" Live preview. :TexdownPreview starts the converter as a preview server
+" (texdown2html.py --preview, see preview.py), sends it each change to the
+" buffer and writes the rendered document to b:texdown_preview_file
+" (by default the buffer's file name with .preview.html).
+" :TexdownPreviewStop ends it. Needs Vim 8.2 (jobs and listener_add).
+if !exists('g:texdown_converter')
+	let g:texdown_converter = ['python3', 'texdown2html.py']
+endif
+
+function! s:PreviewSend(bufnr, request)
+	let l:job = getbufvar(a:bufnr, 'texdown_job', '')
+	if type(l:job) == v:t_job && job_status(l:job) == 'run'
+		call ch_sendraw(job_getchannel(l:job), json_encode(a:request) . "\n")
+	endif
+endfunction
+
+function! s:PreviewReceive(bufnr, channel, message)
+	let l:reply = json_decode(a:message)
+	if has_key(l:reply, 'error')
+		echoerr 'texdown preview: ' . l:reply.error
+		return
+	endif
+
+	let l:blocks = getbufvar(a:bufnr, 'texdown_blocks')
+	if l:reply.remove > 0
+		call remove(l:blocks, l:reply.first, l:reply.first + l:reply.remove - 1)
+	endif
+	call extend(l:blocks, l:reply.insert, l:reply.first)
+	for l:error in l:reply.errors
+		echomsg 'texdown preview: line ' . l:error.line . ': ' . l:error.message
+	endfor
+
+	call writefile(split(join(l:blocks, '') . l:reply.end, "\n", 1),
+		\ getbufvar(a:bufnr, 'texdown_preview_file'))
+endfunction
+
+function! s:PreviewChanged(bufnr, start, end, added, changes)
+	let l:last = a:end - 1 + a:added
+	let l:lines = l:last >= a:start ? getbufline(a:bufnr, a:start, l:last) : []
+	call s:PreviewSend(a:bufnr, {'op': 'change', 'start': a:start - 1, 'end': a:end - 1,
+		\ 'lines': l:lines})
+endfunction
+
+function! s:PreviewStart()
+	call s:PreviewStop()
+	let l:bufnr = bufnr('%')
+	if !exists('b:texdown_preview_file')
+		let b:texdown_preview_file = expand('%:p:r') . '.preview.html'
+	endif
+	let b:texdown_blocks = []
+	let b:texdown_job = job_start(g:texdown_converter + ['--preview'], {
+		\ 'mode': 'nl',
+		\ 'out_cb': function('s:PreviewReceive', [l:bufnr]),
+		\ 'err_io': 'null'})
+	call s:PreviewSend(l:bufnr, {'op': 'open', 'lines': getline(1, '$')})
+	let b:texdown_listener = listener_add(function('s:PreviewChanged'))
+endfunction
+
+function! s:PreviewStop()
+	if exists('b:texdown_listener')
+		call listener_remove(b:texdown_listener)
+		unlet b:texdown_listener
+	endif
+	if exists('b:texdown_job')
+		call job_stop(b:texdown_job)
+		unlet b:texdown_job
+	endif
+endfunction
+
+command! -buffer TexdownPreview call s:PreviewStart()
+command! -buffer TexdownPreviewStop call s:PreviewStop()
@@ -5,24 +5,32 @@ Convert Texdown syntax to HTML.
 """
 
 import texdown
+import bibtex
+import listings
+import mathml
+import outline
+import search
+import tables
+import html
 import re
+import sys
 
 # Basic HTML-specific conversions
 CONVERSIONS_TXT = r"""
-#mathmode:
-#	repl	$\1$
+mathmode:
+	func	mathmode
 chapterstar:
-	repl	<h1>\1</h1>
+	func	chapterstar
 chapter:
-	repl	<h1>\1</h1>
+	func	chapter
 section:
-	repl	<h2>\1</h2>
+	func	section
 usenixabstract:
 	repl	<h3>\1</h3>
 subsection:
-	repl	<h3>\1</h3>
+	func	subsection
 subsubsection:
-	repl	<h4>\1</h4>
+	func	subsubsection
 label:
 	repl	\\label{\1}
 caption:
@@ -30,13 +38,13 @@ caption:
 url:
 	repl	<a href="\1">\1</a>
 cite:
-	repl	~\\citep{\1}
+	func	cite
 cite_fixme:
 	repl	~\\cite{FIXME}
 teletype:
 	repl	\\texttt{\1}
 ref:
-	repl	\\ref{\1}
+	func	ref
 italics:
 	repl	\1<i>\2</i>\3
 bold:
@@ -51,9 +59,6 @@ escape_percents:
 	repl	%
 escape_ampersands:
 	repl	&
-escape_leftbracket
-	match	<
-	repl	&lt;
 """
 
 # Large LaTeX macros
@@ -87,17 +92,231 @@ END_DOCUMENT=r"""
 
 END_DOCUMENT_NIL = ''
 
+REFERENCES = r"""
+<h2>References</h2>
+<ol class="references">
+%s</ol>
+"""
+
+# Scripts go after this marker, which htmlsplit keeps on every page.
+SCRIPTS = '\n<!-- scripts -->\n'
+SCRIPT = '<script src="%s" defer></script>\n'
+
+# Fields that name where a work appeared, in order of preference.
+VENUE_FIELDS = ('journal', 'booktitle', 'publisher', 'school', 'institution', 'howpublished')
+
 class Macros(object):
+	# How --diff shows what changed, see changes.py
+	diff_markup = {'inserted': ('<ins>', '</ins>'), 'deleted': ('<del>', '</del>'), 'escape': html.escape}
+
 	def __init__(self, texdown):
 		self.texdown = texdown
-		self.end_document = END_DOCUMENT_NIL
+		self.bib = None
+		self.bib_loaded = False
+		self.reset()
 
+	def reset(self):
+		" Forget everything about the previous document. "
+		self.end_document = END_DOCUMENT_NIL
+		self.unknown_citations = set()
+		self.reset_citations()
+		self.reset_headings()
+		# Preview converts a block at a time, and serves no sidecars.
+		self.search = None
+		if self.texdown.opts.search_index and not self.texdown.opts.preview:
+			self.search = search.SearchIndex()
+			self.texdown.output_listener = self.search.add_output
+
+	def reset_citations(self):
+		self.cited = [] # Keys in order of first citation
+		self.cite_numbers = {}
+
+	def reset_headings(self):
+		self.outline_source = None
+		self.headings_tree = None
+		self.heading_ids = outline.HeadingIds()
+
+	@texdown.side_effects
 	def macro_techreport(self, block_lines):
 		self.end_document = END_DOCUMENT
 		return TECHREPORT % self.anypaper(block_lines, author = self.make_author_joined)
 
 	def macro_end_document(self, args):
-		return self.end_document
+		if self.search is not None:
+			self.texdown.sidecars['search.json'] = search.to_json(self.search.index())
+			self.texdown.sidecars['search.js'] = search.SEARCH_JS
+		return self.references() + self.scripts() + self.end_document
+
+	def scripts(self):
+		" Script tags for the .js files among the sidecars. "
+		names = sorted(name for name in self.texdown.sidecars if name.endswith('.js'))
+		if not names:
+			return ''
+		return SCRIPTS + ''.join(SCRIPT % (html.escape(name)) for name in names)
+
+	def bibliography(self):
+		" The BibTeX index, loaded on first use. None if there is no .bib file. "
+		if not self.bib_loaded:
+			self.bib_loaded = True
+			self.bib = bibtex.open_index(self.texdown.opts.bibliography)
+			if self.bib is None:
+				sys.stderr.write("Warning: bibliography '%s' not found; citations will not be resolved\n" \
+						% (self.texdown.opts.bibliography))
+		return self.bib
+
+	def cite_number(self, key):
+		" Number citations in order of first use. Returns None for unknown keys. "
+		if key in self.cite_numbers:
+			return self.cite_numbers[key]
+		if key == 'FIXME':
+			return None
+
+		bib = self.bibliography()
+		if bib is None:
+			return None
+		if key not in bib:
+			if key not in self.unknown_citations:
+				self.unknown_citations.add(key)
+				sys.stderr.write("Warning: unknown citation key '%s'\n" % (key))
+			return None
+
+		self.cited.append(key)
+		self.cite_numbers[key] = len(self.cited)
+		return self.cite_numbers[key]
+
+	@texdown.side_effects
+	def macro_cite(self, match):
+		links = []
+		for key in match.group(1).split(','):
+			key = key.strip()
+			number = self.cite_number(key)
+			if number is None:
+				links.append('%s?' % (html.escape(key)))
+			else:
+				links.append('<a href="#cite.%s">%d</a>' % (html.escape(key), number))
+		return '&nbsp;[%s]' % (', '.join(links))
+
+	def macro_ref(self, match):
+		" [label], or [document:label] for a label in another document: a link to it, or its document. "
+		target = self.texdown.corpus_target(match.group(1), 'html')
+		if target is None:
+			return '\\ref{%s}' % (match.group(1))
+		title, anchor, location = target
+		text = self.convert(title or match.group(1).split(':', 1)[1].strip())
+		if location is None:
+			return text
+		if anchor is not None:
+			location += '#' + anchor
+		return '<a href="%s">%s</a>' % (html.escape(location), text)
+
+	def format_reference(self, entry):
+		parts = []
+
+		authors = bibtex.split_authors(entry.get('author', entry.get('editor', '')))
+		if len(authors) > 1:
+			parts.append(html.escape(', '.join(authors[:-1]) + ' and ' + authors[-1]))
+		elif authors:
+			parts.append(html.escape(authors[0]))
+
+		if 'title' in entry:
+			parts.append('<i>%s</i>' % (html.escape(bibtex.plain(entry['title']))))
+
+		for field in VENUE_FIELDS:
+			if field in entry:
+				parts.append(html.escape(bibtex.plain(entry[field])))
+				break
+
+		if 'year' in entry:
+			parts.append(html.escape(bibtex.plain(entry['year'])))
+
+		return '. '.join(parts) + '.'
+
+	def references(self):
+		" The reference list: only entries that were actually cited. "
+		if not self.cited:
+			return ''
+		items = []
+		for key in self.cited:
+			items.append('<li id="cite.%s">%s</li>\n' \
+					% (html.escape(key), self.format_reference(self.bib.get(key))))
+		return REFERENCES % (''.join(items))
+
+	def convert(self, text):
+		" Convert a short piece of Texdown, e.g. a table cell. "
+		return self.texdown.convert(text, fragment = True)
+
+	def document_outline(self):
+		" The document's outline (see outline.py), found once per document. "
+		if self.headings_tree is None or self.outline_source is not self.texdown.source:
+			self.outline_source = self.texdown.source
+			self.headings_tree = outline.outline(self.outline_source)
+		return self.headings_tree
+
+	def heading(self, match, tag):
+		title, label = outline.split_title(match.group(1))
+		anchor = self.heading_ids.next(title, label)
+		return '<%s id="%s">%s</%s>' % (tag, html.escape(anchor), title, tag)
+
+	@texdown.side_effects
+	def macro_chapterstar(self, match):
+		return self.heading(match, 'h1')
+
+	@texdown.side_effects
+	def macro_chapter(self, match):
+		return self.heading(match, 'h1')
+
+	@texdown.side_effects
+	def macro_section(self, match):
+		return self.heading(match, 'h2')
+
+	@texdown.side_effects
+	def macro_subsection(self, match):
+		return self.heading(match, 'h3')
+
+	@texdown.side_effects
+	def macro_subsubsection(self, match):
+		return self.heading(match, 'h4')
+
+	def macro_mathmode(self, match):
+		return self.texdown.macros['inlinemath'](match.group(1))
+
+	@texdown.pure(mathml.VERSION)
+	def macro_inlinemath(self, tex):
+		" $tex$ as MathML (or as it was, if mathml.py can't do it). "
+		return mathml.render(tex)
+
+	@texdown.pure(mathml.VERSION)
+	def macro_math(self, tex):
+		" !!math tex: a displayed equation. "
+		return mathml.render(tex, display = True) + '\n'
+
+	def toc_list(self, headings, depth):
+		items = []
+		for heading in headings:
+			if heading['level'] > depth:
+				continue
+			items.append('<li><a href="#%s">%s</a>%s</li>\n' % (html.escape(heading['id']),
+					self.convert(heading['title']), self.toc_list(heading['children'], depth)))
+		if not items:
+			return ''
+		return '\n<ul>\n%s</ul>' % (''.join(items))
+
+	def macro_changed(self, args):
+		" !!changed inserted|changed|deleted [command]: see changes.py. "
+		what, _, command = args.partition(' ')
+		if what == 'deleted':
+			return '<p class="changed"><del>Removed %s</del></p>' % (html.escape(command or 'block'))
+		return '<p class="changed"><ins>%s above</ins></p>' % ('New' if what == 'inserted' else 'Changed')
+
+	def macro_tableofcontents(self, args):
+		"""
+		A linked table of contents, from the same outline as --toc. Usage:
+			!!tableofcontents [depth]
+		where a depth of 2 lists chapters and sections only.
+		"""
+		depth = int(args) if args else len(outline.HEADING_LEVELS)
+		return '<nav class="toc">%s\n</nav>' \
+				% (self.toc_list(self.document_outline(), depth))
 
 	# Popular stuff from localmacros.py
 	def fancy_table(self, block_lines, check_for_sizes = False, make_float = True, cell_func = None, horizborders = None, vertborders = None):
@@ -126,6 +345,10 @@ class Macros(object):
 					line[colnum] = cell_func(rownum, colnum, line[colnum])
 				block_lines[rownum] = line
 
+		# Preview serves no sidecars to page from.
+		page_rows = self.texdown.opts.table_page_rows
+		if page_rows and len(block_lines) - 1 > page_rows and not self.texdown.opts.preview:
+			return self.paged_table(block_lines, caption, check_for_sizes)
 
 		latex_sizes = ['l'] * cols # The default
 
@@ -217,6 +440,18 @@ class Macros(object):
 			result.append('\\end{table}\n')
 		return ''.join(result)
 
+	def paged_table(self, block_lines, caption, check_for_sizes):
+		" A long table as an HTML table showing its first page of rows, see tables.py. "
+		header = block_lines[0]
+		if check_for_sizes:
+			header = [re.sub(r'!([0-9]+)%$', '', cell) for cell in header]
+		header = [self.convert(cell.strip()) for cell in header]
+		rows = [[self.convert(cell.strip()) for cell in line] for line in block_lines[1:]]
+		output, sidecars = tables.render(header, rows, self.texdown.opts.table_page_rows)
+		self.texdown.sidecars.update(sidecars)
+		return output + (caption or '')
+
+	@texdown.concurrent_safe
 	def macro_floatgraphic(self, args):
 		"""
 		Includes a graphic, places it in a figure, and gives it a label. Usage:
@@ -224,6 +459,7 @@ class Macros(object):
 		"""
 		return self.macro_anygraphic(args, floating = True)
 
+	@texdown.concurrent_safe
 	def macro_inlinegraphic(self, args):
 		return self.macro_anygraphic(args, floating = False)
 
@@ -267,12 +503,14 @@ class Macros(object):
 			result.append('\\captionof{figure}{%s}' % (caption))
 		return '\n'.join(result)
 
+	@texdown.concurrent_safe
 	def macro_floatgraphic_wholepage(self, args):
 		result = [self.macro_floatgraphic(args),
 				'\\afterpage{\\clearpage}']
 		return '\n'.join(result)
 	
 
+	@texdown.concurrent_safe
 	def macro_absolutegraphic(self, args):
 		"""
 		Includes an absolutely-positioned graphic without label.
@@ -288,6 +526,7 @@ class Macros(object):
 		]
 		return '\n'.join(result)
 	
+	@texdown.concurrent_safe
 	def macro_floatcode(self, block_lines, placement_spec = None):
 		"""
 		Code inside a figure. If the final line is a caption, does the right
@@ -312,14 +551,43 @@ class Macros(object):
 		result.append('\\end{figure}')
 		return '\n'.join(result)
 	
+	@texdown.concurrent_safe
 	def macro_exactfloatcode(self, block_lines):
 		return self.macro_floatcode(block_lines, 'h!')
+
+	def macro_listing(self, args):
+		"""
+		Lines of a file inside a figure, read as needed (see listings.py).
+		Not run in threads: citations in the caption are numbered. Usage:
+		!!listing path/to/file.py, 120-240, <<label.if.wanted>> Caption if wanted
+		"""
+		return listings.figure(self.texdown, args)
 	
 	def macro_floattable(self, block_lines):
 		return self.fancy_table(block_lines, check_for_sizes = True)
 	
 	def macro_inlinetable(self, block_lines):
 		return self.fancy_table(block_lines, check_for_sizes = True, make_float = False)
+
+	def placeholder(self, text, caption = None):
+		" A box holding text, followed by the caption if there is one. "
+		return '<div class="placeholder">%s</div>\n' % (text) + (caption or '')
+
+	def macro_placeholder(self, block_lines):
+		"""
+		A box standing in for something left out, keeping its caption (and
+		so its label). --draft shows long blocks this way. Usage:
+			results table goes here	!!placeholder
+			~~ <<table.results>> Results ~~
+		"""
+		lines, caption = texdown.split_caption(block_lines)
+		return self.placeholder(self.convert(' '.join(lines)), caption)
+
+	def draft_floattable(self, block_lines):
+		lines, caption = texdown.split_caption(block_lines)
+		return self.placeholder('table: %d&times;%d' % texdown.table_size(lines), caption)
+
+	draft_inlinetable = draft_floattable
 	
 	def macro_blockquote(self, block_lines):
 		# Special-case attribution line.
@@ -341,20 +609,21 @@ class Macros(object):
 
 		return ''.join(result)
 	
+	@texdown.side_effects
 	def macro_numbers(self, match, open_start, open_end):
 		result = []
 
 		enum_number = int(match.group(2))
 		if open_start:
 			result.append('\\begin{enumerate}\n')
-			self.enum_depth += 1
+			self.texdown.enum_depth += 1
 			if enum_number != 1:
-				varname = 'enum' + 'i' * self.enum_depth
+				varname = 'enum' + 'i' * self.texdown.enum_depth
 				result.append('\\setcounter{%s}{%d}\n' % (varname, enum_number - 1))
 		result.append('\t\\item %s\n' % match.group(3))
 		if open_end:
 			result.append('\\end{enumerate}\n')
-			self.enum_depth -= 1
+			self.texdown.enum_depth -= 1
 
 		return ''.join(result)
 
@@ -434,5 +703,6 @@ class Macros(object):
 	
 
 if __name__ == '__main__':
-	texdown.run_specialised_converter('latex', CONVERSIONS_TXT, Macros)
+	import htmlsplit
+	texdown.run_specialised_converter('html', CONVERSIONS_TXT, Macros, split_output = htmlsplit.write_pages)
 
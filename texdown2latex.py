@@ -5,7 +5,11 @@ Convert Texdown syntax to LaTeX.
 """
 
 import texdown
+import bibtex
+import listings
+import os
 import re
+import sys
 
 # Basic LaTeX-specific conversions
 CONVERSIONS_TXT = r"""
@@ -30,13 +34,13 @@ caption:
 url:
 	repl	\\url{\1}
 cite:
-	repl	~\\citep{\1}
+	func	cite
 cite_fixme:
 	repl	~\\cite{FIXME}
 teletype:
 	repl	\\texttt{\1}
 ref:
-	repl	\\ref{\1}
+	func	ref
 italics:
 	repl	\1\\textit{\2}\3
 bold:
@@ -129,41 +133,123 @@ NICTATR = r"""\documentclass[preprint,natbib,10pt]{article}
 
 END_DOCUMENT=r"""
 	\bibliographystyle{plainnat}
-	\bibliography{papers}
+	\bibliography{%(bibliography)s}
 	\end{document}
 """
 
 END_DOCUMENT_PLAIN=r"""
 	\bibliographystyle{plain}
-	\bibliography{papers}
+	\bibliography{%(bibliography)s}
 	\end{document}
 """
 
 END_DOCUMENT_NIL = ''
 
+# Characters of plain text which mean something to LaTeX.
+SPECIALS = str.maketrans({'\\': '\\textbackslash{}', '{': '\\{', '}': '\\}', '$': '\\$', '&': '\\&',
+		'%': '\\%', '#': '\\#', '_': '\\_', '^': '\\^{}', '~': '\\~{}'})
+
+def escape(text):
+	" Plain text as LaTeX. "
+	return text.translate(SPECIALS)
+
 class Macros(object):
+	# How --diff shows what changed, see changes.py
+	diff_markup = {'inserted': ('{\\color{blue}', '}'), 'deleted': ('{\\color{red}\\sout{', '}}'),
+			'escape': escape, 'preamble': '\\usepackage{xcolor}\n\\usepackage[normalem]{ulem}\n'}
+
 	def __init__(self, texdown):
 		self.texdown = texdown
+		self.bib = None
+		self.bib_loaded = False
+		self.reset()
+
+	def reset(self):
+		" Forget everything about the previous document. "
 		self.end_document = END_DOCUMENT_NIL
+		self.unknown_citations = set()
 
+	@texdown.side_effects
 	def macro_sigplanpaper(self, block_lines):
 		self.end_document = END_DOCUMENT_PLAIN
 		return SIGPLANPAPER % self.anypaper(block_lines, author = self.make_author)
 
+	@texdown.side_effects
 	def macro_techreport(self, block_lines):
 		self.end_document = END_DOCUMENT_PLAIN
 		return TECHREPORT % self.anypaper(block_lines, author = self.make_author_joined)
 
+	@texdown.side_effects
 	def macro_acceptancetestingreport(self, block_lines):
 		self.end_document = END_DOCUMENT_PLAIN
 		return ACCEPTANCE_TESTING_REPORT % self.anypaper(block_lines, author = self.make_author_plain)
 
+	@texdown.side_effects
 	def macro_nictatr(self, block_lines):
 		self.end_document = END_DOCUMENT_PLAIN
 		return NICTATR % self.anypaper(block_lines, author = self.make_author_plain)
 
 	def macro_end_document(self, args):
-		return self.end_document
+		bibliography = self.texdown.opts.bibliography
+		if bibliography.endswith('.bib'):
+			bibliography = bibliography[:-4]
+		return self.end_document % {'bibliography': bibliography}
+
+	def macro_changed(self, args):
+		" !!changed inserted|changed|deleted [command]: see changes.py. "
+		what, _, command = args.partition(' ')
+		if what == 'deleted':
+			return '\\noindent{\\color{red}\\sout{Removed %s}}\n' % ((command or 'block').replace('_', '\\_'))
+		return '\\noindent{\\color{blue}%s above}\n' % ('New' if what == 'inserted' else 'Changed')
+
+	def macro_tableofcontents(self, args):
+		"""
+		Usage:
+			!!tableofcontents [depth]
+		where depth counts as in outline.py: 2 lists chapters and sections.
+		"""
+		if args:
+			return '\\setcounter{tocdepth}{%d}\n\\tableofcontents' % (int(args) - 1)
+		return '\\tableofcontents'
+
+	def bibliography(self):
+		" The BibTeX index, loaded on first use. None if there is no .bib file. "
+		if not self.bib_loaded:
+			self.bib_loaded = True
+			self.bib = bibtex.open_index(self.texdown.opts.bibliography)
+			if self.bib is None:
+				sys.stderr.write("Warning: bibliography '%s' not found; not checking citations\n" \
+						% (self.texdown.opts.bibliography))
+		return self.bib
+
+	def macro_cite(self, match):
+		"""
+		Citations pass straight through to natbib, but unknown keys are
+		reported (once each) so they don't turn up as [?] in the PDF.
+		"""
+		bib = self.bibliography()
+		if bib is not None:
+			for key in match.group(1).split(','):
+				key = key.strip()
+				if key and key != 'FIXME' and key not in bib and key not in self.unknown_citations:
+					self.unknown_citations.add(key)
+					sys.stderr.write("Warning: unknown citation key '%s'\n" % (key))
+		return '~\\citep{%s}' % (match.group(1))
+
+	def macro_ref(self, match):
+		" [label], or [document:label] for a label in another document: a link to its PDF. "
+		target = self.texdown.corpus_target(match.group(1), 'latex')
+		if target is None:
+			return '\\ref{%s}' % (match.group(1))
+		title, anchor, location = target
+		text = self.convert(title or match.group(1).split(':', 1)[1].strip())
+		if location is None:
+			return text
+		return '\\href{%s}{%s}' % (os.path.splitext(location)[0] + '.pdf', text)
+
+	def convert(self, text):
+		" Convert a short piece of Texdown, e.g. a table cell. "
+		return self.texdown.convert(text, fragment = True)
 
 	# Popular stuff from localmacros.py
 	def fancy_table(self, block_lines, check_for_sizes = False, make_float = True, cell_func = None, horizborders = None, vertborders = None):
@@ -283,6 +369,7 @@ class Macros(object):
 			result.append('\\end{table}\n')
 		return ''.join(result)
 
+	@texdown.concurrent_safe
 	def macro_floatgraphic(self, args):
 		"""
 		Includes a graphic, places it in a figure, and gives it a label. Usage:
@@ -290,6 +377,7 @@ class Macros(object):
 		"""
 		return self.macro_anygraphic(args, floating = True)
 
+	@texdown.concurrent_safe
 	def macro_inlinegraphic(self, args):
 		return self.macro_anygraphic(args, floating = False)
 
@@ -333,12 +421,14 @@ class Macros(object):
 			result.append('\\captionof{figure}{%s}' % (caption))
 		return '\n'.join(result)
 
+	@texdown.concurrent_safe
 	def macro_floatgraphic_wholepage(self, args):
 		result = [self.macro_floatgraphic(args),
 				'\\afterpage{\\clearpage}']
 		return '\n'.join(result)
 	
 
+	@texdown.concurrent_safe
 	def macro_absolutegraphic(self, args):
 		"""
 		Includes an absolutely-positioned graphic without label.
@@ -354,6 +444,7 @@ class Macros(object):
 		]
 		return '\n'.join(result)
 	
+	@texdown.concurrent_safe
 	def macro_floatcode(self, block_lines, placement_spec = None):
 		"""
 		Code inside a figure. If the final line is a caption, does the right
@@ -378,14 +469,54 @@ class Macros(object):
 		result.append('\\end{figure}')
 		return '\n'.join(result)
 	
+	@texdown.concurrent_safe
 	def macro_exactfloatcode(self, block_lines):
 		return self.macro_floatcode(block_lines, 'h!')
+
+	def macro_listing(self, args):
+		"""
+		Lines of a file inside a figure, read as needed (see listings.py).
+		Not run in threads: citations in the caption are numbered. Usage:
+		!!listing path/to/file.py, 120-240, <<label.if.wanted>> Caption if wanted
+		"""
+		return listings.figure(self.texdown, args)
 	
 	def macro_floattable(self, block_lines):
 		return self.fancy_table(block_lines, check_for_sizes = True)
 	
 	def macro_inlinetable(self, block_lines):
 		return self.fancy_table(block_lines, check_for_sizes = True, make_float = False)
+
+	def placeholder(self, text, caption = None, environment = 'figure'):
+		" A box holding text, in a float with the caption if there is one. "
+		box = '\\fbox{\\ttfamily %s}\n' % (text)
+		if caption is None:
+			return box
+		if environment is None:
+			return box + caption
+		return '\\begin{%s}[htb]\n\\centering %s%s\\end{%s}\n' % (environment, box, caption, environment)
+
+	def macro_placeholder(self, block_lines):
+		" As in texdown2html.py: a framed box, in a figure if it has a caption. "
+		lines, caption = texdown.split_caption(block_lines)
+		return self.placeholder(self.convert(' '.join(lines)), caption)
+
+	def table_placeholder(self, block_lines, environment):
+		lines, caption = texdown.split_caption(block_lines)
+		return self.placeholder('table: %d$\\times$%d' % texdown.table_size(lines), caption, environment)
+
+	def draft_floattable(self, block_lines):
+		return self.table_placeholder(block_lines, 'table')
+
+	def draft_inlinetable(self, block_lines):
+		return self.table_placeholder(block_lines, None)
+
+	def draft_floatgraphic(self, args):
+		# graphicx draws a box with the file's name, without reading it.
+		return self.macro_anygraphic(args, floating = True, extra = '[draft]')
+
+	def draft_inlinegraphic(self, args):
+		return self.macro_anygraphic(args, floating = False, extra = '[draft]')
 	
 	def macro_blockquote(self, block_lines):
 		# Special-case attribution line.
@@ -407,20 +538,21 @@ class Macros(object):
 
 		return ''.join(result)
 	
+	@texdown.side_effects
 	def macro_numbers(self, match, open_start, open_end):
 		result = []
 
 		enum_number = int(match.group(2))
 		if open_start:
 			result.append('\\begin{enumerate}\n')
-			self.enum_depth += 1
+			self.texdown.enum_depth += 1
 			if enum_number != 1:
-				varname = 'enum' + 'i' * self.enum_depth
+				varname = 'enum' + 'i' * self.texdown.enum_depth
 				result.append('\\setcounter{%s}{%d}\n' % (varname, enum_number - 1))
 		result.append('\t\\item %s\n' % match.group(3))
 		if open_end:
 			result.append('\\end{enumerate}\n')
-			self.enum_depth -= 1
+			self.texdown.enum_depth -= 1
 
 		return ''.join(result)
 
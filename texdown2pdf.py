@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+# vim: set fileencoding=utf-8 :
+"""
+Build PDFs: convert to LaTeX, then run LaTeX and BibTeX only as often as needed.
+
+	texdown2pdf.py [-j JOBS] [--outdir DIR] paper.texdown thesis.texdown ...
+
+Each document is converted to a .tex file next to it (or in --outdir), which
+is only rewritten if it changed. Then LaTeX (--latex, default pdflatex) is
+run until its .aux file stops changing, and BibTeX (--bibtex) whenever the
+citations in the .aux file or the .bib files they come from change. The
+hashes of the .tex, .aux and .bbl files each LaTeX pass read, and of what
+BibTeX read, are kept in <name>.build.json, so a pass whose inputs haven't
+changed since the last build is skipped: an unchanged document runs nothing,
+and a change to the text alone runs LaTeX once. Files the .tex includes,
+such as graphics, aren't tracked; delete the .build.json file to force a
+full build.
+
+The commands are run in the .tex file's directory, with the .tex file (for
+LaTeX) or its name without the extension (for BibTeX) added as the last
+argument, and LaTeX must write <name>.pdf. Up to --jobs documents are built
+at once.
+"""
+
+import codecs
+import concurrent.futures
+import hashlib
+import json
+import os
+import re
+import shlex
+import subprocess
+import sys
+from optparse import OptionGroup
+
+import texdown
+import texdown2latex
+
+BIBTEX_AUX_LINE = re.compile(r'^\\(?:citation|bibdata|bibstyle)\{.*$', re.MULTILINE)
+BIBDATA = re.compile(r'^\\bibdata\{(.*)\}$', re.MULTILINE)
+
+# Lines of LaTeX's or BibTeX's output to show when it fails.
+ERROR_LINES = 20
+
+class BuildError(texdown.ConversionError):
+	pass
+
+def build_options(parser):
+	group = OptionGroup(parser, 'Building PDFs')
+	group.add_option('--latex', dest = 'latex', default = 'pdflatex -interaction=nonstopmode -halt-on-error',
+			help = 'LaTeX command (default: pdflatex -interaction=nonstopmode -halt-on-error)')
+	group.add_option('--bibtex', dest = 'bibtex', default = 'bibtex',
+			help = 'BibTeX command (default: bibtex)')
+	group.add_option('--max-latex-runs', dest = 'max_latex_runs', type = 'int', default = 5,
+			help = 'most LaTeX runs per document (default: 5)')
+	return group
+
+def digest(*paths):
+	" A hash of the files' contents, or of their absence. "
+	hasher = hashlib.sha256()
+	for path in paths:
+		try:
+			with open(path, 'rb') as handle:
+				hasher.update(hashlib.sha256(handle.read()).digest())
+		except (IOError, OSError):
+			hasher.update(b'missing')
+	return hasher.hexdigest()
+
+class Build(object):
+	def __init__(self, tex_path, opts):
+		self.directory, name = os.path.split(os.path.abspath(tex_path))
+		self.name = os.path.splitext(name)[0]
+		self.opts = opts
+		self.latex_runs = self.bibtex_runs = 0
+
+	def path(self, extension):
+		return os.path.join(self.directory, self.name + extension)
+
+	def load_state(self):
+		try:
+			with open(self.path('.build.json'), 'r', encoding = 'utf-8') as handle:
+				state = json.load(handle)
+		except (IOError, OSError, ValueError):
+			return {}
+		return state if isinstance(state, dict) else {}
+
+	def save_state(self, state):
+		with open(self.path('.build.json'), 'w', encoding = 'utf-8') as handle:
+			json.dump(state, handle)
+
+	def run(self, command, target):
+		args = shlex.split(command) + [target]
+		try:
+			result = subprocess.run(args, cwd = self.directory, stdin = subprocess.DEVNULL,
+					stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
+		except OSError as e:
+			raise BuildError("can't run %s: %s" % (args[0], e))
+		if result.returncode != 0:
+			output = result.stdout.decode('utf-8', 'replace').splitlines()[-ERROR_LINES:]
+			raise BuildError("%s failed on %s:\n%s" % (args[0], target, '\n'.join(output)))
+
+	def bibtex_inputs(self):
+		" A hash of what BibTeX would read, or None if the document has no bibliography. "
+		try:
+			with open(self.path('.aux'), 'r', encoding = 'utf-8', errors = 'replace') as handle:
+				aux = handle.read()
+		except (IOError, OSError):
+			return None
+		databases = BIBDATA.findall(aux)
+		if not databases:
+			return None
+		bib_paths = []
+		for names in databases:
+			for name in names.split(','):
+				bib_paths.append(os.path.join(self.directory, name if name.endswith('.bib') else name + '.bib'))
+		lines = '\n'.join(BIBTEX_AUX_LINE.findall(aux))
+		return hashlib.sha256(lines.encode('utf-8')).hexdigest() + digest(*bib_paths)
+
+	def build(self):
+		" Run the toolchain as often as needed. Raises BuildError if a command fails. "
+		state = self.load_state()
+		try:
+			while True:
+				bibtex_inputs = self.bibtex_inputs()
+				if bibtex_inputs is not None and bibtex_inputs != state.get('bibtex'):
+					state.pop('bibtex', None)
+					self.run(self.opts.bibtex, self.name)
+					self.bibtex_runs += 1
+					state['bibtex'] = bibtex_inputs
+
+				latex_inputs = digest(self.path('.tex'), self.path('.aux'), self.path('.bbl'))
+				if latex_inputs == state.get('latex') and os.path.exists(self.path('.pdf')):
+					break
+				if self.latex_runs == self.opts.max_latex_runs:
+					sys.stderr.write("Warning: %s: .aux file still changing after %d LaTeX runs\n" \
+							% (self.name, self.latex_runs))
+					break
+				state.pop('latex', None)
+				self.run(self.opts.latex, self.name + '.tex')
+				self.latex_runs += 1
+				state['latex'] = latex_inputs
+		finally:
+			self.save_state(state)
+
+def convert(converter, filename, outdir):
+	" Convert filename to LaTeX, writing the .tex only if it changed. Returns its path. "
+	handle = codecs.open(filename, 'r', encoding = 'utf-8')
+	data = handle.read()
+	handle.close()
+	output = ''.join(converter.convert_document(data))
+
+	directory = outdir or os.path.dirname(filename)
+	if directory and not os.path.isdir(directory):
+		os.makedirs(directory)
+	tex_path = os.path.join(directory, os.path.splitext(os.path.basename(filename))[0] + '.tex')
+	texdown.write_sidecars(directory or '.', converter.sidecars)
+	try:
+		with open(tex_path, 'r', encoding = 'utf-8', newline = '') as handle:
+			unchanged = handle.read() == output
+	except (IOError, OSError):
+		unchanged = False
+	if not unchanged:
+		with open(tex_path, 'w', encoding = 'utf-8', newline = '') as handle:
+			handle.write(output)
+	return tex_path
+
+def plural(count, word):
+	return '%d %s run%s' % (count, word, '' if count == 1 else 's')
+
+def build_files(filenames, macro_clses, opts):
+	" Convert and build each of filenames. Returns the number that failed. "
+	converter = texdown.Converter(macro_clses, opts)
+	failures = 0
+	builds = []
+	for filename in filenames:
+		try:
+			builds.append((filename, Build(convert(converter, filename, opts.outdir), opts)))
+		except texdown.ConversionError as e:
+			print("Error: %s: %s" % (filename, e))
+			failures += 1
+
+	with concurrent.futures.ThreadPoolExecutor(opts.jobs or os.cpu_count() or 1) as pool:
+		futures = [(filename, build, pool.submit(build.build)) for filename, build in builds]
+		for filename, build, future in futures:
+			try:
+				future.result()
+			except BuildError as e:
+				print("Error: %s: %s" % (filename, e))
+				failures += 1
+				continue
+			if build.latex_runs or build.bibtex_runs:
+				print("%s: %s, %s" % (filename, plural(build.latex_runs, 'LaTeX'), plural(build.bibtex_runs, 'BibTeX')))
+			else:
+				print("%s: up to date" % (filename))
+	return failures
+
+def main():
+	texdown.update_conversions(texdown.CONVERSIONS, texdown2latex.CONVERSIONS_TXT)
+	opts, args = texdown.parse_args(option_groups = [build_options])
+	if not args:
+		print("Usage: texdown2pdf.py [options] file.texdown ...")
+		sys.exit(2)
+	macro_clses = [texdown2latex.Macros] + texdown.import_local_macros(opts.localmacros)
+	if build_files(args, macro_clses, opts):
+		sys.exit(1)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,269 @@
+# vim: set fileencoding=utf-8 :
+"""
+The rules as bytes patterns, for converting UTF-8 without decoding it.
+
+	texdown2latex.py --bytes paper.texdown paper.tex
+
+Every rule is written in ASCII, so it can run over the UTF-8 bytes of a
+document as well as over its characters, as long as each part of a pattern
+which matches one character matches all the bytes of one character. This
+module rewrites the patterns so that they do:
+
+	.        (?:[^\\n\\x80-\\xff]|[\\xc2-\\xdf][\\x80-\\xbf]|...)  one whole character
+	[^abc]   (?:[^abc\\x80-\\xff]|[\\xc2-\\xdf][\\x80-\\xbf]|...)
+	.*?      [^\\n]*?  where what follows can't match inside a character
+
+Everything else that matches characters (\\s, \\w, \\b, case-insensitive
+matching, classes holding non-ASCII characters) means something different
+over bytes, so a rule using it can't be translated, and byte_conversions()
+returns None: the document is then decoded and converted as usual. Since no
+part of a translated pattern matches starting inside a character, matches
+and groups always hold whole characters, so macros are given the groups
+decoded (see Utf8Match) and their output is encoded.
+"""
+
+import codecs
+import re
+
+try:
+	import re._parser as sre_parse
+	import re._constants as sre_constants
+except ImportError: # Python < 3.11
+	import sre_parse
+	import sre_constants
+
+# One whole multi-byte character, in valid UTF-8.
+MULTIBYTE = rb'[\xc2-\xdf][\x80-\xbf]|[\xe0-\xef][\x80-\xbf]{2}|[\xf0-\xf4][\x80-\xbf]{3}'
+
+class Untranslatable(Exception):
+	pass
+
+def escape(code):
+	" The byte pattern for the character code. "
+	return b''.join(re.escape(bytes([byte])) for byte in chr(code).encode('utf-8'))
+
+def character_set(op, av, dotall):
+	"""
+	For a part of a pattern which matches one character of a set which
+	includes every non-ASCII character, the ASCII bytes it excludes as
+	a class body (e.g. b'\\n' for '.'). None for anything else.
+	"""
+	if op is sre_constants.ANY:
+		return b'' if dotall else b'\\n'
+	if op is sre_constants.NOT_LITERAL and av < 128:
+		return escape(av)
+	if op is sre_constants.IN and av and av[0][0] is sre_constants.NEGATE:
+		excluded = []
+		for item_op, item_av in av[1:]:
+			if item_op is sre_constants.LITERAL and item_av < 128:
+				excluded.append(escape(item_av))
+			elif item_op is sre_constants.RANGE and item_av[1] < 128:
+				excluded.append(escape(item_av[0]) + b'-' + escape(item_av[1]))
+			else:
+				raise Untranslatable(item_op)
+		return b''.join(excluded)
+	return None
+
+def one_character(excluded):
+	" Bytes pattern for one character, other than the excluded ASCII ones. "
+	return b'(?:[^' + excluded + rb'\x80-\xff]|' + MULTIBYTE + b')'
+
+def any_bytes(excluded):
+	" Bytes pattern for any one byte but the excluded ASCII ones. "
+	if not excluded:
+		return rb'[\x00-\xff]'
+	return b'[^' + excluded + b']'
+
+def starts_whole(item):
+	" True if the part of a pattern can't match starting inside a character. "
+	op, av = item
+	if op in (sre_constants.LITERAL, sre_constants.NOT_LITERAL, sre_constants.ANY, sre_constants.IN):
+		return True
+	if op is sre_constants.AT:
+		return av in (sre_constants.AT_BEGINNING, sre_constants.AT_END,
+				sre_constants.AT_BEGINNING_STRING, sre_constants.AT_END_STRING)
+	if op is sre_constants.SUBPATTERN:
+		return bool(av[-1].data) and starts_whole(av[-1].data[0])
+	if op is sre_constants.BRANCH:
+		return all(alternative.data and starts_whole(alternative.data[0]) for alternative in av[1])
+	if op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+		return av[0] >= 1 and bool(av[2].data) and starts_whole(av[2].data[0])
+	if op is sre_constants.ASSERT:
+		return av[0] == 1 and bool(av[1].data) and starts_whole(av[1].data[0])
+	return False
+
+def translate_items(items, follows_whole, state):
+	"""
+	The bytes pattern for a sequence of parsed items. follows_whole is
+	True if whatever comes after the sequence can't match inside a
+	character.
+	"""
+	out = []
+	for idx, item in enumerate(items):
+		after_whole = starts_whole(items[idx + 1]) if idx + 1 < len(items) else follows_whole
+		out.append(translate_item(item, after_whole, state))
+	return b''.join(out)
+
+def translate_item(item, follows_whole, state):
+	op, av = item
+	dotall = state.flags & re.DOTALL
+	if op is sre_constants.LITERAL:
+		return escape(av)
+	excluded = character_set(op, av, dotall)
+	if excluded is not None:
+		return one_character(excluded)
+	if op is sre_constants.IN:
+		body = []
+		for item_op, item_av in av:
+			if item_op is sre_constants.LITERAL and item_av < 128:
+				body.append(escape(item_av))
+			elif item_op is sre_constants.RANGE and item_av[1] < 128:
+				body.append(escape(item_av[0]) + b'-' + escape(item_av[1]))
+			else:
+				raise Untranslatable(item_op)
+		return b'[' + b''.join(body) + b']'
+	if op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+		low, high, body = av
+		lazy = b'?' if op is sre_constants.MIN_REPEAT else b''
+		if len(body.data) == 1 and high is sre_constants.MAXREPEAT and follows_whole:
+			excluded = character_set(body.data[0][0], body.data[0][1], dotall)
+			if excluded is not None:
+				# Any number of bytes: it can only stop between characters.
+				return one_character(excluded) * low + any_bytes(excluded) + b'*' + lazy
+		if high is sre_constants.MAXREPEAT:
+			count = b'{%d,}' % (low)
+		else:
+			count = b'{%d,%d}' % (low, high)
+		return b'(?:' + translate_items(body.data, True, state) + b')' + count + lazy
+	if op is sre_constants.SUBPATTERN:
+		group, add_flags, del_flags, body = av
+		if add_flags or del_flags:
+			raise Untranslatable(op)
+		inner = translate_items(body.data, follows_whole, state)
+		if group is None:
+			return b'(?:' + inner + b')'
+		if group in state.names:
+			return b'(?P<' + state.names[group].encode('ascii') + b'>' + inner + b')'
+		return b'(' + inner + b')'
+	if op is sre_constants.BRANCH:
+		return b'(?:' + b'|'.join(translate_items(alternative.data, follows_whole, state)
+				for alternative in av[1]) + b')'
+	if op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+		direction, body = av
+		prefix = {(1, sre_constants.ASSERT): b'(?=', (1, sre_constants.ASSERT_NOT): b'(?!',
+				(-1, sre_constants.ASSERT): b'(?<=', (-1, sre_constants.ASSERT_NOT): b'(?<!'}[(direction, op)]
+		return prefix + translate_items(body.data, False, state) + b')'
+	if op is sre_constants.AT:
+		ats = {sre_constants.AT_BEGINNING: b'^', sre_constants.AT_END: b'$',
+				sre_constants.AT_BEGINNING_STRING: b'\\A', sre_constants.AT_END_STRING: b'\\Z'}
+		if av not in ats:
+			raise Untranslatable(av)
+		return ats[av]
+	if op is sre_constants.GROUPREF:
+		return b'(?:\\%d)' % (av)
+	raise Untranslatable(op)
+
+class ParseState(object):
+	def __init__(self, flags, groupdict):
+		self.flags = flags
+		self.names = dict((number, name) for name, number in groupdict.items())
+
+def translate(pattern):
+	" The compiled bytes pattern matching the UTF-8 of what pattern matches. "
+	if pattern.flags & (re.IGNORECASE | re.VERBOSE | re.ASCII) or not isinstance(pattern.pattern, str):
+		raise Untranslatable(pattern.pattern)
+	parsed = sre_parse.parse(pattern.pattern, pattern.flags)
+	state = ParseState(parsed.state.flags, parsed.state.groupdict)
+	source = translate_items(parsed.data, True, state)
+	try:
+		return re.compile(source, pattern.flags & (re.MULTILINE | re.DOTALL))
+	except re.error:
+		# e.g. a lookbehind which is no longer of fixed width
+		raise Untranslatable(pattern.pattern)
+
+def byte_conversions(conversions):
+	" A copy of conversions with bytes patterns, or None if a rule can't be translated. "
+	result = {}
+	for name, conv in conversions.items():
+		conv = dict(conv)
+		try:
+			if 'match' in conv:
+				conv['match'] = translate(conv['match'])
+		except Untranslatable:
+			return None
+		if 'repl' in conv:
+			conv['repl'] = conv['repl'].encode('utf-8')
+		if 'needs' in conv:
+			conv['needs'] = [literal.encode('utf-8') for literal in conv['needs']]
+		result[name] = conv
+	return result
+
+def valid_utf8(data, size = 1 << 16):
+	" Raise UnicodeDecodeError if data isn't valid UTF-8, decoding a piece at a time. "
+	if data.isascii():
+		return
+	decoder = codecs.getincrementaldecoder('utf-8')()
+	for start in range(0, len(data), size):
+		decoder.decode(data[start:start + size])
+	decoder.decode(b'', True)
+
+class CharOffsets(object):
+	"""
+	Character offsets in a piece of UTF-8, given byte offsets. The matches
+	found in it ask about offsets mostly in order, so only the bytes since
+	the last offset asked about are decoded, not the whole text up to it.
+	"""
+	def __init__(self, data):
+		self.data = data
+		self.byte = self.char = 0
+
+	def __call__(self, byte_offset):
+		if byte_offset < 0:
+			return -1
+		if byte_offset >= self.byte:
+			self.char += len(self.data[self.byte:byte_offset].decode('utf-8'))
+		else:
+			self.char -= len(self.data[byte_offset:self.byte].decode('utf-8'))
+		self.byte = byte_offset
+		return self.char
+
+class Utf8Match(object):
+	"""
+	A bytes match, as macros expect to see it: groups are str, and offsets
+	count characters of the text the match was found in. Matches in the
+	same text should share its CharOffsets.
+	"""
+	def __init__(self, match, offsets = None):
+		self.match = match
+		self.offset = offsets if offsets is not None else CharOffsets(match.string)
+		self.re = match.re
+		self.lastindex = match.lastindex
+		self.lastgroup = match.lastgroup
+
+	def group(self, *indices):
+		groups = [self.decode(self.match.group(idx)) for idx in (indices or (0,))]
+		return groups[0] if len(groups) == 1 else tuple(groups)
+
+	__getitem__ = group
+
+	def groups(self, default = None):
+		return tuple(self.decode(group) if group is not None else default for group in self.match.groups())
+
+	def groupdict(self, default = None):
+		return dict((name, self.decode(group) if group is not None else default)
+				for name, group in self.match.groupdict().items())
+
+	def decode(self, group):
+		return group.decode('utf-8') if group is not None else None
+
+	def start(self, group = 0):
+		return self.offset(self.match.start(group))
+
+	def end(self, group = 0):
+		return self.offset(self.match.end(group))
+
+	def span(self, group = 0):
+		return self.start(group), self.end(group)
+
+	def expand(self, template):
+		return self.match.expand(template.encode('utf-8')).decode('utf-8')
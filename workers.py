@@ -0,0 +1,187 @@
+# vim: set fileencoding=utf-8 :
+"""
+Convert documents in a pool of worker processes, with time and memory limits.
+
+	texdown2html.py -j 4 --timeout 30 --memory-limit 500 --outdir html *.texdown
+
+Each worker sets up its converter once and then converts documents sent to it
+over a pipe. A worker which is still converting a document after --timeout
+seconds is killed and replaced, and the document fails with
+ConversionTimeout; one which runs out of the --memory-limit megabytes it may
+use over and above what it uses when idle fails the document with
+ConversionOutOfMemory and is replaced too. Other documents carry on.
+
+	pool = WorkerPool(CONVERSIONS_TXT, [Macros], opts, jobs = 4, timeout = 30)
+	for result in pool.map(documents):
+		...
+	pool.close()
+
+Each result is (output, sidecars, inputs), inputs being what macros read
+from outside the document (see Converter.note_input()), or the
+ConversionError for that document.
+imap_unordered() takes (key, text) pairs from an iterable as workers come
+free, for more documents than should be held in memory at once.
+"""
+
+import multiprocessing
+import os
+import time
+import traceback
+from multiprocessing.connection import wait
+
+try:
+	import resource
+except ImportError: # Not on Windows
+	resource = None
+
+import texdown
+
+class ConversionTimeout(texdown.ConversionError):
+	def __init__(self, timeout):
+		texdown.ConversionError.__init__(self, "conversion took longer than %s seconds" % (timeout))
+		self.timeout = timeout
+
+class ConversionOutOfMemory(texdown.ConversionError):
+	def __init__(self, limit):
+		texdown.ConversionError.__init__(self, "conversion used more than %s MB" % (limit))
+		self.limit = limit
+
+def address_space():
+	" This process's address space in bytes, or 0 if it can't be found. "
+	try:
+		with open('/proc/self/statm') as handle:
+			return int(handle.read().split()[0]) * os.sysconf('SC_PAGE_SIZE')
+	except (IOError, OSError, ValueError):
+		return 0
+
+def serve(connection, conversions_txt, macro_clses, opts, memory_limit):
+	" The worker process: convert each document received until told to stop. "
+	texdown.update_conversions(texdown.CONVERSIONS, conversions_txt)
+	converter = texdown.Converter(macro_clses, opts)
+	if memory_limit:
+		limit = address_space() + memory_limit * 1024 * 1024
+		resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+	while True:
+		texdown_text = connection.recv()
+		if texdown_text is None:
+			return
+		try:
+			output = ''.join(converter.convert_document(texdown_text))
+			connection.send(('ok', output, converter.sidecars, converter.inputs))
+		except MemoryError:
+			# Whatever was being built is gone, but start afresh anyway.
+			connection.send(('memory', None, None, None))
+			return
+		except texdown.ConversionError as e:
+			connection.send(('error', str(e), None, None))
+		except Exception:
+			connection.send(('error', traceback.format_exc(), None, None))
+
+class Worker(object):
+	def __init__(self, context, args):
+		self.connection, child = context.Pipe()
+		self.process = context.Process(target = serve, args = (child,) + args)
+		self.process.daemon = True
+		self.process.start()
+		child.close()
+		self.job = None # Index of the document being converted
+		self.deadline = None
+
+	def kill(self):
+		self.process.kill()
+		self.process.join()
+		self.connection.close()
+
+class WorkerPool(object):
+	def __init__(self, conversions_txt, macro_clses, opts, jobs = None, timeout = None, memory_limit = None):
+		"""
+		Start jobs workers (default: one per CPU), each converting with
+		Converter(macro_clses, opts) after update_conversions(conversions_txt).
+		"""
+		if memory_limit and resource is None:
+			raise ValueError("memory limits aren't supported on this platform")
+		self.context = multiprocessing.get_context()
+		self.args = (conversions_txt, macro_clses, opts, memory_limit)
+		self.timeout = timeout
+		self.memory_limit = memory_limit
+		self.workers = [Worker(self.context, self.args) for count in range(jobs or os.cpu_count() or 1)]
+
+	def replace(self, worker):
+		worker.kill()
+		self.workers[self.workers.index(worker)] = Worker(self.context, self.args)
+
+	def map(self, documents):
+		" Convert each document, returning a list of results in the same order. "
+		documents = list(documents)
+		results = [None] * len(documents)
+		for idx, result in self.imap_unordered(enumerate(documents)):
+			results[idx] = result
+		return results
+
+	def imap_unordered(self, documents):
+		"""
+		Convert each (key, text) in documents, yielding (key, result) as each
+		one finishes. Documents are only taken from the iterable as workers
+		become free, so no more than one per worker is held at a time.
+		"""
+		documents = iter(documents)
+		busy = []
+
+		while True:
+			for worker in self.workers:
+				if worker not in busy:
+					try:
+						worker.job, text = next(documents)
+					except StopIteration:
+						break
+					worker.deadline = time.monotonic() + self.timeout if self.timeout else None
+					worker.connection.send(text)
+					busy.append(worker)
+			if not busy:
+				return
+
+			deadlines = [worker.deadline for worker in busy if worker.deadline is not None]
+			wait_for = max(0, min(deadlines) - time.monotonic()) if deadlines else None
+			ready = wait([worker.connection for worker in busy], wait_for)
+
+			for worker in list(busy):
+				if worker.connection in ready:
+					try:
+						status, output, sidecars, inputs = worker.connection.recv()
+					except EOFError: # It died.
+						status, output = 'died', worker.process.exitcode
+					if status == 'ok':
+						result = (output, sidecars, inputs)
+					elif status == 'error':
+						result = texdown.ConversionError(output)
+					elif status == 'memory':
+						result = ConversionOutOfMemory(self.memory_limit)
+					else:
+						result = texdown.ConversionError("worker exited with status %s" % (output))
+					if status in ('memory', 'died'):
+						self.replace(worker)
+				elif worker.deadline is not None and time.monotonic() >= worker.deadline:
+					result = ConversionTimeout(self.timeout)
+					self.replace(worker)
+				else:
+					continue
+				busy.remove(worker)
+				yield worker.job, result
+
+	def convert(self, texdown_text):
+		" Convert one document: returns (output, sidecars, inputs) or raises ConversionError. "
+		result = self.map([texdown_text])[0]
+		if isinstance(result, Exception):
+			raise result
+		return result
+
+	def close(self):
+		for worker in self.workers:
+			try:
+				worker.connection.send(None)
+			except (IOError, OSError):
+				pass
+		for worker in self.workers:
+			worker.process.join()
+			worker.connection.close()